@@ -0,0 +1,211 @@
+"""Версионированный кэш страниц.
+
+У каждой ленты есть своя «область» (scope) со счётчиком версии:
+'posts' для главной, 'group:<slug>', 'author:<username>', 'post:<id>',
+'follower:<user_id>' для подписок читателя, 'feed:<author_id>' для
+постов автора в лентах подписчиков и 'pulled' для смены режима
+fan-out. Запись
+закэшированной страницы хранит версии всех её областей, поэтому при
+изменении контента достаточно поднять версию — запись с другими
+версиями считается устаревшей и пересчитывается.
+"""
+import hashlib
+import math
+import random
+import time
+from functools import wraps
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.http import HttpResponse
+
+from .holes import punch_holes
+from .replicas import is_pinned, replica_max_lag, replica_reads_count
+
+# Сколько секунд после логического истечения запись ещё можно отдать,
+# пока один из запросов пересчитывает страницу.
+STALE_GRACE = 60
+LOCK_TIMEOUT = 5
+LOCK_POLL_INTERVAL = 0.05
+EARLY_BETA = 1.0
+
+
+def version_key(scope):
+    # quote: слаги и имена пользователей могут быть не ASCII.
+    return 'version:' + quote(scope)
+
+
+def _initial_version():
+    # Если счётчик вытеснен, новое значение не должно совпасть ни с
+    # одной из старых версий, поэтому начинаем с текущего времени.
+    return time.time_ns()
+
+
+def get_versions(scopes):
+    """Текущие версии областей за один get_many."""
+    keys = [version_key(scope) for scope in scopes]
+    versions = cache.get_many(keys)
+    missing = {
+        key: _initial_version() + index
+        for index, key in enumerate(keys) if key not in versions}
+    if missing:
+        # Любое новое значение безопасно: оно не совпадёт со старыми.
+        cache.set_many(missing, timeout=None)
+        versions.update(missing)
+    return [versions[key] for key in keys]
+
+
+def attach_versions(objects, scope, attr='cache_version'):
+    """Проставляет объектам версии областей scope.format(pk)."""
+    objects = list(objects)
+    versions = get_versions([scope.format(obj.pk) for obj in objects])
+    for obj, version in zip(objects, versions):
+        setattr(obj, attr, version)
+
+
+def bump(*scopes):
+    """Поднимает версии областей, инвалидируя их страницы.
+
+    Внутри транзакции версии поднимаются ещё раз после коммита:
+    страница, отрендеренная по старым данным до коммита, не переживёт его.
+    """
+    _incr(scopes)
+    if connection.in_atomic_block:
+        transaction.on_commit(lambda: _incr(scopes))
+
+
+def _incr(scopes):
+    for scope in scopes:
+        key = version_key(scope)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, _initial_version(), timeout=None)
+
+
+def page_key(request, prefix, per_user=False):
+    path = hashlib.md5(request.get_full_path().encode()).hexdigest()
+    # Префикс 'page:' оставляет страницы в локальном уровне TwoTierCache.
+    key = f'page:{prefix}:{path}'
+    if per_user:
+        key += f':{request.user.pk}'
+    return key
+
+
+def stampede_protection():
+    return getattr(settings, 'CACHE_STAMPEDE_PROTECTION', True)
+
+
+def _is_stale(entry, versions, now):
+    """Запись устарела по версии, по TTL или досрочно (XFetch).
+
+    Чем дороже пересчёт (delta) и чем ближе истечение, тем выше
+    шанс, что один из запросов пересчитает страницу заранее.
+    """
+    if entry['versions'] != versions:
+        return True
+    if not stampede_protection():
+        return now >= entry['expires']
+    early = entry['delta'] * EARLY_BETA * -math.log(1 - random.random())
+    return now + early >= entry['expires']
+
+
+def _wait_for_entry(key):
+    deadline = time.monotonic() + LOCK_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(LOCK_POLL_INTERVAL)
+        entry = cache.get(key)
+        if entry is not None:
+            return entry
+    return None
+
+
+class CachedPage:
+    """Кэш страницы с версионированным ключом и hole punching.
+
+    Тело рендерится один раз для всех посетителей (персональные
+    фрагменты — через {% hole %}), поэтому ключ не зависит от cookie.
+
+    Защита от stampede: устаревшую страницу пересчитывает только
+    запрос, взявший короткую блокировку, остальные получают старое
+    тело; пустой ключ остальные ждут, а не считают параллельно.
+    """
+
+    def __init__(self, view, timeout, key_prefix, scopes, per_user):
+        self.view = view
+        self.timeout = timeout
+        self.key_prefix = key_prefix
+        self.scopes = scopes
+        self.per_user = per_user
+
+    def __call__(self, request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD') or is_pinned():
+            # Закреплённый за основной базой читатель не должен получить
+            # страницу, собранную с отстающей реплики.
+            return self.view(request, *args, **kwargs)
+        key = page_key(request, self.key_prefix, self.per_user)
+        versions = '.'.join(
+            map(str, get_versions(self.scopes(request, *args, **kwargs))))
+        entry = cache.get(key)
+        if entry is not None and not _is_stale(entry, versions, time.time()):
+            return _respond(request, entry)
+        if not stampede_protection():
+            return self.refresh(request, key, versions, entry, args, kwargs)
+        lock_key = key + ':lock'
+        if cache.add(lock_key, 1, LOCK_TIMEOUT):
+            try:
+                return self.refresh(
+                    request, key, versions, entry, args, kwargs)
+            finally:
+                cache.delete(lock_key)
+        if entry is None:
+            entry = _wait_for_entry(key)
+        if entry is None:
+            return self.refresh(request, key, versions, None, args, kwargs)
+        return _respond(request, entry)
+
+    def refresh(self, request, key, versions, previous, args, kwargs):
+        started = time.monotonic()
+        replica_reads = replica_reads_count()
+        request.shared_render = True
+        try:
+            response = self.view(request, *args, **kwargs)
+        finally:
+            request.shared_render = False
+        if response.status_code != 200 or response.streaming:
+            return response
+        timeout = self.timeout
+        if (replica_reads_count() > replica_reads
+                and (previous is None or previous['versions'] != versions)):
+            # Версию только что подняли, а реплика могла ещё не получить
+            # изменение: такую страницу скоро пересобираем.
+            timeout = min(timeout, replica_max_lag())
+        entry = {
+            'versions': versions,
+            'content': response.content.decode(response.charset),
+            'content_type': response['Content-Type'],
+            'delta': time.monotonic() - started,
+            'expires': time.time() + timeout,
+        }
+        cache.set(key, entry, self.timeout + STALE_GRACE)
+        return _respond(request, entry)
+
+
+def cache_versioned(timeout, key_prefix, scopes, per_user=False):
+    """Декоратор для CachedPage.
+
+    scopes(request, *args, **kwargs) возвращает области страницы.
+    per_user=True — для страниц, целиком принадлежащих пользователю.
+    """
+    def decorator(view):
+        return wraps(view)(
+            CachedPage(view, timeout, key_prefix, scopes, per_user))
+    return decorator
+
+
+def _respond(request, entry):
+    return HttpResponse(
+        punch_holes(request, entry['content']),
+        content_type=entry['content_type'])
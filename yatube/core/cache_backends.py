@@ -0,0 +1,425 @@
+"""Общий для всех worker-процессов кэш в файле SQLite.
+
+Внешний сервис не нужен: все процессы открывают один файл в режиме
+WAL, поэтому читатели не блокируют писателя. Записи, которые читали
+давнее всего, вытесняются при превышении MAX_ENTRIES (приближённый
+LRU: время доступа обновляется не чаще раза в TOUCH_INTERVAL секунд).
+incr и add выполняются в BEGIN IMMEDIATE и атомарны между процессами.
+
+TwoTierCache ставит перед общим кэшем маленький LRU в памяти процесса.
+"""
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS cache ('
+    ' key TEXT PRIMARY KEY,'
+    ' value BLOB NOT NULL,'
+    ' expires REAL,'
+    ' accessed REAL NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)',
+)
+# SQLite ограничивает число параметров запроса.
+CHUNK_SIZE = 500
+TOUCH_INTERVAL = 1.0
+CULL_EVERY = 50
+# Ключи, значения которых версионированы: счётчики версий, страницы
+# core.cache.page_key и фрагменты шаблонного тега {% cache %}.
+LOCAL_PREFIXES = ('version:', 'page:', 'template.cache.')
+
+
+class SQLiteCache(BaseCache):
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        self._path = location
+        options = params.get('OPTIONS', {})
+        self._busy_timeout = options.get('BUSY_TIMEOUT', 5.0)
+        self._local = threading.local()
+        self._sets = 0
+
+    def _connection(self):
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            directory = os.path.dirname(self._path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(
+                self._path, timeout=self._busy_timeout,
+                isolation_level=None, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            for statement in SCHEMA:
+                connection.execute(statement)
+            local.connection = connection
+            local.pid = os.getpid()
+        return local.connection
+
+    @contextmanager
+    def _write(self):
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    @staticmethod
+    def _alive(expires, now):
+        return expires is None or expires > now
+
+    def _key(self, key, version):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return key
+
+    def get(self, key, default=None, version=None):
+        key = self._key(key, version)
+        connection = self._connection()
+        row = connection.execute(
+            'SELECT value, expires, accessed FROM cache WHERE key = ?',
+            (key,)).fetchone()
+        if row is None:
+            return default
+        value, expires, accessed = row
+        now = time.time()
+        if not self._alive(expires, now):
+            connection.execute(
+                'DELETE FROM cache WHERE key = ? AND expires <= ?',
+                (key, now))
+            return default
+        if now - accessed > TOUCH_INTERVAL:
+            connection.execute(
+                'UPDATE cache SET accessed = ? WHERE key = ?', (now, key))
+        return pickle.loads(value)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self._key(key, version)
+        self._connection().execute(
+            'INSERT OR REPLACE INTO cache (key, value, expires, accessed) '
+            'VALUES (?, ?, ?, ?)',
+            (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+             self.get_backend_timeout(timeout), time.time()))
+        self._maybe_cull()
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self._key(key, version)
+        now = time.time()
+        with self._write() as connection:
+            connection.execute(
+                'DELETE FROM cache WHERE key = ? AND expires <= ?',
+                (key, now))
+            added = connection.execute(
+                'INSERT OR IGNORE INTO cache (key, value, expires, accessed) '
+                'VALUES (?, ?, ?, ?)',
+                (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL),
+                 self.get_backend_timeout(timeout), now)).rowcount == 1
+        if added:
+            self._maybe_cull()
+        return added
+
+    def incr(self, key, delta=1, version=None):
+        key = self._key(key, version)
+        with self._write() as connection:
+            row = connection.execute(
+                'SELECT value, expires FROM cache WHERE key = ?',
+                (key,)).fetchone()
+            if row is None or not self._alive(row[1], time.time()):
+                raise ValueError("Key '%s' not found" % key)
+            value = pickle.loads(row[0]) + delta
+            connection.execute(
+                'UPDATE cache SET value = ? WHERE key = ?',
+                (pickle.dumps(value, pickle.HIGHEST_PROTOCOL), key))
+        return value
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self._key(key, version)
+        now = time.time()
+        expires = self.get_backend_timeout(timeout)
+        return self._connection().execute(
+            'UPDATE cache SET expires = ?, accessed = ? '
+            'WHERE key = ? AND (expires IS NULL OR expires > ?)',
+            (expires, now, key, now)).rowcount == 1
+
+    def has_key(self, key, version=None):
+        key = self._key(key, version)
+        return self._connection().execute(
+            'SELECT 1 FROM cache '
+            'WHERE key = ? AND (expires IS NULL OR expires > ?)',
+            (key, time.time())).fetchone() is not None
+
+    def delete(self, key, version=None):
+        key = self._key(key, version)
+        return self._connection().execute(
+            'DELETE FROM cache WHERE key = ?', (key,)).rowcount == 1
+
+    def get_many(self, keys, version=None):
+        keys = {self._key(key, version): key for key in keys}
+        connection = self._connection()
+        now = time.time()
+        result = {}
+        stored = list(keys)
+        for start in range(0, len(stored), CHUNK_SIZE):
+            chunk = stored[start:start + CHUNK_SIZE]
+            rows = connection.execute(
+                'SELECT key, value, expires FROM cache WHERE key IN ({})'
+                .format(', '.join('?' * len(chunk))), chunk)
+            for key, value, expires in rows:
+                if self._alive(expires, now):
+                    result[keys[key]] = pickle.loads(value)
+        return result
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        expires = self.get_backend_timeout(timeout)
+        now = time.time()
+        rows = [
+            (self._key(key, version),
+             pickle.dumps(value, pickle.HIGHEST_PROTOCOL), expires, now)
+            for key, value in data.items()]
+        with self._write() as connection:
+            connection.executemany(
+                'INSERT OR REPLACE INTO cache (key, value, expires, accessed) '
+                'VALUES (?, ?, ?, ?)', rows)
+        self._maybe_cull()
+        return []
+
+    def delete_many(self, keys, version=None):
+        rows = [(self._key(key, version),) for key in keys]
+        with self._write() as connection:
+            connection.executemany('DELETE FROM cache WHERE key = ?', rows)
+
+    def clear(self):
+        self._connection().execute('DELETE FROM cache')
+
+    def _maybe_cull(self):
+        self._sets += 1
+        if self._sets % CULL_EVERY == 0:
+            self.cull()
+
+    def cull(self):
+        """Удаляет истёкшие записи, затем давно не читанные (LRU)."""
+        with self._write() as connection:
+            count = connection.execute(
+                'SELECT COUNT(*) FROM cache').fetchone()[0]
+            if count <= self._max_entries:
+                return
+            connection.execute(
+                'DELETE FROM cache WHERE expires <= ?', (time.time(),))
+            count = connection.execute(
+                'SELECT COUNT(*) FROM cache').fetchone()[0]
+            if count <= self._max_entries:
+                return
+            if self._cull_frequency == 0:
+                connection.execute('DELETE FROM cache')
+                return
+            connection.execute(
+                'DELETE FROM cache WHERE key IN ('
+                ' SELECT key FROM cache ORDER BY accessed LIMIT ?)',
+                (count // self._cull_frequency,))
+
+
+class _LocalStore:
+    """LRU в памяти процесса; общий для всех потоков, как у LocMemCache."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        self.data = OrderedDict()
+        self.stats = dict.fromkeys(('local_hits', 'shared_hits', 'misses'), 0)
+
+    def check_fork(self):
+        # После fork копия чужого процесса не должна жить дольше.
+        if self.pid != os.getpid():
+            self.data.clear()
+            self.pid = os.getpid()
+
+
+# Кэши в django.core.cache.caches создаются на каждый поток, а
+# локальный уровень должен быть один на процесс.
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class TwoTierCache(BaseCache):
+    """Локальный LRU процесса перед общим кэшем (LOCATION — его алиас).
+
+    Локально хранятся только ключи с LOCAL_PREFIXES: счётчики версий,
+    страницы core.cache и фрагменты {% cache %}. Согласованность держится
+    на версиях: закэшированная страница хранит версии своих областей,
+    ключ карточки содержит версию поста, поэтому после bump в любом
+    процессе старые локальные копии не отдаются, а чужой bump виден
+    здесь не позже чем через COUNTER_TIMEOUT. Остальные ключи (шард
+    автора, kvstore sorl) версий не имеют, и локальная копия пережила
+    бы их удаление другим процессом, поэтому они идут только в общий
+    кэш.
+
+    Записи живут локально не дольше LOCAL_TIMEOUT секунд, счётчики
+    версий (ключи с COUNTER_PREFIX) — не дольше COUNTER_TIMEOUT.
+    Блокировки (add) и incr всегда идут в общий кэш.
+    """
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        self._shared_alias = location
+        options = params.get('OPTIONS', {})
+        self._local_timeout = options.get('LOCAL_TIMEOUT', 10)
+        self._counter_timeout = options.get('COUNTER_TIMEOUT', 1)
+        self._counter_prefix = options.get('COUNTER_PREFIX', 'version:')
+        self._local_prefixes = tuple(options.get(
+            'LOCAL_PREFIXES', LOCAL_PREFIXES))
+        with _stores_lock:
+            self._store = _stores.setdefault(location, _LocalStore())
+
+    @property
+    def shared(self):
+        return caches[self._shared_alias]
+
+    def stats(self):
+        """Попадания в локальный и общий уровни и промахи."""
+        store = self._store
+        with store.lock:
+            stats = dict(store.stats, local_entries=len(store.data))
+        lookups = stats['local_hits'] + stats['shared_hits'] + stats['misses']
+        stats['local_hit_ratio'] = (
+            stats['local_hits'] / lookups if lookups else 0.0)
+        return stats
+
+    def reset_stats(self):
+        store = self._store
+        with store.lock:
+            for name in store.stats:
+                store.stats[name] = 0
+
+    def _count(self, name, amount=1):
+        with self._store.lock:
+            self._store.stats[name] += amount
+
+    def _is_local(self, key):
+        return key.startswith(self._local_prefixes)
+
+    def _remember(self, key, value, version, timeout=DEFAULT_TIMEOUT):
+        if not self._is_local(key):
+            return
+        ttl = (
+            self._counter_timeout if key.startswith(self._counter_prefix)
+            else self._local_timeout)
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        if timeout is not None:
+            ttl = min(ttl, timeout)
+        expires = time.monotonic() + ttl
+        local_key = self.make_key(key, version=version)
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        store = self._store
+        with store.lock:
+            store.check_fork()
+            store.data[local_key] = (data, expires)
+            store.data.move_to_end(local_key)
+            while len(store.data) > self._max_entries:
+                store.data.popitem(last=False)
+
+    def _recall(self, key, version):
+        """(True, значение) при локальном попадании, иначе (False, None)."""
+        if not self._is_local(key):
+            return False, None
+        local_key = self.make_key(key, version=version)
+        store = self._store
+        with store.lock:
+            store.check_fork()
+            item = store.data.get(local_key)
+            if item is None:
+                return False, None
+            if item[1] <= time.monotonic():
+                del store.data[local_key]
+                return False, None
+            store.data.move_to_end(local_key)
+            store.stats['local_hits'] += 1
+        return True, pickle.loads(item[0])
+
+    def _forget(self, key, version):
+        with self._store.lock:
+            self._store.data.pop(self.make_key(key, version=version), None)
+
+    def get(self, key, default=None, version=None):
+        found, value = self._recall(key, version)
+        if found:
+            return value
+        missing = object()
+        value = self.shared.get(key, missing, version=version)
+        if value is missing:
+            self._count('misses')
+            return default
+        self._count('shared_hits')
+        self._remember(key, value, version)
+        return value
+
+    def get_many(self, keys, version=None):
+        result = {}
+        rest = []
+        for key in keys:
+            found, value = self._recall(key, version)
+            if found:
+                result[key] = value
+            else:
+                rest.append(key)
+        if rest:
+            fetched = self.shared.get_many(rest, version=version)
+            self._count('shared_hits', len(fetched))
+            self._count('misses', len(rest) - len(fetched))
+            for key, value in fetched.items():
+                self._remember(key, value, version)
+            result.update(fetched)
+        return result
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.shared.set(key, value, timeout, version=version)
+        self._remember(key, value, version, timeout)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        failed = self.shared.set_many(data, timeout, version=version)
+        for key, value in data.items():
+            if key not in failed:
+                self._remember(key, value, version, timeout)
+        return failed
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        # Решает только общий кэш: add служит межпроцессной блокировкой.
+        self._forget(key, version)
+        return self.shared.add(key, value, timeout, version=version)
+
+    def incr(self, key, delta=1, version=None):
+        self._forget(key, version)
+        value = self.shared.incr(key, delta, version=version)
+        self._remember(key, value, version)
+        return value
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        return self.shared.touch(key, timeout, version=version)
+
+    def has_key(self, key, version=None):
+        found, _ = self._recall(key, version)
+        return found or self.shared.has_key(key, version=version)
+
+    def delete(self, key, version=None):
+        self._forget(key, version)
+        return self.shared.delete(key, version=version)
+
+    def delete_many(self, keys, version=None):
+        for key in keys:
+            self._forget(key, version)
+        self.shared.delete_many(keys, version=version)
+
+    def clear(self):
+        with self._store.lock:
+            self._store.data.clear()
+        self.shared.clear()
@@ -0,0 +1,33 @@
+"""Настройка соединений SQLite.
+
+PRAGMA действуют на соединение, поэтому применяются обработчиком
+connection_created к каждому новому соединению каждого worker'а.
+WAL позволяет читателям не ждать писателя, busy_timeout заставляет
+писателя подождать блокировку вместо мгновенного «database is locked».
+"""
+from django.conf import settings
+
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    # В режиме WAL NORMAL не портит базу при сбое, но не ждёт fsync
+    # на каждом коммите.
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,
+    # Отрицательное значение — размер в КиБ.
+    'cache_size': -20000,
+    'mmap_size': 128 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+}
+
+
+def sqlite_pragmas():
+    return getattr(settings, 'SQLITE_PRAGMAS', DEFAULT_PRAGMAS)
+
+
+def apply_pragmas(sender, connection, **kwargs):
+    """Обработчик connection_created: PRAGMA из sqlite_pragmas()."""
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for name, value in sqlite_pragmas().items():
+            cursor.execute(f'PRAGMA {name} = {value}')
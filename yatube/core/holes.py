@@ -0,0 +1,54 @@
+"""Hole punching для общих закэшированных страниц.
+
+Тело страницы рендерится один раз для всех посетителей; вместо
+персональных кусочков (шапка, вкладки, CSRF-формы, кнопки) тег
+{% hole %} оставляет маркер. После чтения из кэша punch_holes()
+рендерит маленькие шаблоны маркеров для конкретного запроса.
+"""
+import re
+from urllib.parse import parse_qsl, urlencode
+
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+HOLE_RE = re.compile(r'<!--hole:(?P<name>[\w/.-]+)\?(?P<params>[^>]*?)-->')
+
+# Поставщики дополнительного контекста: имя шаблона -> функция
+# (request, **params) -> dict.
+_providers = {}
+
+
+def hole_context(template_name):
+    """Регистрирует поставщика контекста для шаблона-дырки."""
+    def decorator(func):
+        _providers[template_name] = func
+        return func
+    return decorator
+
+
+def is_shared_render(request):
+    return getattr(request, 'shared_render', False)
+
+
+def render_hole(request, template_name, params):
+    context = dict(params)
+    provider = _providers.get(template_name)
+    if provider is not None:
+        context.update(provider(request, **params))
+    return render_to_string(template_name, context, request=request)
+
+
+def marker(template_name, params):
+    params = {
+        key: value for key, value in params.items()
+        if value is not None and value is not False}
+    return mark_safe(
+        f'<!--hole:{template_name}?{urlencode(params)}-->')
+
+
+def punch_holes(request, content):
+    """Заменяет маркеры в общем теле страницы на персональный HTML."""
+    def replace(match):
+        params = dict(parse_qsl(match.group('params')))
+        return render_hole(request, match.group('name'), params)
+    return HOLE_RE.sub(replace, content)
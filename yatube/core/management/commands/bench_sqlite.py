@@ -0,0 +1,154 @@
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connections, transaction
+from django.db.models import F
+from django.db.backends.signals import connection_created
+
+from core.db import apply_pragmas
+from core.writer import Writer
+from posts.models import Comment, Post, User
+
+ALIAS = 'bench'
+
+
+class Command(BaseCommand):
+    help = (
+        'Нагрузочный тест SQLite: смешанные чтения и записи из '
+        'нескольких потоков с PRAGMA из core.db и без них, а также '
+        'с записями через очередь core.writer.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=8)
+        parser.add_argument('--duration', type=float, default=5.0)
+        parser.add_argument('--write-ratio', type=float, default=0.2,
+                            help='Доля операций записи')
+        parser.add_argument('--posts', type=int, default=5000,
+                            help='Сколько постов в базе перед тестом')
+
+    def handle(self, *args, **options):
+        directory = tempfile.mkdtemp()
+        try:
+            for tuned, queued in ((False, False), (True, False),
+                                  (True, True)):
+                path = os.path.join(
+                    directory, f'bench-{tuned}-{queued}.sqlite3')
+                result = self.run(path, tuned, queued, options)
+                self.stdout.write(
+                    f'pragmas={"on " if tuned else "off"} '
+                    f'queue={"on " if queued else "off"} '
+                    f'reads/s={result["read"] / options["duration"]:.0f} '
+                    f'writes/s={result["write"] / options["duration"]:.0f} '
+                    f'locked={result["locked"]} '
+                    f'p99 ms={result["p99"] * 1000:.1f}')
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def run(self, path, tuned, queued, options):
+        connections.databases[ALIAS] = dict(
+            connections.databases['default'], NAME=path)
+        # Без обработчика — стандартные настройки SQLite: журнал отката
+        # (читатели и писатель блокируют друг друга) и synchronous=FULL.
+        if not tuned:
+            connection_created.disconnect(apply_pragmas)
+        writer = Writer(using=ALIAS) if queued else None
+        try:
+            self.create_schema()
+            self.seed(options['posts'])
+            return self.load(options, writer)
+        finally:
+            if writer is not None:
+                writer.stop()
+            connection_created.connect(apply_pragmas)
+            connections[ALIAS].close()
+            del connections[ALIAS]
+            del connections.databases[ALIAS]
+
+    def create_schema(self):
+        # Таблицы по текущим моделям, без миграций: тесту не нужны их
+        # данные, а часть миграций данных пишет в основную базу.
+        with connections[ALIAS].schema_editor() as editor:
+            for model in apps.get_models():
+                if model._meta.managed and not model._meta.proxy:
+                    editor.create_model(model)
+
+    def seed(self, count):
+        User.objects.using(ALIAS).bulk_create(
+            [User(username=f'bench{index}') for index in range(20)])
+        users = list(User.objects.using(ALIAS))
+        Post.objects.using(ALIAS).bulk_create(
+            [Post(author=random.choice(users), text=f'Пост {index}')
+             for index in range(count)], batch_size=500)
+
+    def operations(self, writer):
+        """Чтение главной и запись комментария (через очередь или нет)."""
+        user_ids = list(
+            User.objects.using(ALIAS).values_list('pk', flat=True))
+        post_ids = list(
+            Post.objects.using(ALIAS).values_list('pk', flat=True)[:1000])
+
+        def read():
+            list(Post.objects.using(ALIAS).for_cards()[:10])
+
+        def comment():
+            # Как add_comment: вставка и счётчик в одной транзакции.
+            with transaction.atomic(using=ALIAS):
+                post_id = random.choice(post_ids)
+                Comment.objects.using(ALIAS).bulk_create([Comment(
+                    post_id=post_id, author_id=random.choice(user_ids),
+                    text='Комментарий')])
+                Post.objects.using(ALIAS).filter(pk=post_id).update(
+                    comments_count=F('comments_count') + 1)
+
+        if writer is None:
+            return read, comment
+        return read, lambda: writer.run(comment)
+
+    def load(self, options, writer=None):
+        result = Counter()
+        latencies = []
+        lock = threading.Lock()
+        stop = threading.Event()
+        read, write = self.operations(writer)
+
+        def worker():
+            local = Counter()
+            local_latencies = []
+            while not stop.is_set():
+                kind = (
+                    'write' if random.random() < options['write_ratio']
+                    else 'read')
+                started = time.monotonic()
+                try:
+                    write() if kind == 'write' else read()
+                except OperationalError:
+                    local['locked'] += 1
+                    continue
+                local_latencies.append(time.monotonic() - started)
+                local[kind] += 1
+            connections[ALIAS].close()
+            with lock:
+                result.update(local)
+                latencies.extend(local_latencies)
+
+        threads = [
+            threading.Thread(target=worker)
+            for _ in range(options['threads'])]
+        for thread in threads:
+            thread.start()
+        time.sleep(options['duration'])
+        stop.set()
+        for thread in threads:
+            thread.join()
+        latencies.sort()
+        result['p99'] = (
+            latencies[int(len(latencies) * 0.99)] if latencies else 0)
+        return result
@@ -0,0 +1,82 @@
+import threading
+import time
+from collections import Counter
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client, override_settings
+
+from core.cache import bump
+
+
+class Command(BaseCommand):
+    help = (
+        'Нагрузочный тест: запросы к БД в секунду, пока версия главной '
+        'страницы регулярно меняется, с защитой от stampede и без неё.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=16)
+        parser.add_argument('--duration', type=float, default=10.0)
+        parser.add_argument('--bump-every', type=float, default=2.0,
+                            help='Как часто (с) менять версию страницы')
+        parser.add_argument('--query-latency', type=float, default=20.0,
+                            help='Искусственная задержка запроса к БД, мс')
+        parser.add_argument('--path', default='/')
+        parser.add_argument('--scope', default='posts')
+
+    def handle(self, *args, **options):
+        for protection in (False, True):
+            with override_settings(CACHE_STAMPEDE_PROTECTION=protection):
+                requests, queries = self.run(options)
+            per_second = [
+                queries[second]
+                for second in range(int(options['duration']))]
+            self.stdout.write(
+                f'protection={"on " if protection else "off"} '
+                f'requests/s={requests / options["duration"]:.0f} '
+                f'db queries/s: max={max(per_second)} '
+                f'mean={sum(per_second) / len(per_second):.1f} '
+                f'by second={per_second}')
+            if hasattr(cache, 'stats'):
+                self.stdout.write(f'  cache: {cache.stats()}')
+
+    def run(self, options):
+        cache.clear()
+        if hasattr(cache, 'reset_stats'):
+            cache.reset_stats()
+        queries = Counter()
+        requests = Counter()
+        lock = threading.Lock()
+        stop = threading.Event()
+        latency = options['query_latency'] / 1000
+        started = time.monotonic()
+
+        def counting(execute, sql, params, many, context):
+            time.sleep(latency)
+            with lock:
+                queries[int(time.monotonic() - started)] += 1
+            return execute(sql, params, many, context)
+
+        def worker():
+            client = Client()
+            with connection.execute_wrapper(counting):
+                while not stop.is_set():
+                    client.get(options['path'])
+                    with lock:
+                        requests['total'] += 1
+            connection.close()
+
+        threads = [
+            threading.Thread(target=worker)
+            for _ in range(options['threads'])]
+        for thread in threads:
+            thread.start()
+        while time.monotonic() - started < options['duration']:
+            time.sleep(options['bump_every'])
+            bump(options['scope'])
+        stop.set()
+        for thread in threads:
+            thread.join()
+        return requests['total'], queries
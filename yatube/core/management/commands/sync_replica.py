@@ -0,0 +1,50 @@
+import sqlite3
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from core.replicas import replicas
+
+
+class Command(BaseCommand):
+    help = (
+        'Копирует основную базу SQLite в файлы реплик (онлайн-бэкап). '
+        'С --interval повторяет копирование, изображая асинхронную '
+        'репликацию с задержкой.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'aliases', nargs='*',
+            help='Алиасы реплик; по умолчанию DATABASE_REPLICAS '
+                 'или replica')
+        parser.add_argument(
+            '--interval', type=float, default=None,
+            help='Повторять каждые N секунд')
+
+    def handle(self, *args, **options):
+        aliases = options['aliases'] or replicas() or ['replica']
+        for alias in aliases:
+            if alias not in connections.databases:
+                raise CommandError(f'Нет базы с алиасом {alias}')
+        while True:
+            for alias in aliases:
+                self.copy(alias)
+            if options['interval'] is None:
+                return
+            time.sleep(options['interval'])
+
+    def copy(self, alias):
+        source = sqlite3.connect(
+            connections.databases[DEFAULT_DB_ALIAS]['NAME'])
+        target = sqlite3.connect(connections.databases[alias]['NAME'])
+        try:
+            started = time.monotonic()
+            source.backup(target)
+        finally:
+            target.close()
+            source.close()
+        self.stdout.write(
+            f'{alias}: скопировано за '
+            f'{(time.monotonic() - started) * 1000:.0f} мс')
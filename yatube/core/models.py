@@ -0,0 +1,22 @@
+from django.db import models
+
+
+class Checkpoint(models.Model):
+    """Докуда дошла возобновляемая команда (backfill, перенос данных)."""
+    name = models.CharField('Команда', max_length=100, primary_key=True)
+    position = models.BigIntegerField('Позиция', default=0)
+    updated = models.DateTimeField('Обновлено', auto_now=True)
+
+    class Meta:
+        verbose_name = 'Позиция команды'
+        verbose_name_plural = 'Позиции команд'
+
+
+class StoredFile(models.Model):
+    """Число ссылок на файл медиа (core.storage)."""
+    name = models.CharField('Файл', max_length=255, primary_key=True)
+    references = models.IntegerField('Ссылок', default=0)
+
+    class Meta:
+        verbose_name = 'Файл медиа'
+        verbose_name_plural = 'Файлы медиа'
@@ -0,0 +1,139 @@
+"""Чтение с реплик базы.
+
+Реплики перечислены в settings.DATABASE_REPLICAS. С них читают только
+GET-запросы представлений, помеченных replica_reads (ленты,
+post_detail, список постов в админке); все записи и остальные чтения
+идут в основную базу. Пользователь, который недавно что-то отправил
+(любой не-GET запрос), на REPLICA_PIN_SECONDS закреплён за основной
+базой: после редиректа из post_create он увидит свой пост, даже если
+реплика отстаёт. Общий кэш страниц (core.cache) такой запрос обходит:
+страницу в нём могли собрать с реплики до записи.
+"""
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+PIN_SESSION_KEY = 'replica_pin_until'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+class _State:
+    """Состояние текущего запроса (потока)."""
+
+    def __init__(self, pinned=False):
+        self.pinned = pinned
+        self.allowed = False
+        # Сколько чтений ушло на реплики: core.cache по нему узнаёт,
+        # что страница могла быть собрана из отстающих данных.
+        self.replica_reads = 0
+
+
+_state = ContextVar('replica_state', default=None)
+
+
+def replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', [])
+
+
+def replica_max_lag():
+    """Наибольшее ожидаемое отставание реплик, секунды."""
+    return getattr(settings, 'REPLICA_MAX_LAG', 5)
+
+
+def is_pinned():
+    """Текущий запрос закреплён за основной базой."""
+    state = _state.get()
+    return state is not None and state.pinned
+
+
+def replica_reads_count():
+    state = _state.get()
+    return state.replica_reads if state is not None else 0
+
+
+@contextmanager
+def reading_replicas():
+    """Разрешает чтения с реплик внутри блока."""
+    state = _state.get()
+    token = None
+    if state is None:
+        state = _State()
+        token = _state.set(state)
+    allowed, state.allowed = state.allowed, True
+    try:
+        yield state
+    finally:
+        state.allowed = allowed
+        if token is not None:
+            _state.reset(token)
+
+
+def replica_reads(view):
+    """Декоратор: GET-запросы представления читают с реплик."""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.method not in SAFE_METHODS:
+            return view(request, *args, **kwargs)
+        with reading_replicas():
+            return view(request, *args, **kwargs)
+    return wrapper
+
+
+class ReplicaChangeListMixin:
+    """Список объектов в админке читается с реплик.
+
+    Только GET: POST списка сохраняет list_editable, и формы должны
+    быть построены по данным основной базы.
+    """
+
+    def changelist_view(self, request, extra_context=None):
+        if request.method not in SAFE_METHODS:
+            return super().changelist_view(request, extra_context)
+        with reading_replicas():
+            return super().changelist_view(request, extra_context)
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        aliases = replicas()
+        if (state is None or not state.allowed or state.pinned
+                or not aliases):
+            return None
+        state.replica_reads += 1
+        return random.choice(aliases)
+
+    def db_for_write(self, model, **hints):
+        # Явно: иначе объект, прочитанный с реплики, сохранился бы туда же.
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # На всех алиасах одни и те же данные.
+        return True
+
+
+class ReplicaPinMiddleware:
+    """Закрепляет недавно писавшего пользователя за основной базой."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not replicas():
+            return self.get_response(request)
+        pinned = request.session.get(PIN_SESSION_KEY, 0) > time.time()
+        token = _state.set(_State(pinned=pinned))
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.reset(token)
+        if request.method not in SAFE_METHODS:
+            request.session[PIN_SESSION_KEY] = (
+                time.time() + getattr(settings, 'REPLICA_PIN_SECONDS', 10))
+        return response
@@ -0,0 +1,161 @@
+"""Хранилище медиа с именами по содержимому.
+
+Файл сохраняется под sha256 своего содержимого: повторная загрузка
+той же картинки не пишет вторую копию, а получает имя уже лежащего
+файла — и те же миниатюры sorl, ключ которых зависит от имени.
+Файлы раскладываются по подпапкам из первых знаков хеша
+(posts/ab/cd/abcd….jpg): в одной папке их не больше нескольких сотен
+даже при миллионах картинок. Старые файлы переносит shard_media.
+
+Сколько строк ссылается на файл, хранит StoredFile. Ссылку добавляет
+и снимает владелец файла (сигналы постов); файл удаляется после
+коммита, когда ссылок не осталось. Файлы с прежними, не хешевыми
+именами не считаются и так не удаляются. Расхождения после правок в
+обход сигналов чинит recount_media.
+
+Повторная загрузка того же файла берёт ссылку (reserve) до проверки
+exists() и держит её до коммита всех открытых транзакций: удаление
+последней прежней ссылки в это время файл не удалит, а
+delete_unreferenced удаляет строку и файл в одной транзакции, так что
+загрузка видит либо файл со ссылкой, либо его отсутствие.
+"""
+import hashlib
+import os
+import re
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.db import connections, transaction
+from django.db.models import F
+from django.utils.deconstruct import deconstructible
+from sorl.thumbnail import default
+from sorl.thumbnail.images import ImageFile
+
+from .models import StoredFile
+
+CHUNK_SIZE = 64 * 1024
+# Два уровня по два знака хеша — 65 536 папок.
+SHARD_LEVELS = 2
+SHARD_WIDTH = 2
+DIGEST = re.compile(r'^[0-9a-f]{64}$')
+
+
+def content_hash(content):
+    """sha256 файла; читается кусками, позиция в файле сбрасывается."""
+    digest = hashlib.sha256()
+    content.seek(0)
+    for chunk in content.chunks(CHUNK_SIZE):
+        digest.update(chunk)
+    content.seek(0)
+    return digest.hexdigest()
+
+
+def walk(storage, path=''):
+    """Имена файлов в папке path хранилища и во вложенных папках.
+
+    В памяти — листинг одной папки за раз.
+    """
+    directories, files = storage.listdir(path)
+    for name in sorted(files):
+        yield os.path.join(path, name)
+    for directory in sorted(directories):
+        yield from walk(storage, os.path.join(path, directory))
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """FileSystemStorage, который называет файлы по sha256."""
+
+    def hashed_name(self, name, digest):
+        """Имя файла с содержимым digest для загрузки с именем name."""
+        directory = os.path.dirname(name)
+        extension = os.path.splitext(name)[1].lower()
+        shards = [
+            digest[level * SHARD_WIDTH:(level + 1) * SHARD_WIDTH]
+            for level in range(SHARD_LEVELS)]
+        return os.path.join(directory, *shards, digest + extension)
+
+    def is_hashed(self, name):
+        """Имя выдано этим хранилищем, а не досталось от прежнего."""
+        stem = os.path.splitext(os.path.basename(name))[0]
+        return bool(DIGEST.match(stem))
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        name = self.hashed_name(name, content_hash(content))
+        reserve(name)
+        try:
+            # Свежее время изменения: collect_media не примет уже
+            # лежащий файл за старый мусор, пока пост не закоммичен.
+            os.utime(self.path(name))
+            return name
+        except FileNotFoundError:
+            pass
+        # Параллельная загрузка того же файла получит имя с суффиксом:
+        # лишняя копия, но не потеря данных.
+        return super().save(name, content, max_length)
+
+
+def add_reference(name):
+    if not name:
+        return
+    StoredFile.objects.bulk_create(
+        [StoredFile(name=name)], ignore_conflicts=True)
+    StoredFile.objects.filter(name=name).update(
+        references=F('references') + 1)
+
+
+def reserve(name):
+    """Временная ссылка на name до коммита текущих транзакций.
+
+    Постоянную ссылку берёт владелец (сигналы постов) в той же
+    транзакции; без транзакции ссылка снимается сразу.
+    """
+    add_reference(name)
+    # Пост пишется в транзакции своего шарда, а ссылка — в основной
+    # базе: снимать её можно только после коммита обеих.
+    aliases = [
+        connection.alias for connection in connections.all()
+        if connection.in_atomic_block]
+    after_commit(aliases, lambda: StoredFile.objects.filter(
+        name=name).update(references=F('references') - 1))
+
+
+def after_commit(aliases, callback):
+    """Вызывает callback после коммита транзакций всех aliases."""
+    if not aliases:
+        callback()
+        return
+    transaction.on_commit(
+        lambda: after_commit(aliases[1:], callback), using=aliases[0])
+
+
+def drop_reference(name, storage, using=None, thumbnails=True):
+    """Снимает ссылку; файл без ссылок удаляется после коммита using.
+
+    thumbnails=False оставляет миниатюры sorl: их адреса ещё лежат в
+    Post.renditions постов, перенесённых на новое имя (shard_media).
+    """
+    if not name:
+        return
+    StoredFile.objects.filter(name=name).update(
+        references=F('references') - 1)
+    transaction.on_commit(
+        lambda: delete_unreferenced(name, storage, thumbnails), using=using)
+
+
+def delete_unreferenced(name, storage, thumbnails=True):
+    # Удалить строку может только один процесс: он и удаляет файл. Файл
+    # удаляется до коммита: reserve() новой загрузки ждёт его.
+    with transaction.atomic():
+        deleted, _ = StoredFile.objects.filter(
+            name=name, references__lte=0).delete()
+        if deleted:
+            if thumbnails:
+                # Миниатюры sorl и их записи в kvstore — вместе с
+                # исходником.
+                default.kvstore.delete(ImageFile(name, storage))
+            storage.delete(name)
@@ -0,0 +1,18 @@
+from django import template
+
+from core.holes import is_shared_render, marker, render_hole
+
+register = template.Library()
+
+
+@register.simple_tag(takes_context=True)
+def hole(context, template_name, **params):
+    """Персональный фрагмент страницы.
+
+    На общей (кэшируемой) странице оставляет маркер, иначе сразу
+    рендерит шаблон для текущего запроса.
+    """
+    request = context.get('request')
+    if request is not None and is_shared_render(request):
+        return marker(template_name, params)
+    return render_hole(request, template_name, params)
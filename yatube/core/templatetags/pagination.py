@@ -0,0 +1,14 @@
+from django import template
+
+register = template.Library()
+
+
+@register.simple_tag(takes_context=True)
+def page_url(context, cursor=None):
+    """Адрес страницы ленты: параметры запроса (?q= и др.) с cursor."""
+    query = context['request'].GET.copy()
+    query.pop('page', None)
+    query.pop('cursor', None)
+    if cursor:
+        query['cursor'] = cursor
+    return '?' + query.urlencode()
@@ -0,0 +1,41 @@
+"""Окружение тестов: свой файл общего кэша.
+
+Иначе тесты читали бы страницы и счётчики версий работающего сайта из
+cache/cache.sqlite3 и писали бы в него свои.
+"""
+import copy
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.test import override_settings
+from django.test.runner import DiscoverRunner
+
+
+@contextmanager
+def isolated_cache():
+    """Общий кэш во временном файле, удаляемом на выходе."""
+    directory = tempfile.mkdtemp(prefix='yatube-cache-')
+    caches = copy.deepcopy(settings.CACHES)
+    caches['shared']['LOCATION'] = os.path.join(directory, 'cache.sqlite3')
+    try:
+        with override_settings(CACHES=caches):
+            yield
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+class TestRunner(DiscoverRunner):
+    """manage.py test с isolated_cache(); для pytest — фикстура в
+    tests/conftest.py."""
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self._cache = isolated_cache()
+        self._cache.__enter__()
+
+    def teardown_test_environment(self, **kwargs):
+        self._cache.__exit__(None, None, None)
+        super().teardown_test_environment(**kwargs)
@@ -0,0 +1,168 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from django.core.cache import caches
+from django.test import SimpleTestCase
+
+from core.cache_backends import SQLiteCache, TwoTierCache, _LocalStore
+
+
+class SQLiteCacheTests(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cache.sqlite3')
+        self.cache = SQLiteCache(self.path, {})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_set_get_delete(self):
+        """Значение читается, пока не удалено"""
+        self.cache.set('key', {'a': 1})
+        self.assertEqual(self.cache.get('key'), {'a': 1})
+        self.assertTrue(self.cache.delete('key'))
+        self.assertIsNone(self.cache.get('key'))
+
+    def test_expired_value_is_missing(self):
+        """Истёкшее значение не отдаётся"""
+        self.cache.set('key', 'value', timeout=0.01)
+        time.sleep(0.02)
+        self.assertIsNone(self.cache.get('key'))
+        self.assertTrue(self.cache.add('key', 'new'))
+
+    def test_add_only_missing(self):
+        """add не перезаписывает существующий ключ"""
+        self.assertTrue(self.cache.add('key', 1))
+        self.assertFalse(self.cache.add('key', 2))
+        self.assertEqual(self.cache.get('key'), 1)
+
+    def test_shared_between_workers(self):
+        """Второй экземпляр (другой worker) видит те же данные"""
+        other = SQLiteCache(self.path, {})
+        self.cache.set('key', 'value')
+        self.assertEqual(other.get('key'), 'value')
+        other.delete('key')
+        self.assertIsNone(self.cache.get('key'))
+
+    def test_incr_is_atomic(self):
+        """Параллельные incr из разных потоков не теряются"""
+        self.cache.set('counter', 0, timeout=None)
+
+        def worker():
+            cache = SQLiteCache(self.path, {})
+            for _ in range(50):
+                cache.incr('counter')
+
+        threads = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.cache.get('counter'), 200)
+        with self.assertRaises(ValueError):
+            self.cache.incr('missing')
+
+    def test_get_many_set_many(self):
+        """set_many и get_many работают одной пачкой"""
+        data = {f'key{i}': i for i in range(600)}
+        self.assertEqual(self.cache.set_many(data), [])
+        self.assertEqual(self.cache.get_many(list(data) + ['none']), data)
+        self.cache.delete_many(['key0', 'key1'])
+        self.assertEqual(
+            self.cache.get_many(['key0', 'key1', 'key2']), {'key2': 2})
+
+    def test_cull_evicts_least_recently_used(self):
+        """При переполнении вытесняются давно не читанные ключи"""
+        cache = SQLiteCache(self.path, {
+            'OPTIONS': {'MAX_ENTRIES': 4, 'CULL_FREQUENCY': 2}})
+        for i in range(6):
+            cache.set(f'key{i}', i)
+        connection = cache._connection()
+        for i in range(6):
+            connection.execute(
+                'UPDATE cache SET accessed = ? WHERE key LIKE ?',
+                (i, f'%key{i}'))
+        # key0 записан первым, но прочитан последним.
+        cache.get('key0')
+        cache.cull()
+        self.assertEqual(
+            sorted(cache.get_many([f'key{i}' for i in range(6)])),
+            ['key0', 'key4', 'key5'])
+
+
+class TwoTierCacheTests(SimpleTestCase):
+    def setUp(self):
+        caches['shared'].clear()
+        self.options = {
+            'OPTIONS': {'MAX_ENTRIES': 3, 'COUNTER_TIMEOUT': 0.05}}
+        self.cache = TwoTierCache('shared', self.options)
+        self.cache.clear()
+        self.cache.reset_stats()
+
+    def other_worker(self):
+        other = TwoTierCache('shared', self.options)
+        # У другого процесса свой локальный уровень.
+        other._store = _LocalStore()
+        return other
+
+    def test_second_read_is_local(self):
+        """Повторное чтение не ходит в общий кэш"""
+        self.cache.set('page:key', 'value')
+        caches['shared'].delete('page:key')
+        self.assertEqual(self.cache.get('page:key'), 'value')
+        self.assertIsNone(self.cache.get('other'))
+        stats = self.cache.stats()
+        self.assertEqual(stats['local_hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_counter_from_other_worker(self):
+        """Чужой bump виден не позже чем через COUNTER_TIMEOUT"""
+        other = self.other_worker()
+        self.cache.set('version:posts', 1, timeout=None)
+        other.get('version:posts')
+        self.assertEqual(self.cache.incr('version:posts'), 2)
+        self.assertEqual(self.cache.get('version:posts'), 2)
+        self.assertEqual(other.get('version:posts'), 1)
+        time.sleep(0.06)
+        self.assertEqual(other.get_many(['version:posts']),
+                         {'version:posts': 2})
+
+    def test_unversioned_key_not_local(self):
+        """Ключи без версии читаются только из общего кэша"""
+        other = self.other_worker()
+        self.cache.set('shard:1', 'default')
+        self.assertEqual(other.get('shard:1'), 'default')
+        self.cache.delete('shard:1')
+        self.assertIsNone(other.get('shard:1'))
+        self.assertEqual(other.stats()['local_entries'], 0)
+
+    def test_add_checks_shared_cache(self):
+        """add решает общий кэш, а не локальная копия"""
+        other = self.other_worker()
+        self.assertTrue(self.cache.add('lock', 1))
+        self.assertFalse(other.add('lock', 1))
+        self.cache.delete('lock')
+        self.assertTrue(other.add('lock', 1))
+
+    def test_local_lru_is_bounded(self):
+        """Локальный уровень хранит не больше MAX_ENTRIES ключей"""
+        for i in range(5):
+            self.cache.set(f'page:key{i}', i)
+        self.assertEqual(self.cache.stats()['local_entries'], 3)
+        self.cache.get('page:key0')
+        self.assertEqual(self.cache.stats()['shared_hits'], 1)
+
+    def test_local_tier_shared_by_threads(self):
+        """Потоки одного процесса делят локальный уровень"""
+        self.cache.set('page:key', 'value')
+        values = []
+        thread = threading.Thread(
+            target=lambda: values.append(
+                TwoTierCache('shared', self.options).get('page:key')))
+        thread.start()
+        thread.join()
+        self.assertEqual(values, ['value'])
+        self.assertEqual(self.cache.stats()['local_hits'], 1)
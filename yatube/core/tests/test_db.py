@@ -0,0 +1,21 @@
+from django.db import connections
+from django.test import SimpleTestCase, override_settings
+
+
+class PragmasTests(SimpleTestCase):
+
+    @override_settings(SQLITE_PRAGMAS={
+        'busy_timeout': 1234, 'temp_store': 'MEMORY', 'cache_size': -1000})
+    def test_pragmas_applied_to_new_connection(self):
+        """PRAGMA из настроек применяются к каждому новому соединению"""
+        default = connections['default']
+        wrapper = type(default)(default.settings_dict, 'pragmas')
+        try:
+            with wrapper.cursor() as cursor:
+                values = []
+                for name in ('busy_timeout', 'temp_store', 'cache_size'):
+                    cursor.execute(f'PRAGMA {name}')
+                    values.append(cursor.fetchone()[0])
+        finally:
+            wrapper.close()
+        self.assertEqual(values, [1234, 2, -1000])
@@ -0,0 +1,91 @@
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connections
+from django.test import Client, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from core.cache import page_key
+from core.replicas import reading_replicas
+from posts.models import Post
+
+User = get_user_model()
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRoutingTests(TransactionTestCase):
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='reader')
+        self.post = Post.objects.create(author=self.user, text='Пост')
+        self.client.force_login(self.user)
+
+    def get(self, url):
+        with CaptureQueriesContext(connections['replica']) as replica:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response, len(replica)
+
+    def test_feed_reads_from_replica(self):
+        """Ленты и страница поста читают с реплики"""
+        for url in (reverse('posts:index'),
+                    reverse('posts:post_detail', args=[self.post.pk]),
+                    reverse('posts:follow_index')):
+            with self.subTest(url=url):
+                self.assertGreater(self.get(url)[1], 0)
+
+    def test_writer_is_pinned_to_primary(self):
+        """После записи пользователь читает из основной базы"""
+        response = self.client.post(
+            reverse('posts:post_create'), {'text': 'Новый пост'})
+        response, replica_queries = self.get(response.url)
+        self.assertEqual(replica_queries, 0)
+        self.assertContains(response, 'Новый пост')
+        self.assertEqual(self.get(reverse('posts:index'))[1], 0)
+        self.client.logout()
+        cache.clear()
+        self.assertGreater(self.get(reverse('posts:index'))[1], 0)
+
+    def test_pinned_reader_bypasses_page_cache(self):
+        """Закреплённый читатель не получает страницу из общего кэша"""
+        url = reverse('posts:index')
+        self.client.post(
+            reverse('posts:add_comment', args=[self.post.pk]),
+            {'text': 'Комментарий'})
+        guest = Client()
+        guest.get(url)
+        # Так выглядит страница, собранная с реплики до записи.
+        Post.objects.bulk_create(
+            [Post(author=self.user, text='Без сигнала')])
+        self.assertNotContains(guest.get(url), 'Без сигнала')
+        response, replica_queries = self.get(url)
+        self.assertEqual(replica_queries, 0)
+        self.assertContains(response, 'Без сигнала')
+
+    def test_writes_go_to_primary(self):
+        """Объект, прочитанный с реплики, сохраняется в основную базу"""
+        with reading_replicas():
+            post = Post.objects.get(pk=self.post.pk)
+        self.assertEqual(post._state.db, 'replica')
+        post.text = 'Исправлено'
+        post.save()
+        self.assertEqual(post._state.db, 'default')
+
+    @override_settings(REPLICA_MAX_LAG=3)
+    def test_page_after_bump_expires_soon(self):
+        """Страница с реплики сразу после смены версии живёт недолго"""
+        self.client.logout()
+        url = reverse('posts:index')
+        response = self.get(url)[0]
+        key = page_key(response.wsgi_request, 'index_page')
+        entry = cache.get(key)
+        self.assertLessEqual(entry['expires'], time.time() + 3)
+        # Версии с тех пор не менялись: пересобранной странице верим.
+        entry['expires'] = 0
+        cache.set(key, entry)
+        self.get(url)
+        self.assertGreater(cache.get(key)['expires'], time.time() + 3)
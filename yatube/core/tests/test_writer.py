@@ -0,0 +1,77 @@
+import threading
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.test import TransactionTestCase, override_settings
+from django.urls import reverse
+
+from core import writer as writer_module
+from core.writer import Writer
+from posts.models import Comment, Group, Post
+
+User = get_user_model()
+
+
+class WriterTests(TransactionTestCase):
+    def setUp(self):
+        self.writer = Writer(batch_wait=0.2)
+
+    def tearDown(self):
+        self.writer.stop()
+
+    def create_group(self, slug):
+        return Group.objects.create(title=slug, slug=slug, description='')
+
+    def test_writes_are_batched(self):
+        """Записи, пришедшие вместе, выполняются одной транзакцией"""
+        futures = [
+            self.writer.submit(self.create_group, f'group{index}')
+            for index in range(5)]
+        slugs = [future.result(5).slug for future in futures]
+        self.assertEqual(slugs, [f'group{index}' for index in range(5)])
+        self.assertEqual(self.writer.batches, 1)
+        self.assertEqual(Group.objects.count(), 5)
+
+    def test_failed_write_does_not_roll_back_batch(self):
+        """Ошибка одной записи достаётся только её автору"""
+        def fail():
+            self.create_group('failed')
+            raise ValueError('ошибка')
+
+        first = self.writer.submit(self.create_group, 'first')
+        failed = self.writer.submit(fail)
+        last = self.writer.submit(self.create_group, 'last')
+        with self.assertRaises(ValueError):
+            failed.result(5)
+        first.result(5)
+        last.result(5)
+        self.assertEqual(
+            sorted(Group.objects.values_list('slug', flat=True)),
+            ['first', 'last'])
+
+    def test_inside_transaction_runs_inline(self):
+        """Внутри транзакции вызывающего запись выполняется сразу"""
+        with transaction.atomic():
+            thread = self.writer.run(threading.current_thread)
+        self.assertIs(thread, threading.current_thread())
+        self.assertEqual(self.writer.batches, 0)
+
+
+class WriteQueueViewsTests(TransactionTestCase):
+    def tearDown(self):
+        writer_module.writer.stop()
+
+    @override_settings(SQLITE_WRITE_QUEUE=True)
+    def test_views_write_through_queue(self):
+        """Создание поста и комментария идут через писателя"""
+        user = User.objects.create_user(username='writer')
+        self.client.force_login(user)
+        batches = writer_module.writer.batches
+        self.client.post(reverse('posts:post_create'), {'text': 'Пост'})
+        post = Post.objects.get()
+        self.client.post(
+            reverse('posts:add_comment', args=[post.pk]),
+            {'text': 'Комментарий'})
+        self.assertEqual(Comment.objects.get().post, post)
+        self.assertEqual(Post.objects.get().comments_count, 1)
+        self.assertEqual(writer_module.writer.batches, batches + 2)
@@ -0,0 +1,134 @@
+"""Единственный писатель SQLite в процессе.
+
+SQLite пропускает одного писателя за раз, и одновременные записи из
+разных потоков ждут блокировку и повторяют попытки. С включённой
+настройкой SQLITE_WRITE_QUEUE записи из представлений выполняет один
+поток: он собирает стоящие в очереди записи в короткую транзакцию
+(каждая — в своей точке сохранения) и отвечает каждому вызывающему
+после коммита. Между процессами записи по-прежнему разводит
+busy_timeout (core.db).
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+
+BATCH_SIZE = 50
+# Сколько писатель ждёт попутчиков, прежде чем открыть транзакцию.
+BATCH_WAIT = 0.002
+RESULT_TIMEOUT = 30
+
+
+def write_queue_enabled():
+    return getattr(settings, 'SQLITE_WRITE_QUEUE', False)
+
+
+class Writer:
+
+    def __init__(self, using=DEFAULT_DB_ALIAS, batch_size=BATCH_SIZE,
+                 batch_wait=BATCH_WAIT):
+        self.using = using
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        # Число выполненных транзакций-пачек.
+        self.batches = 0
+
+    def submit(self, func, *args, **kwargs):
+        """Ставит запись в очередь; результат — в возвращённом Future."""
+        future = Future()
+        self._ensure_started()
+        self._queue.put((future, func, args, kwargs))
+        return future
+
+    def run(self, func, *args, **kwargs):
+        """Выполняет запись через очередь и ждёт коммита.
+
+        Внутри чужой транзакции и в самом потоке писателя запись
+        выполняется сразу: иначе вызывающий не увидел бы её до своего
+        коммита или ждал бы сам себя.
+        """
+        if (threading.current_thread() is self._thread
+                or connections[self.using].in_atomic_block):
+            return func(*args, **kwargs)
+        return self.submit(func, *args, **kwargs).result(RESULT_TIMEOUT)
+
+    def stop(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def _ensure_started(self):
+        # После fork потока-писателя в дочернем процессе нет.
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._loop, name='sqlite-writer', daemon=True)
+                self._thread.start()
+
+    def _loop(self):
+        try:
+            while True:
+                batch = self._next_batch()
+                if batch is None:
+                    return
+                self._execute(batch)
+        finally:
+            connections[self.using].close()
+
+    def _next_batch(self):
+        item = self._queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            try:
+                item = self._queue.get(
+                    timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _execute(self, batch):
+        self.batches += 1
+        results = []
+        try:
+            with transaction.atomic(using=self.using):
+                for future, func, args, kwargs in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    try:
+                        # Ошибка одной записи не откатывает остальные.
+                        with transaction.atomic(using=self.using):
+                            results.append((future, func(*args, **kwargs)))
+                    except Exception as error:
+                        future.set_exception(error)
+        except Exception as error:
+            for future, _ in results:
+                future.set_exception(error)
+            connections[self.using].close_if_unusable_or_obsolete()
+            return
+        for future, result in results:
+            future.set_result(result)
+
+
+writer = Writer()
+
+
+def write(func, *args, **kwargs):
+    """Выполняет запись через писателя процесса, если очередь включена."""
+    if not write_queue_enabled():
+        return func(*args, **kwargs)
+    return writer.run(func, *args, **kwargs)
@@ -1,15 +1,18 @@
-from django.contrib import admin
+from django.contrib import admin, messages
 
+from core.replicas import ReplicaChangeListMixin
+from . import search
 from .models import Post
 from .models import Group
 from .models import Comment
 from .models import Follow
 
 
-class PostAdmin(admin.ModelAdmin):
+class PostAdmin(ReplicaChangeListMixin, admin.ModelAdmin):
     # Перечисляем поля, которые должны отображаться в админке
     list_display = ('pk', 'text', 'pub_date', 'author', 'group',)
-    # Добавляем интерфейс для поиска по тексту постов
+    # Добавляем интерфейс для поиска по тексту постов (FTS5, см.
+    # get_search_results)
     search_fields = ('text',)
     # Добавляем возможность редактировать поля group в админке
     list_editable = ('group',)
@@ -17,6 +20,26 @@ class PostAdmin(admin.ModelAdmin):
     list_filter = ('pub_date',)
     # Это свойство сработает для всех колонок: где пусто — там будет эта строка
     empty_value_display = '-пусто-'
+    # Сколько лучших по рангу совпадений показывает поиск; об обрезке
+    # список предупреждает
+    search_limit = 1000
+
+    def get_search_results(self, request, queryset, search_term):
+        # LIKE '%...%' из search_fields перебирал бы всю таблицу.
+        # Список читает одну базу: посты других шардов в нём не
+        # показываются, поэтому и ищутся только в ней.
+        ids = search.matching_ids(
+            search_term, self.search_limit, queryset.db)
+        if ids is None:
+            return super().get_search_results(
+                request, queryset, search_term)
+        if len(ids) >= self.search_limit:
+            self.message_user(
+                request,
+                f'Показаны {self.search_limit} лучших совпадений, '
+                'остальные отброшены: уточните запрос.',
+                messages.WARNING)
+        return queryset.filter(pk__in=ids), False
 # При регистрации модели Post источником конфигурации для неё назначаем
 # класс PostAdmin
 
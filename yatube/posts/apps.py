@@ -1,5 +1,17 @@
 from django.apps import AppConfig
+from django.db import connections
+from django.db.models.signals import post_migrate
+
+
+def install_search(sender, using, **kwargs):
+    # Миграции, пересоздающие posts_post, удаляют триггеры поиска.
+    from . import search
+    search.install(connections[using])
 
 
 class PostsConfig(AppConfig):
     name = 'posts'
+
+    def ready(self):
+        from . import holes, signals  # noqa: F401
+        post_migrate.connect(install_search, sender=self)
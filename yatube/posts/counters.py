@@ -0,0 +1,117 @@
+"""Денормализованные счётчики постов, комментариев и подписок.
+
+Счётчики меняются через F() в той же транзакции, что и сама строка:
+save() моделей атомарен вместе с post_save (CountedModel), а удаление,
+в том числе каскадное, Django выполняет в транзакции вместе с
+post_delete. Расхождения после операций в обход сигналов (update,
+bulk_create, правка базы руками) находит и чинит команда recount.
+"""
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from . import sharding
+from .models import AuthorStats, Comment, Follow, Group, Post, User
+
+BATCH_SIZE = 500
+
+
+def _change(model, pk, using=None, **deltas):
+    # Строки AuthorStats может ещё не быть: тогда она будет посчитана
+    # с нуля при первом чтении (author_stats).
+    if pk is not None:
+        model.objects.using(using).filter(pk=pk).update(**{
+            name: F(name) + delta for name, delta in deltas.items()})
+
+
+def post_added(post, delta=1):
+    _change(AuthorStats, post.author_id, posts_count=delta)
+    _change(Group, post.group_id, posts_count=delta)
+
+
+def post_moved(old_group_id, new_group_id):
+    if old_group_id != new_group_id:
+        _change(Group, old_group_id, posts_count=-1)
+        _change(Group, new_group_id, posts_count=1)
+
+
+def comment_added(comment, delta=1):
+    # Пост лежит на том же шарде, что и комментарий.
+    _change(Post, comment.post_id, comment._state.db,
+            comments_count=delta)
+
+
+def follow_added(follow, delta=1):
+    _change(AuthorStats, follow.author_id, followers_count=delta)
+    _change(AuthorStats, follow.user_id, following_count=delta)
+
+
+def _count(model, field):
+    """Подзапрос: число строк model, у которых field = pk внешней строки."""
+    return Coalesce(Subquery(
+        model.objects.filter(**{field: OuterRef('pk')})
+        .order_by().values(field).annotate(total=Count('pk'))
+        .values('total')), 0)
+
+
+def expected_counters():
+    """(queryset, поле счётчика, выражение с настоящим значением)."""
+    return (
+        (AuthorStats.objects.all(), 'posts_count', _count(Post, 'author')),
+        (AuthorStats.objects.all(), 'followers_count',
+         _count(Follow, 'author')),
+        (AuthorStats.objects.all(), 'following_count',
+         _count(Follow, 'user')),
+        (Group.objects.all(), 'posts_count', _count(Post, 'group')),
+        (Post.objects.all(), 'comments_count', _count(Comment, 'post')),
+    )
+
+
+def _author_counts(user_id):
+    return {
+        'posts_count': sharding.author_posts(user_id).count(),
+        'followers_count': Follow.objects.filter(author_id=user_id).count(),
+        'following_count': Follow.objects.filter(user_id=user_id).count(),
+    }
+
+
+def author_stats(user):
+    """Счётчики автора; при первом обращении считаются с нуля."""
+    try:
+        return user.stats
+    except AuthorStats.DoesNotExist:
+        stats, _ = AuthorStats.objects.get_or_create(
+            user=user, defaults=_author_counts(user.pk))
+        user.stats = stats
+        return stats
+
+
+def recount(fix=True):
+    """Ищет и (при fix) чинит расхождения счётчиков.
+
+    Возвращает число пользователей без строки AuthorStats и список
+    (модель, pk, поле, хранимое значение, настоящее значение).
+    """
+    missing = list(User.objects.filter(stats__isnull=True).values_list(
+        'pk', flat=True))
+    if fix:
+        AuthorStats.objects.bulk_create(
+            [AuthorStats(user_id=pk) for pk in missing],
+            batch_size=BATCH_SIZE, ignore_conflicts=True)
+    drift = []
+    for queryset, field, actual in expected_counters():
+        rows = list(
+            queryset.annotate(actual=actual)
+            .exclude(**{field: F('actual')})
+            .values_list('pk', field, 'actual'))
+        drift.extend(
+            (queryset.model.__name__, pk, field, stored, expected)
+            for pk, stored, expected in rows)
+        if not fix:
+            continue
+        pks = [row[0] for row in rows]
+        for start in range(0, len(pks), BATCH_SIZE):
+            # Значение считает сама база в момент UPDATE, поэтому
+            # параллельные изменения не теряются.
+            queryset.filter(pk__in=pks[start:start + BATCH_SIZE]).update(
+                **{field: actual})
+    return len(missing), drift
@@ -0,0 +1,212 @@
+"""Лента «Избранные авторы»: гибрид fan-out on write и on read.
+
+Посты обычных авторов раскладываются по FeedEntry подписчиков при
+публикации. Авторы, у которых подписчиков больше порога
+FEED_FANOUT_THRESHOLD, не раскладываются: их посты подмешиваются при
+чтении k-way merge по потокам каждого такого автора.
+
+Режим автора определяется по AuthorStats.followers_count. При переходе
+через порог (followers_changed) записи лент автора удаляются или
+раскладываются заново, чтобы посты, написанные в другом режиме, не
+пропали и не остались лишними строками.
+"""
+from django.conf import settings
+from django.db import transaction
+
+from . import sharding
+from .models import AuthorStats, FeedEntry, Follow, Post
+from .paginator import MergedCursorPaginator, paginate
+
+BATCH_SIZE = 500
+FANOUT_THRESHOLD = 10000
+
+
+def fanout_threshold():
+    return getattr(settings, 'FEED_FANOUT_THRESHOLD', FANOUT_THRESHOLD)
+
+
+def is_pulled(author_id):
+    """Посты автора читаются «на лету», а не раскладываются."""
+    return AuthorStats.objects.filter(
+        user_id=author_id,
+        followers_count__gt=fanout_threshold()).exists()
+
+
+def pulled_authors(user_id):
+    """Избранные авторы читателя, которые превысили порог fan-out."""
+    # По счётчику, а не COUNT по подписчикам каждого автора.
+    return list(AuthorStats.objects.filter(
+        user_id__in=Follow.objects.filter(user_id=user_id).values(
+            'author_id'),
+        followers_count__gt=fanout_threshold()).values_list(
+            'user_id', flat=True))
+
+
+def page_scopes(user_id):
+    """Области кэша ленты читателя: подписки и посты избранных авторов."""
+    return [f'follower:{user_id}', 'pulled', *(
+        f'feed:{author_id}' for author_id in Follow.objects.filter(
+            user_id=user_id).values_list('author_id', flat=True))]
+
+
+def followers_changed(author_id, delta):
+    """Меняет режим автора, если число подписчиков перешло порог.
+
+    Вызывается после изменения счётчика на delta; True — режим сменился.
+    """
+    followers = AuthorStats.objects.filter(user_id=author_id).values_list(
+        'followers_count', flat=True).first()
+    threshold = fanout_threshold()
+    if delta > 0 and followers == threshold + 1:
+        # Теперь посты подмешиваются при чтении: разложенные не нужны.
+        for user_ids in _follower_batches(author_id):
+            FeedEntry.objects.filter(
+                user_id__in=user_ids, author_id=author_id).delete()
+        return True
+    if delta < 0 and followers == threshold:
+        # Посты, написанные в режиме pull, никому не разложены.
+        for user_ids in _follower_batches(author_id):
+            for user_id in user_ids:
+                _backfill(user_id, author_id)
+        return True
+    return False
+
+
+def _follower_batches(author_id):
+    follower_ids = Follow.objects.filter(
+        author_id=author_id).values_list('user_id', flat=True).iterator()
+    batch = []
+    for user_id in follower_ids:
+        batch.append(user_id)
+        if len(batch) >= BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _bulk_insert(entries):
+    """Пишет FeedEntry пачками, не держа их все в памяти."""
+    batch = []
+    for entry in entries:
+        batch.append(entry)
+        if len(batch) >= BATCH_SIZE:
+            FeedEntry.objects.bulk_create(batch, ignore_conflicts=True)
+            batch = []
+    FeedEntry.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+def push_post(post):
+    """Раскладывает новый пост по лентам подписчиков автора."""
+    if is_pulled(post.author_id):
+        return
+    follower_ids = Follow.objects.filter(
+        author_id=post.author_id).values_list('user_id', flat=True)
+    _bulk_insert(
+        FeedEntry(
+            user_id=user_id,
+            post_id=post.pk,
+            author_id=post.author_id,
+            pub_date=post.pub_date,
+        )
+        for user_id in follower_ids.iterator())
+
+
+def backfill(user_id, author_id):
+    """Добавляет в ленту читателя все посты нового избранного автора."""
+    if is_pulled(author_id):
+        return
+    _backfill(user_id, author_id)
+
+
+def _backfill(user_id, author_id):
+    posts = sharding.author_posts(author_id).values_list(
+        'pk', 'pub_date')
+    _bulk_insert(
+        FeedEntry(
+            user_id=user_id,
+            post_id=post_id,
+            author_id=author_id,
+            pub_date=pub_date,
+        )
+        for post_id, pub_date in posts.iterator())
+
+
+def drop(user_id, author_id):
+    """Убирает из ленты читателя посты автора после отписки."""
+    FeedEntry.objects.filter(user_id=user_id, author_id=author_id).delete()
+
+
+def rebuild(user_id=None):
+    """Пересобирает ленты из Follow и Post; возвращает число подписок."""
+    follows = Follow.objects.exclude(user=None).exclude(author=None)
+    entries = FeedEntry.objects.all()
+    if user_id is not None:
+        follows = follows.filter(user_id=user_id)
+        entries = entries.filter(user_id=user_id)
+    pulled = set(AuthorStats.objects.filter(
+        followers_count__gt=fanout_threshold()).values_list(
+            'user_id', flat=True))
+    pairs = [
+        (follower_id, author_id)
+        for follower_id, author_id
+        in follows.values_list('user_id', 'author_id')
+        if author_id not in pulled]
+    with transaction.atomic():
+        entries.delete()
+        for follower_id, author_id in pairs:
+            _backfill(follower_id, author_id)
+    return len(pairs)
+
+
+def follow_page(request, per_page):
+    """Страница ленты: FeedEntry читателя плюс потоки pull-авторов."""
+    streams = [entry_stream(FeedEntry.objects.filter(user=request.user))]
+    # Поток на каждого pull-автора: author_id IN (...) с ORDER BY и
+    # LIMIT пришлось бы сортировать во временном B-tree целиком, а так
+    # каждый поток — range scan по (author, pub_date) с LIMIT.
+    for author_id in pulled_authors(request.user.pk):
+        streams.append((
+            sharding.author_posts(author_id).for_cards(),
+            'pk',
+        ))
+    return entries_page(request, streams, per_page)
+
+
+def entry_stream(entries):
+    """Поток записей-указателей (FeedEntry, TagEntry, Mention)."""
+    if not sharding.is_sharded():
+        entries = entries.for_cards()
+    return entries, 'post_id'
+
+
+def entries_page(request, streams, per_page):
+    """Страница постов из потоков записей-указателей и самих постов."""
+    page_obj = paginate(
+        request, streams, per_page, paginator_class=MergedCursorPaginator)
+    if not sharding.is_sharded():
+        page_obj.object_list = [
+            row if isinstance(row, Post) else row.post for row in page_obj]
+        return page_obj
+    posts = _entry_posts(page_obj)
+    rows = [
+        row if isinstance(row, Post) else posts.get(row.post_id)
+        for row in page_obj]
+    # Пост мог быть удалён на шарде раньше, чем его записи в лентах.
+    page_obj.object_list = [post for post in rows if post is not None]
+    return page_obj
+
+
+def _entry_posts(page_obj):
+    """Посты записей страницы: по запросу на шард, а не JOIN."""
+    by_shard = {}
+    for row in page_obj:
+        if not isinstance(row, Post):
+            by_shard.setdefault(
+                sharding.shard_for(row.author_id), []).append(row.post_id)
+    posts = {}
+    for alias, post_ids in by_shard.items():
+        posts.update(
+            (post.pk, post) for post in
+            Post.objects.using(alias).filter(pk__in=post_ids).for_cards())
+    return posts
@@ -1,5 +1,7 @@
 from django import forms
+from django.core.files.uploadedfile import UploadedFile
 
+from . import images
 from .models import Post, Comment
 
 
@@ -17,6 +19,14 @@ class PostForm(forms.ModelForm):
         }
         fields = ('text', 'group', 'image')
 
+    def clean_image(self):
+        image = self.cleaned_data['image']
+        # Без новой загрузки здесь уже сохранённый файл поста.
+        if not isinstance(image, UploadedFile):
+            return image
+        images.check(image)
+        return images.downsize(image)
+
 
 class CommentForm(forms.ModelForm):
     class Meta:
@@ -0,0 +1,19 @@
+"""Персональный контекст для фрагментов общих страниц."""
+from core.holes import hole_context
+
+from .forms import CommentForm
+from .models import Follow
+
+
+@hole_context('posts/includes/follow_button.html')
+def follow_button(request, username):
+    following = (
+        request.user.is_authenticated
+        and Follow.objects.filter(
+            user=request.user, author__username=username).exists())
+    return {'following': following}
+
+
+@hole_context('posts/includes/comment_form.html')
+def comment_form(request, post_id):
+    return {'form': CommentForm()}
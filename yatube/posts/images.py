@@ -0,0 +1,82 @@
+"""Проверка и уменьшение загруженных картинок постов.
+
+Загрузки больше FILE_UPLOAD_MAX_MEMORY_SIZE Django пишет на диск
+кусками, а forms.ImageField открывает картинку Pillow лениво: читается
+только заголовок. Поэтому формат, размер файла и число пикселей
+проверяются до декодирования (check), а декодирует картинку только
+downsize() — и только ту, что прошла проверку. JPEG декодируется
+сразу в уменьшенном масштабе (draft), так что память на загрузку
+ограничена MAX_PIXELS при любом размере исходника.
+"""
+import tempfile
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.files import File
+from PIL import Image, ImageOps
+
+MAX_BYTES = 10 * 1024 * 1024
+MAX_PIXELS = 24 * 1000 * 1000
+# Оригиналы больше этой стороны уменьшаются при сохранении.
+MAX_SIDE = 2560
+FORMATS = ('JPEG', 'PNG', 'GIF', 'WEBP')
+JPEG_QUALITY = 90
+
+
+def limit(name, default):
+    return getattr(settings, f'POST_IMAGE_{name}', default)
+
+
+def check(upload):
+    """Проверяет загрузку по заголовку, не декодируя картинку.
+
+    upload.image — картинка, открытая forms.ImageField.
+    """
+    max_bytes = limit('MAX_BYTES', MAX_BYTES)
+    if upload.size > max_bytes:
+        raise ValidationError(
+            'Файл больше %(limit)s МБ.', code='file_too_large',
+            params={'limit': max_bytes // (1024 * 1024)})
+    if upload.image.format not in FORMATS:
+        raise ValidationError(
+            'Поддерживаются картинки JPEG, PNG, GIF и WebP.',
+            code='unsupported_format')
+    width, height = upload.image.size
+    max_pixels = limit('MAX_PIXELS', MAX_PIXELS)
+    if width * height > max_pixels:
+        raise ValidationError(
+            'В картинке больше %(limit)s млн пикселей.',
+            code='too_many_pixels',
+            params={'limit': max_pixels // 1000000})
+
+
+def downsize(upload):
+    """Уменьшает картинку больше MAX_SIDE; иначе возвращает как есть."""
+    max_side = limit('MAX_SIDE', MAX_SIDE)
+    if max(upload.image.size) <= max_side:
+        return upload
+    if getattr(upload.image, 'is_animated', False):
+        # thumbnail() оставил бы от анимации первый кадр.
+        return upload
+    # После verify() картинку нужно открыть заново.
+    if hasattr(upload, 'temporary_file_path'):
+        source = upload.temporary_file_path()
+    else:
+        upload.seek(0)
+        source = upload
+    with Image.open(source) as image:
+        format_ = image.format
+        scale = max_side / max(image.size)
+        target = tuple(max(1, round(side * scale)) for side in image.size)
+        # JPEG сразу декодируется в масштабе 1/2…1/8, не целиком.
+        image.draft('RGB', target)
+        image.thumbnail(target)
+        # save() не пишет EXIF, а с ним и Orientation: снимок с телефона
+        # поворачивается заранее.
+        result = ImageOps.exif_transpose(image)
+        # Результат — во временном файле, а не в памяти.
+        output = tempfile.TemporaryFile()
+        options = {'quality': JPEG_QUALITY} if format_ == 'JPEG' else {}
+        result.save(output, format_, **options)
+    output.seek(0)
+    return File(output, name=upload.name)
@@ -0,0 +1,103 @@
+import random
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import RequestFactory, override_settings
+
+from posts import feed
+from posts.models import FeedEntry, Follow, Post
+
+User = get_user_model()
+
+DISTRIBUTIONS = ('uniform', 'zipf', 'celebrity')
+
+
+class Command(BaseCommand):
+    help = (
+        'Сравнивает push, pull и hybrid ленты «Избранные авторы» на '
+        'синтетических данных. Всё пишется в транзакции и откатывается.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--readers', type=int, default=300)
+        parser.add_argument('--authors', type=int, default=30)
+        parser.add_argument('--follows', type=int, default=10,
+                            help='Подписок у одного читателя')
+        parser.add_argument('--posts', type=int, default=300,
+                            help='Всего постов за прогон')
+        parser.add_argument('--threshold', type=int, default=100,
+                            help='Порог fan-out для hybrid')
+        parser.add_argument('--distributions', default=','.join(
+            DISTRIBUTIONS))
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        strategies = (
+            ('push', 10 ** 9),
+            ('pull', 0),
+            ('hybrid', options['threshold']),
+        )
+        self.stdout.write(
+            f'{"distribution":<12} {"strategy":<8} {"write ms/post":>14} '
+            f'{"read ms/page":>13} {"feed rows":>10}')
+        for distribution in options['distributions'].split(','):
+            for name, threshold in strategies:
+                with override_settings(FEED_FANOUT_THRESHOLD=threshold):
+                    write_ms, read_ms, rows = self.run(
+                        distribution, options)
+                self.stdout.write(
+                    f'{distribution:<12} {name:<8} {write_ms:>14.2f} '
+                    f'{read_ms:>13.2f} {rows:>10}')
+
+    def run(self, distribution, options):
+        rnd = random.Random(options['seed'])
+        with transaction.atomic():
+            readers, authors = self.make_users(options)
+            self.make_follows(rnd, distribution, readers, authors, options)
+            started = time.perf_counter()
+            for _ in range(options['posts']):
+                Post.objects.create(author=rnd.choice(authors), text='bench')
+            write_ms = (
+                (time.perf_counter() - started) * 1000 / options['posts'])
+            rows = FeedEntry.objects.count()
+            factory = RequestFactory()
+            sample = rnd.sample(readers, min(50, len(readers)))
+            started = time.perf_counter()
+            for reader in sample:
+                request = factory.get('/follow/')
+                request.user = reader
+                list(feed.follow_page(request, 10))
+            read_ms = (time.perf_counter() - started) * 1000 / len(sample)
+            transaction.set_rollback(True)
+        return write_ms, read_ms, rows
+
+    def make_users(self, options):
+        User.objects.bulk_create(
+            [User(username=f'bench_reader_{i}')
+             for i in range(options['readers'])]
+            + [User(username=f'bench_author_{i}')
+               for i in range(options['authors'])])
+        users = User.objects.filter(username__startswith='bench_')
+        readers = list(users.filter(username__startswith='bench_reader_'))
+        authors = list(users.filter(username__startswith='bench_author_'))
+        return readers, authors
+
+    def make_follows(self, rnd, distribution, readers, authors, options):
+        if distribution == 'zipf':
+            weights = [1 / rank for rank in range(1, len(authors) + 1)]
+        else:
+            weights = [1] * len(authors)
+        per_reader = min(options['follows'], len(authors))
+        follows = []
+        for reader in readers:
+            followed = set()
+            if distribution == 'celebrity':
+                followed.add(authors[0].pk)
+            while len(followed) < per_reader:
+                followed.add(rnd.choices(authors, weights)[0].pk)
+            follows.extend(
+                Follow(user_id=reader.pk, author_id=author_id)
+                for author_id in followed)
+        Follow.objects.bulk_create(follows)
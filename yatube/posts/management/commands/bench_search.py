@@ -0,0 +1,89 @@
+import random
+import time
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from posts import search
+from posts.models import Post
+
+User = get_user_model()
+
+WORDS = (
+    'город река утро вечер поезд книга музыка море лес дорога окно '
+    'кофе снег дождь солнце ветер письмо друг работа отпуск кошка '
+    'собака сад дом театр кино звезда мост площадь рынок'
+).split()
+# Встречается в одном посте из RARE_EVERY: LIKE с ORDER BY pub_date
+# находит частые слова сразу, а редкие — только пройдя всю таблицу.
+RARE = 'маяк'
+RARE_EVERY = 1000
+
+
+class Command(BaseCommand):
+    help = (
+        'Сравнивает задержку поиска по постам: FTS5 (posts.search) и '
+        "LIKE '%...%' по всей таблице. Данные пишутся в транзакции и "
+        'откатываются.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--posts', type=int, default=100000)
+        parser.add_argument('--queries', type=int, default=200)
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        rnd = random.Random(options['seed'])
+        with transaction.atomic():
+            self.seed(rnd, options['posts'])
+            common = [
+                ' '.join(rnd.sample(WORDS, rnd.choice((1, 2))))
+                for _ in range(options['queries'])]
+            rare = [f'{RARE} {word}' for word in common]
+            self.stdout.write(
+                f'{"words":<8} {"method":<6} {"p50 ms":>8} {"p99 ms":>8}')
+            for kind, queries in (('common', common), ('rare', rare)):
+                for name, run in (('fts5', self.fts), ('like', self.like)):
+                    p50, p99 = self.measure(run, queries)
+                    self.stdout.write(
+                        f'{kind:<8} {name:<6} {p50:>8.2f} {p99:>8.2f}')
+            transaction.set_rollback(True)
+
+    def seed(self, rnd, count):
+        author = User.objects.create(username='bench_search_author')
+        batch = []
+        for index in range(count):
+            words = [rnd.choice(WORDS) for _ in range(rnd.randint(5, 30))]
+            if index % RARE_EVERY == 0:
+                words.append(RARE)
+            batch.append(Post(author=author, text=' '.join(words)))
+            if len(batch) >= 1000:
+                Post.objects.bulk_create(batch)
+                batch = []
+        Post.objects.bulk_create(batch)
+
+    def fts(self, query):
+        # Первая страница и следующая за ней, как в представлении.
+        paginator = search.SearchPaginator(query, 10)
+        list(paginator.get_page())
+        if paginator.next_cursor:
+            list(search.SearchPaginator(query, 10).get_page(
+                paginator.next_cursor))
+
+    def like(self, query):
+        posts = Post.objects.all()
+        for word in query.split():
+            posts = posts.filter(text__icontains=word)
+        list(posts.for_cards()[:10])
+        list(posts.for_cards()[10:20])
+
+    def measure(self, run, queries):
+        latencies = []
+        for query in queries:
+            started = time.perf_counter()
+            run(query)
+            latencies.append((time.perf_counter() - started) * 1000)
+        latencies.sort()
+        return (latencies[len(latencies) // 2],
+                latencies[int(len(latencies) * 0.99)])
@@ -0,0 +1,35 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from posts import media_gc
+
+
+class Command(BaseCommand):
+    help = (
+        'Удаляет картинки постов и миниатюры sorl, на которые никто не '
+        'ссылается, и устаревшие записи kvstore sorl (posts.media_gc).'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Только показать, что было бы удалено')
+        parser.add_argument(
+            '--rate', type=float, default=50,
+            help='Не больше стольких удалений в секунду, 0 — без предела')
+        parser.add_argument(
+            '--min-age', type=float,
+            default=media_gc.MIN_AGE.total_seconds() / 3600,
+            help='Не трогать файлы моложе стольких часов')
+
+    def handle(self, *args, **options):
+        collector = media_gc.Collector(
+            dry_run=options['dry_run'], rate=options['rate'],
+            min_age=timedelta(hours=options['min_age']),
+            log=self.stdout.write if options['verbosity'] > 1 else None)
+        stats = collector.run()
+        verb = 'найдено' if options['dry_run'] else 'удалено'
+        self.stdout.write(self.style.SUCCESS(
+            f'Файлов {verb}: {stats["files"]}, '
+            f'записей kvstore: {stats["entries"]}'))
@@ -0,0 +1,71 @@
+from itertools import islice
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from sorl.thumbnail import default
+from sorl.thumbnail.conf import settings as sorl_settings
+from sorl.thumbnail.images import ImageFile
+from sorl.thumbnail.parsers import parse_geometry
+
+from core.storage import walk
+from posts import renditions
+
+
+class Command(BaseCommand):
+    help = (
+        'Сравнивает размер миниатюр карточки: прежней (одна 1980x1024 '
+        'с увеличением) и нынешних ширин и форматов (posts.renditions) '
+        'для картинок в media/posts. Миниатюры считаются в памяти и '
+        'никуда не пишутся.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--path', default='posts')
+        parser.add_argument('--limit', type=int, default=None)
+
+    def handle(self, *args, **options):
+        geometry, legacy = renditions.LEGACY
+        outputs = [('legacy', geometry, legacy)] + [
+            (f'{width}w {format_.lower()}', geometry, variant)
+            for width, format_, geometry, variant in renditions.variants()]
+        totals = {label: 0 for label, _, _ in outputs}
+        images = originals = skipped = 0
+        # Картинки лежат и в подпапках по хешу (core.storage).
+        for path in islice(
+                walk(default_storage, options['path']), options['limit']):
+            source = ImageFile(path, default_storage)
+            try:
+                image = default.engine.get_image(source)
+            except Exception:
+                skipped += 1
+                continue
+            images += 1
+            originals += default_storage.size(path)
+            image_info = default.engine.get_image_info(image)
+            for label, geometry, variant in outputs:
+                totals[label] += self.encoded_size(
+                    image, image_info, geometry,
+                    renditions.sorl_options(source, variant))
+        self.stdout.write(
+            f'images: {images}, unreadable: {skipped}, '
+            f'originals: {originals} bytes')
+        if not images:
+            return
+        self.stdout.write(
+            f'{"output":<12} {"bytes":>12} {"per image":>10} '
+            f'{"vs legacy":>9}')
+        for label, total in totals.items():
+            self.stdout.write(
+                f'{label:<12} {total:>12} {total // images:>10} '
+                f'{total / totals["legacy"]:>9.0%}')
+
+    def encoded_size(self, image, image_info, geometry, options):
+        engine = default.engine
+        geometry = parse_geometry(
+            geometry, engine.get_image_ratio(image, options))
+        thumbnail = engine.create(image, geometry, options)
+        return len(engine._get_raw_data(
+            thumbnail, options['format'], options['quality'],
+            image_info=image_info,
+            progressive=options.get(
+                'progressive', sorl_settings.THUMBNAIL_PROGRESSIVE)))
@@ -0,0 +1,64 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core.models import Checkpoint
+from posts import sharding, tags
+from posts.models import Post
+
+BATCH_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = (
+        'Разбирает хештеги и упоминания уже написанных постов в индекс '
+        '(posts.tags). Идёт пачками по id и запоминает позицию, поэтому '
+        'прерванный запуск продолжается с места остановки.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+        parser.add_argument(
+            '--pause', type=float, default=0,
+            help='Пауза между пачками, секунды: меньше мешает записи')
+        parser.add_argument(
+            '--restart', action='store_true',
+            help='Начать с первого поста, забыв сохранённую позицию')
+
+    def handle(self, *args, **options):
+        for alias in sharding.shards():
+            checkpoint, _ = Checkpoint.objects.get_or_create(
+                name=f'index_tags:{alias}')
+            if options['restart']:
+                checkpoint.position = 0
+                checkpoint.save()
+            if checkpoint.position:
+                self.stdout.write(
+                    f'{alias}: продолжаем после поста #{checkpoint.position}')
+            self.index(alias, checkpoint, options)
+
+    def index(self, alias, checkpoint, options):
+        posts = Post.objects.using(alias).order_by('pk').only(
+            'pk', 'text', 'author_id', 'pub_date')
+        total_tags = total_mentions = 0
+        while True:
+            batch = list(posts.filter(
+                pk__gt=checkpoint.position)[:options['batch_size']])
+            if not batch:
+                break
+            # Пачка и позиция сохраняются вместе: повтор пачки после
+            # сбоя безопасен, но пропуска не будет.
+            with transaction.atomic():
+                tag_count, mention_count = tags.index_batch(batch)
+                checkpoint.position = batch[-1].pk
+                checkpoint.save()
+            total_tags += tag_count
+            total_mentions += mention_count
+            self.stdout.write(
+                f'{alias}: до поста #{checkpoint.position}, тегов '
+                f'{total_tags}, упоминаний {total_mentions}')
+            time.sleep(options['pause'])
+        self.stdout.write(self.style.SUCCESS(
+            f'{alias}: готово, тегов {total_tags}, '
+            f'упоминаний {total_mentions}'))
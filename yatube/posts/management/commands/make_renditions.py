@@ -0,0 +1,40 @@
+from django.core.management.base import BaseCommand
+
+from posts import renditions, sharding
+from posts.models import Post
+
+BATCH_SIZE = 100
+
+
+class Command(BaseCommand):
+    help = (
+        'Делает миниатюры картинок постов (posts.renditions), которых '
+        'ещё нет: для старых постов и тех, что не успел фоновый поток.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all', action='store_true',
+            help='Переделать миниатюры всех постов, например после '
+                 'изменения ширин или форматов')
+
+    def handle(self, *args, **options):
+        for alias in sharding.shards():
+            posts = Post.objects.using(alias).exclude(image='')
+            if not options['all']:
+                posts = posts.filter(renditions='')
+            done = failed = last_pk = 0
+            while True:
+                post_ids = list(posts.filter(pk__gt=last_pk).order_by(
+                    'pk').values_list('pk', flat=True)[:BATCH_SIZE])
+                if not post_ids:
+                    break
+                for post_id in post_ids:
+                    if renditions.render(post_id, alias):
+                        done += 1
+                    else:
+                        failed += 1
+                last_pk = post_ids[-1]
+            self.stdout.write(self.style.SUCCESS(
+                f'{alias}: миниатюр сделано для постов: {done}, '
+                f'не удалось: {failed}'))
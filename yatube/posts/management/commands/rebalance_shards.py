@@ -0,0 +1,178 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from core.cache import bump
+from posts import sharding
+from posts.models import AuthorShard, Comment, Post, User
+
+# Сколько ждать после закрытия записи: запросы, начатые до этого, ещё
+# могут писать на прежний шард автора.
+GRACE = 15
+# Сколько авторов переносится за одно закрытие записи.
+MOVE_BATCH_SIZE = 50
+
+
+def chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class Command(BaseCommand):
+    help = (
+        'Переносит посты и комментарии авторов между шардами '
+        '(posts.sharding). Без --author переносит всех незакреплённых '
+        'авторов на их шард по хешу, например после добавления алиаса '
+        'в POST_SHARDS; с --author и --to закрепляет автора за шардом. '
+        'На время переноса запись постов автора закрыта.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--author', help='Имя автора')
+        parser.add_argument(
+            '--to', help='Алиас, за которым закрепить автора')
+        parser.add_argument('--grace', type=float, default=GRACE)
+        parser.add_argument(
+            '--batch-size', type=int, default=MOVE_BATCH_SIZE,
+            help='Сколько авторов переносить за одно ожидание --grace')
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Только показать, кого и куда нужно перенести')
+
+    def handle(self, *args, **options):
+        aliases = sharding.shards()
+        if options['to'] and not options['author']:
+            raise CommandError('--to задаётся вместе с --author')
+        if options['to'] and options['to'] not in aliases:
+            raise CommandError(f'{options["to"]} нет в POST_SHARDS')
+        # Записывает, где посты лежат сейчас; ничего не переносит.
+        sharding.backfill_directory()
+        author = None
+        if options['author']:
+            author = User.objects.filter(username=options['author']).first()
+            if author is None:
+                raise CommandError(f'Нет автора {options["author"]}')
+            target = options['to'] or sharding.hashed_shard(
+                author.pk, aliases)
+            moves = self.plan_author(aliases, author.pk, target)
+        else:
+            moves = self.plan(aliases)
+        pinned = bool(options['to'])
+        for author_id, source, destination in moves:
+            self.stdout.write(
+                f'Автор #{author_id}: {source} -> {destination}')
+        if not options['dry_run']:
+            for batch in chunks(moves, options['batch_size']):
+                self.move(batch, pinned, options['grace'])
+        if author is not None and not options['dry_run']:
+            AuthorShard.objects.update_or_create(
+                user=author, defaults={'alias': target, 'pinned': pinned})
+            sharding.forget_shard(author.pk)
+        verb = 'к переносу' if options['dry_run'] else 'перенесено'
+        self.stdout.write(self.style.SUCCESS(
+            f'Переносов {verb}: {len(moves)}'))
+
+    def plan_author(self, aliases, author_id, target):
+        current = sharding.current_shards([author_id])[author_id]
+        moves = [(author_id, current, target)] if current != target else []
+        # Остатки прерванных переносов на остальных шардах.
+        moves.extend(
+            (author_id, alias, target) for alias in aliases
+            if alias not in (current, target)
+            and Post.objects.using(alias).filter(
+                author_id=author_id).exists())
+        return moves
+
+    def plan(self, aliases):
+        moves = [
+            (author_id, alias, sharding.hashed_shard(author_id, aliases))
+            for author_id, alias in AuthorShard.objects.filter(
+                pinned=False).values_list('user_id', 'alias')
+            if alias != sharding.hashed_shard(author_id, aliases)]
+        # Остатки прерванных переносов: посты не на шарде автора.
+        for alias in aliases:
+            author_ids = list(Post.objects.using(alias).order_by(
+            ).values_list('author_id', flat=True).distinct())
+            for chunk in chunks(author_ids, sharding.BATCH_SIZE):
+                current = sharding.current_shards(chunk)
+                moves.extend(
+                    (author_id, alias, current[author_id])
+                    for author_id in chunk if current[author_id] != alias)
+        return moves
+
+    def move(self, moves, pinned, grace):
+        """Копирует данные авторов пачки на новые шарды, затем удаляет
+        со старых.
+
+        Запись авторов закрыта от начала копирования до переключения
+        шарда, поэтому на старом шарде после копии ничего не появится.
+        """
+        current = sharding.current_shards(
+            list({author_id for author_id, _, _ in moves}))
+        # Иначе source уже не основной шард автора: копировать нечего.
+        switches = [
+            move for move in moves if current[move[0]] == move[1]]
+        author_ids = [author_id for author_id, _, _ in switches]
+        if switches:
+            AuthorShard.objects.bulk_create(
+                [AuthorShard(user_id=author_id, alias=source)
+                 for author_id, source, _ in switches],
+                ignore_conflicts=True)
+            AuthorShard.objects.filter(user_id__in=author_ids).update(
+                moving=True)
+            # Одно ожидание на пачку: запросы, проверившие запись до
+            # закрытия, успевают закоммитить.
+            time.sleep(grace)
+        try:
+            for author_id, source, target in switches:
+                with transaction.atomic(using=target):
+                    # Остатки прерванного переноса: копия не успела стать
+                    # основной, и её можно выбросить.
+                    self.delete(target, author_id)
+                    self.copy(author_id, source, target)
+                AuthorShard.objects.filter(user_id=author_id).update(
+                    alias=target, pinned=pinned, moving=False)
+                sharding.forget_shard(author_id)
+        finally:
+            AuthorShard.objects.filter(user_id__in=author_ids).update(
+                moving=False)
+        for author_id, source, _ in moves:
+            with transaction.atomic(using=source):
+                self.delete(source, author_id)
+        bump(*(f'author:{username}' for username in User.objects.filter(
+            pk__in=[author_id for author_id, _, _ in moves]).values_list(
+                'username', flat=True)))
+
+    def copy(self, author_id, source, target):
+        posts = Post.objects.using(source).filter(author_id=author_id)
+        self.bulk_copy(target, posts.iterator(), keep_pk=True)
+        comments = Comment.objects.using(source).filter(
+            post__author_id=author_id)
+        # У комментариев id свои на каждом шарде.
+        self.bulk_copy(target, comments.iterator(), keep_pk=False)
+
+    def bulk_copy(self, alias, rows, keep_pk):
+        batch = []
+        for row in rows:
+            if not keep_pk:
+                row.pk = None
+            batch.append(row)
+            if len(batch) >= sharding.BATCH_SIZE:
+                type(row).objects.using(alias).bulk_create(batch)
+                batch = []
+        if batch:
+            type(batch[0]).objects.using(alias).bulk_create(batch)
+
+    def delete(self, alias, author_id):
+        # Сырой DELETE: сигналы удаления уменьшили бы счётчики и убрали
+        # бы посты из лент, а пост всего лишь переезжает.
+        post_table = Post._meta.db_table
+        with connections[alias].cursor() as cursor:
+            cursor.execute(
+                f'DELETE FROM {Comment._meta.db_table} WHERE post_id IN '
+                f'(SELECT id FROM {post_table} WHERE author_id = %s)',
+                [author_id])
+            cursor.execute(
+                f'DELETE FROM {post_table} WHERE author_id = %s',
+                [author_id])
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from posts import feed
+
+
+class Command(BaseCommand):
+    help = 'Пересобирает ленты «Избранные авторы» из Follow и Post'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user-id', type=int, default=None,
+            help='Пересобрать ленту только одного читателя')
+
+    def handle(self, *args, **options):
+        follows = feed.rebuild(user_id=options['user_id'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Ленты пересобраны, подписок обработано: {follows}'))
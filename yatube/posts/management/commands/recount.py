@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from core.cache import bump
+from posts import counters, sharding
+from posts.models import User
+
+
+class Command(BaseCommand):
+    help = (
+        'Сверяет денормализованные счётчики с данными и чинит '
+        'расхождения'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Только показать расхождения, ничего не менять')
+
+    def handle(self, *args, **options):
+        if sharding.is_sharded():
+            # Подзапросы сверки соединяют таблицы одной базы.
+            raise CommandError(
+                'Сверка счётчиков пока не поддерживает шардирование')
+        fix = not options['dry_run']
+        missing, drift = counters.recount(fix=fix)
+        for model, pk, field, stored, expected in drift:
+            self.stdout.write(
+                f'{model} #{pk}: {field} = {stored}, должно быть {expected}')
+        if fix:
+            self.invalidate(drift)
+        verb = 'исправлено' if fix else 'найдено'
+        self.stdout.write(self.style.SUCCESS(
+            f'Расхождений {verb}: {len(drift)}, '
+            f'пользователей без счётчиков: {missing}'))
+
+    def invalidate(self, drift):
+        # Счётчики видны на закэшированных страницах постов и авторов.
+        post_ids = {pk for model, pk, *_ in drift if model == 'Post'}
+        author_ids = {pk for model, pk, *_ in drift if model == 'AuthorStats'}
+        usernames = User.objects.filter(pk__in=author_ids).values_list(
+            'username', flat=True)
+        bump(*[f'post:{pk}' for pk in post_ids],
+             *[f'author:{username}' for username in usernames])
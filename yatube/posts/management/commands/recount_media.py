@@ -0,0 +1,77 @@
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+from core.models import StoredFile
+from posts import sharding
+from posts.media_gc import chunked
+from posts.models import Post
+
+BATCH_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = (
+        'Сверяет число ссылок на картинки постов (core.storage) с '
+        'постами на всех шардах и чинит расхождения.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Только показать расхождения, ничего не менять')
+
+    def handle(self, *args, **options):
+        self.dry_run = options['dry_run']
+        expected = self.expected()
+        drifted = 0
+        last_name = ''
+        while True:
+            # Строки StoredFile — пачками по ключу, а не все сразу.
+            stored = list(StoredFile.objects.filter(
+                name__gt=last_name).order_by('name').values_list(
+                    'name', 'references')[:BATCH_SIZE])
+            if not stored:
+                break
+            drifted += self.fix({
+                name: (references, expected.pop(name, 0))
+                for name, references in stored})
+            last_name = stored[-1][0]
+        # Файлы с постами, у которых нет строки StoredFile.
+        for names in chunked(sorted(expected), BATCH_SIZE):
+            drifted += self.fix(
+                {name: (None, expected[name]) for name in names})
+        verb = 'найдено' if self.dry_run else 'исправлено'
+        self.stdout.write(self.style.SUCCESS(
+            f'Расхождений {verb}: {drifted}'))
+
+    def expected(self):
+        """{имя: число постов с этой картинкой на всех шардах}."""
+        storage = Post._meta.get_field('image').storage
+        expected = Counter()
+        for alias in sharding.shards():
+            posts = Post.objects.using(alias).exclude(image='')
+            rows = posts.order_by().values_list('image').annotate(
+                total=Count('pk'))
+            for name, total in rows.iterator():
+                if storage.is_hashed(name):
+                    expected[name] += total
+        return expected
+
+    def fix(self, counts):
+        """counts — {имя: (ссылок в StoredFile, должно быть)}."""
+        drift = {
+            name: references for name, (stored, references) in counts.items()
+            if stored != references}
+        for name, references in drift.items():
+            self.stdout.write(
+                f'{name}: ссылок {counts[name][0]}, должно быть '
+                f'{references}')
+        if not self.dry_run:
+            with transaction.atomic():
+                for name, references in drift.items():
+                    StoredFile.objects.update_or_create(
+                        name=name, defaults={'references': references})
+        return len(drift)
@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from posts import renditions
+
+BATCH_SIZE = 20
+
+
+class Command(BaseCommand):
+    help = (
+        'Делает миниатюры картинок постов из очереди RenditionJob '
+        '(posts.renditions). Работает, пока его не остановят.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--pause', type=float, default=1,
+            help='Пауза при пустой очереди, секунды')
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Выполнить задания, которые уже в очереди, и выйти')
+
+    def handle(self, *args, **options):
+        done = 0
+        while True:
+            count = renditions.run_jobs(BATCH_SIZE)
+            done += count
+            close_old_connections()
+            if count:
+                continue
+            if options['once']:
+                break
+            time.sleep(options['pause'])
+        self.stdout.write(self.style.SUCCESS(
+            f'миниатюры сделаны по заданиям: {done}'))
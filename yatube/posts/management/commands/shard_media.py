@@ -0,0 +1,135 @@
+import os
+import time
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from core import storage
+from core.cache import bump
+from core.models import Checkpoint
+from posts import renditions, sharding
+from posts.media_gc import referenced
+from posts.models import Post
+
+BATCH_SIZE = 100
+
+
+class Command(BaseCommand):
+    help = (
+        'Переносит картинки постов из общей папки posts/ в подпапки по '
+        'хешу содержимого (core.storage) и переписывает Post.image. Идёт '
+        'пачками по id и запоминает позицию, поэтому прерванный запуск '
+        'продолжается с места остановки.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+        parser.add_argument(
+            '--pause', type=float, default=0,
+            help='Пауза между пачками, секунды: меньше нагружает диск')
+        parser.add_argument(
+            '--restart', action='store_true',
+            help='Начать с первого поста, забыв сохранённую позицию')
+
+    def handle(self, *args, **options):
+        field = Post._meta.get_field('image')
+        self.storage = field.storage
+        self.upload_to = field.upload_to
+        for alias in sharding.shards():
+            checkpoint, _ = Checkpoint.objects.get_or_create(
+                name=f'shard_media:{alias}')
+            if options['restart']:
+                checkpoint.position = 0
+                checkpoint.save()
+            if checkpoint.position:
+                self.stdout.write(
+                    f'{alias}: продолжаем после поста #{checkpoint.position}')
+            self.migrate(alias, checkpoint, options)
+
+    def target(self, name):
+        """Имя файла в новой раскладке; копирует файл, если его там нет."""
+        upload_name = os.path.join(self.upload_to, os.path.basename(name))
+        if self.storage.is_hashed(name):
+            digest = os.path.splitext(os.path.basename(name))[0]
+            if name == self.storage.hashed_name(upload_name, digest):
+                return name
+        with self.storage.open(name) as content:
+            # save() хеширует содержимое и не копирует уже лежащий файл.
+            return self.storage.save(upload_name, content)
+
+    def migrate(self, alias, checkpoint, options):
+        posts = sharding.with_related(
+            Post.objects.using(alias).exclude(image='').order_by('pk').only(
+                'pk', 'image', 'author_id', 'group_id'),
+            'author', 'group')
+        totals = Counter()
+        while True:
+            batch = list(posts.filter(
+                pk__gt=checkpoint.position)[:options['batch_size']])
+            if not batch:
+                break
+            moves = self.copy(batch, totals)
+            self.rewrite(alias, batch, moves, checkpoint)
+            totals['moved'] += len(moves)
+            self.stdout.write(
+                f'{alias}: до поста #{checkpoint.position}, перенесено '
+                f'{totals["moved"]}, нет файла {totals["missing"]}')
+            time.sleep(options['pause'])
+        self.stdout.write(self.style.SUCCESS(
+            f'{alias}: готово, перенесено {totals["moved"]}, '
+            f'нет файла {totals["missing"]}'))
+
+    def copy(self, batch, totals):
+        """{пост: (старое имя, новое)} для постов пачки, которые надо
+        перенести. Файлы копируются до транзакции: повтор безопасен."""
+        moves = {}
+        for post in batch:
+            name = post.image.name
+            if not self.storage.exists(name):
+                totals['missing'] += 1
+                self.stderr.write(f'Пост #{post.pk}: нет файла {name}')
+                continue
+            new_name = self.target(name)
+            if new_name != name:
+                moves[post] = (name, new_name)
+        return moves
+
+    def rewrite(self, alias, batch, moves, checkpoint):
+        # Посты — на шарде, счётчики ссылок и позиция — в основной базе.
+        with transaction.atomic(), transaction.atomic(using=alias):
+            for post, (name, new_name) in moves.items():
+                # Картинку могли заменить, пока копировали файлы.
+                if not Post.objects.using(alias).filter(
+                        pk=post.pk, image=name).update(image=new_name):
+                    continue
+                # Миниатюры те же: Post.renditions не сбрасывается.
+                renditions.move_thumbnails(name, new_name, self.storage)
+                storage.add_reference(new_name)
+                if self.storage.is_hashed(name):
+                    storage.drop_reference(
+                        name, self.storage, using=DEFAULT_DB_ALIAS,
+                        thumbnails=False)
+                else:
+                    transaction.on_commit(
+                        lambda name=name: self.delete_legacy(name),
+                        using=alias)
+            checkpoint.position = batch[-1].pk
+            checkpoint.save()
+            if moves:
+                # Пока миниатюр нет, страницы ссылаются на сам файл.
+                bump('posts', *self.scopes(moves))
+
+    def delete_legacy(self, name):
+        # Прежнее имя могли скопировать в другой пост, в том числе на
+        # другом шарде: файл удаляет перенос последнего из них.
+        if name not in referenced([name]):
+            self.storage.delete(name)
+
+    def scopes(self, posts):
+        scopes = set()
+        for post in posts:
+            scopes |= {f'post:{post.pk}', f'author:{post.author.username}'}
+            if post.group_id:
+                scopes.add(f'group:{post.group.slug}')
+        return scopes
@@ -0,0 +1,279 @@
+"""Сборка мусора в медиа: картинки и миниатюры, на которые никто не
+ссылается.
+
+Живые файлы:
+- исходник в posts/ — если на его имя ссылается пост на любом шарде;
+- миниатюра sorl в cache/ — если у неё есть запись в kvstore.
+Записи kvstore исходников, на которые не ссылается ни один пост,
+удаляются вместе с их миниатюрами: Post.renditions ссылается только на
+миниатюры текущей картинки поста (shard_media переносит их список на
+новое имя). Если у всех постов картинки есть renditions, миниатюры,
+которых в них нет (например, прежняя увеличенная LEGACY), — тоже
+мусор; без renditions карточку собирает prefetch() из любых миниатюр.
+
+Хранилище читается по одной папке (core.storage.walk), kvstore и
+посты — пачками по CHUNK_SIZE, так что память не растёт с числом
+файлов. Файлы моложе min_age не трогаются: пост или запись kvstore
+для них могли ещё не закоммитить. Исходник с хешевым именем удаляется,
+как в core.storage.delete_unreferenced, в одной транзакции со строкой
+StoredFile: повторная загрузка того же файла (core.storage.reserve)
+не меняет его время изменения до проверки, но ждёт эту транзакцию.
+"""
+import json
+import time
+from collections import Counter
+from datetime import timedelta
+from itertools import islice
+
+from django.db import transaction
+from django.utils import timezone
+from sorl.thumbnail import default
+from sorl.thumbnail.conf import settings as sorl_settings
+from sorl.thumbnail.images import ImageFile, deserialize_image_file
+from sorl.thumbnail.kvstores.base import add_prefix, del_prefix
+from sorl.thumbnail.models import KVStore
+
+from core.models import StoredFile
+from core.storage import walk
+
+from . import sharding
+from .models import Post
+
+CHUNK_SIZE = 500
+MIN_AGE = timedelta(days=1)
+
+
+def chunked(iterable, size=CHUNK_SIZE):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def kvstore_rows(identity):
+    """Пачки (ключ, значение) kvstore sorl: keyset по ключу."""
+    prefix = last = add_prefix('', identity)
+    while True:
+        rows = list(KVStore.objects.filter(
+            key__startswith=prefix, key__gt=last).order_by(
+                'key').values_list('key', 'value')[:CHUNK_SIZE])
+        if not rows:
+            return
+        yield rows
+        last = rows[-1][0]
+
+
+def existing_keys(keys):
+    return set(KVStore.objects.filter(key__in=keys).values_list(
+        'key', flat=True))
+
+
+def referenced(names):
+    """Имена из names, на которые ссылаются посты."""
+    # Счётчик мог отстать, но живым файл он не объявит напрасно.
+    found = set(StoredFile.objects.filter(
+        name__in=names, references__gt=0).values_list('name', flat=True))
+    for alias in sharding.shards():
+        rest = [name for name in names if name not in found]
+        if not rest:
+            break
+        found.update(Post.objects.using(alias).filter(
+            image__in=rest).values_list('image', flat=True))
+    return found
+
+
+def rendition_urls(value):
+    """Адреса миниатюр в Post.renditions."""
+    card = json.loads(value).get('card') or {}
+    urls = {card['url']} if card.get('url') else set()
+    for srcset in card.get('srcset', {}).values():
+        urls.update(
+            candidate.split()[0] for candidate in srcset.split(',')
+            if candidate.strip())
+    return urls
+
+
+def used_thumbnails(names):
+    """{имя: адреса миниатюр из renditions всех его постов}.
+
+    Только для имён, у всех постов которых renditions есть.
+    """
+    used = {}
+    partial = set()
+    for alias in sharding.shards():
+        rows = Post.objects.using(alias).filter(
+            image__in=names).values_list('image', 'renditions')
+        for name, value in rows:
+            urls = rendition_urls(value) if value else set()
+            if not urls:
+                partial.add(name)
+            used.setdefault(name, set()).update(urls)
+    return {
+        name: urls for name, urls in used.items() if name not in partial}
+
+
+class Collector:
+    """Удаляет мусор; dry_run — только считает.
+
+    rate — не больше стольких удалений (файлов и записей kvstore) в
+    секунду, 0 — без ограничения.
+    """
+
+    def __init__(self, dry_run=False, rate=0, min_age=MIN_AGE, log=None):
+        self.dry_run = dry_run
+        self.rate = rate
+        self.min_age = min_age
+        self.log = log or (lambda message: None)
+        self.stats = Counter()
+        field = Post._meta.get_field('image')
+        self.storage = field.storage
+        self.upload_to = field.upload_to
+
+    def run(self):
+        self.prune_sources()
+        self.prune_thumbnail_lists()
+        self.prune_thumbnail_entries()
+        self.sweep_originals()
+        self.sweep_thumbnails()
+        return self.stats
+
+    def throttle(self):
+        if self.rate:
+            time.sleep(1 / self.rate)
+
+    def remove_keys(self, keys):
+        self.stats['entries'] += len(keys)
+        if not keys or self.dry_run:
+            return
+        # Через kvstore: ключи удаляются и из его кэша.
+        default.kvstore._delete_raw(*keys)
+        for _ in keys:
+            self.throttle()
+
+    def remove_file(self, storage, name):
+        self.stats['files'] += 1
+        self.log(name)
+        if self.dry_run:
+            return
+        storage.delete(name)
+        self.throttle()
+
+    def is_old(self, storage, name):
+        return storage.get_modified_time(name) < timezone.now() - self.min_age
+
+    def prune_sources(self):
+        """Записи исходников без постов — вместе с их миниатюрами."""
+        for rows in kvstore_rows('image'):
+            # Одно имя бывает под разными хранилищами: до core.storage
+            # картинки лежали в хранилище по умолчанию.
+            sources = [
+                image for image in map(
+                    deserialize_image_file, dict(rows).values())
+                if image.name.startswith(self.upload_to)]
+            alive = referenced([source.name for source in sources])
+            used = used_thumbnails(list(alive))
+            for source in sources:
+                if source.name not in alive:
+                    self.remove_source(source)
+                elif source.name in used:
+                    self.remove_unused_thumbnails(source, used[source.name])
+
+    def remove_source(self, source):
+        thumbnail_keys = [
+            add_prefix(key) for key in default.kvstore._get(
+                source.key, identity='thumbnails') or []]
+        rows = KVStore.objects.filter(
+            key__in=thumbnail_keys).values_list('value', flat=True)
+        for value in rows:
+            thumbnail = deserialize_image_file(value)
+            if thumbnail.exists():
+                self.remove_file(thumbnail.storage, thumbnail.name)
+        self.remove_keys(thumbnail_keys + [
+            add_prefix(source.key, 'thumbnails'), add_prefix(source.key)])
+
+    def remove_unused_thumbnails(self, source, urls):
+        """Миниатюры живого исходника, которых нет в renditions."""
+        keys = default.kvstore._get(source.key, identity='thumbnails') or []
+        rows = KVStore.objects.filter(
+            key__in=[add_prefix(key) for key in keys]).values_list(
+                'key', 'value')
+        stale = set()
+        for key, value in rows:
+            thumbnail = deserialize_image_file(value)
+            if thumbnail.url in urls:
+                continue
+            if not thumbnail.exists():
+                stale.add(key)
+            elif self.is_old(thumbnail.storage, thumbnail.name):
+                stale.add(key)
+                self.remove_file(thumbnail.storage, thumbnail.name)
+        if not stale:
+            return
+        self.remove_keys(list(stale))
+        if not self.dry_run:
+            default.kvstore._set(
+                source.key,
+                [key for key in keys if add_prefix(key) not in stale],
+                identity='thumbnails')
+
+    def prune_thumbnail_lists(self):
+        """Списки миниатюр, у исходника которых нет записи."""
+        for rows in kvstore_rows('thumbnails'):
+            sources = {
+                add_prefix(del_prefix(key)): key for key, _ in rows}
+            found = existing_keys(list(sources))
+            self.remove_keys([
+                key for source_key, key in sources.items()
+                if source_key not in found])
+
+    def prune_thumbnail_entries(self):
+        """Записи миниатюр, файлов которых уже нет."""
+        prefix = sorl_settings.THUMBNAIL_PREFIX
+        for rows in kvstore_rows('image'):
+            images = {
+                key: deserialize_image_file(value) for key, value in rows}
+            self.remove_keys([
+                key for key, image in images.items()
+                if image.name.startswith(prefix) and not image.exists()])
+
+    def walk(self, storage, path):
+        if not storage.exists(path):
+            return []
+        return walk(storage, path)
+
+    def sweep_originals(self):
+        for chunk in chunked(self.walk(self.storage, self.upload_to)):
+            old = [name for name in chunk if self.is_old(self.storage, name)]
+            alive = referenced(old)
+            for name in old:
+                if name not in alive:
+                    self.remove_original(name)
+
+    def remove_original(self, name):
+        if self.dry_run or not self.storage.is_hashed(name):
+            # Прежние имена повторная загрузка не выдаёт.
+            self.remove_file(self.storage, name)
+            return
+        with transaction.atomic():
+            # Запись первой: reserve() новой загрузки ждёт коммита, а
+            # взятую до этого ссылку покажет условие удаления.
+            StoredFile.objects.bulk_create(
+                [StoredFile(name=name)], ignore_conflicts=True)
+            deleted, _ = StoredFile.objects.filter(
+                name=name, references__lte=0).delete()
+            if deleted:
+                self.remove_file(self.storage, name)
+
+    def sweep_thumbnails(self):
+        storage = default.storage
+        names = self.walk(storage, sorl_settings.THUMBNAIL_PREFIX)
+        for chunk in chunked(names):
+            keys = {
+                add_prefix(ImageFile(name, storage).key): name
+                for name in chunk if self.is_old(storage, name)}
+            found = existing_keys(list(keys))
+            for key, name in keys.items():
+                if key not in found:
+                    self.remove_file(storage, name)
@@ -0,0 +1,57 @@
+# Generated by Django 2.2.16 on 2026-10-18 03:40
+
+from django.db import migrations
+
+# SQL — на момент миграции: posts.search может измениться позже.
+TABLE = 'posts_post_fts'
+CREATE_TABLE = (
+    f'CREATE VIRTUAL TABLE IF NOT EXISTS {TABLE} USING fts5('
+    "text, content='posts_post', content_rowid='id', "
+    "tokenize='unicode61 remove_diacritics 2', prefix='2 3')")
+TRIGGERS = {
+    f'{TABLE}_insert': (
+        'AFTER INSERT ON posts_post BEGIN '
+        f'INSERT INTO {TABLE}(rowid, text) VALUES (new.id, new.text); '
+        'END'),
+    f'{TABLE}_delete': (
+        'AFTER DELETE ON posts_post BEGIN '
+        f'INSERT INTO {TABLE}({TABLE}, rowid, text) '
+        "VALUES ('delete', old.id, old.text); "
+        'END'),
+    f'{TABLE}_update': (
+        'AFTER UPDATE OF text ON posts_post BEGIN '
+        f'INSERT INTO {TABLE}({TABLE}, rowid, text) '
+        "VALUES ('delete', old.id, old.text); "
+        f'INSERT INTO {TABLE}(rowid, text) VALUES (new.id, new.text); '
+        'END'),
+}
+
+
+def create_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(CREATE_TABLE)
+        for name, body in TRIGGERS.items():
+            cursor.execute(f'CREATE TRIGGER IF NOT EXISTS {name} {body}')
+        cursor.execute(f"INSERT INTO {TABLE}({TABLE}) VALUES ('rebuild')")
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        for name in TRIGGERS:
+            cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+        cursor.execute(f'DROP TABLE IF EXISTS {TABLE}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0029_sharding'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.16 on 2026-10-18 03:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0031_tag_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='renditions',
+            field=models.TextField(blank=True, default='', editable=False, verbose_name='Миниатюры'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 2.2.16 on 2026-10-18 03:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0032_post_renditions'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RenditionJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('post_id', models.IntegerField(verbose_name='Пост')),
+                ('alias', models.CharField(max_length=100, verbose_name='Алиас базы поста')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Поставлено')),
+            ],
+            options={
+                'verbose_name': 'Задание на миниатюры',
+                'verbose_name_plural': 'Задания на миниатюры',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='renditionjob',
+            constraint=models.UniqueConstraint(fields=('post_id', 'alias'), name='rendition_job_post'),
+        ),
+    ]
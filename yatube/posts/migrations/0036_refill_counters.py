@@ -0,0 +1,50 @@
+# Generated by Django 2.2.16 on 2026-10-18 04:40
+
+from django.conf import settings
+from django.db import migrations
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def _count(model, field):
+    return Coalesce(Subquery(
+        model.objects.filter(**{field: OuterRef('pk')})
+        .order_by().values(field).annotate(total=Count('pk'))
+        .values('total')), 0)
+
+
+def refill_counters(apps, schema_editor):
+    # 0027 заполняла счётчики всегда в основной базе; здесь — в той,
+    # к которой применяется миграция. Повторный запуск безопасен.
+    User = apps.get_model(settings.AUTH_USER_MODEL)
+    AuthorStats = apps.get_model('posts', 'AuthorStats')
+    Group = apps.get_model('posts', 'Group')
+    Post = apps.get_model('posts', 'Post')
+    Comment = apps.get_model('posts', 'Comment')
+    Follow = apps.get_model('posts', 'Follow')
+    db_alias = schema_editor.connection.alias
+    existing = set(AuthorStats.objects.using(db_alias).values_list(
+        'user_id', flat=True))
+    AuthorStats.objects.using(db_alias).bulk_create(
+        [AuthorStats(user_id=pk)
+         for pk in User.objects.using(db_alias).values_list('pk', flat=True)
+         if pk not in existing],
+        batch_size=500)
+    AuthorStats.objects.using(db_alias).update(
+        posts_count=_count(Post, 'author'),
+        followers_count=_count(Follow, 'author'),
+        following_count=_count(Follow, 'user'))
+    Group.objects.using(db_alias).update(posts_count=_count(Post, 'group'))
+    Post.objects.using(db_alias).update(
+        comments_count=_count(Comment, 'post'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0035_post_image_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(refill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.16 on 2026-10-18 04:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0036_refill_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='authorshard',
+            name='moving',
+            field=models.BooleanField(default=False, help_text='Посты автора копируются на другой шард, запись закрыта', verbose_name='Переносится'),
+        ),
+    ]
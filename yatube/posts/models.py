@@ -1,21 +1,81 @@
-from django.db import models
+import json
+
+from django.db import models, router, transaction
 from django.contrib.auth import get_user_model
 
+from core.storage import ContentAddressedStorage
+
+from . import sharding
+
 User = get_user_model()
 
 
-class Group(models.Model):
+class CountedModel(models.Model):
+    """Модель, связанная с денормализованными счётчиками.
+
+    save() выполняется в одной транзакции с обработчиками post_save,
+    которые меняют счётчики связанных строк (posts.counters).
+    Собственные счётчики (counter_fields) меняются только через F(),
+    поэтому save() уже существующей строки их не перезаписывает.
+    """
+    counter_fields = ()
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        if (self.counter_fields and not self._state.adding
+                and kwargs.get('update_fields') is None):
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key
+                and field.name not in self.counter_fields]
+        using = kwargs.get('using') or router.db_for_write(
+            type(self), instance=self)
+        with transaction.atomic(using=using):
+            super().save(*args, **kwargs)
+
+
+class Group(CountedModel):
     title = models.CharField(
         verbose_name='Группа',
         max_length=200)
     slug = models.SlugField(unique=True)
     description = models.TextField()
+    posts_count = models.IntegerField(
+        'Число постов',
+        default=0,
+        editable=False
+    )
+
+    counter_fields = ('posts_count',)
 
     def __str__(self):
         return self.title
 
 
-class Post(models.Model):
+class ShardedQuerySet(models.QuerySet):
+
+    def create(self, **kwargs):
+        if self._db is None and sharding.is_sharded():
+            # Без явного using() строку размещает роутер по шарду
+            # автора, а не база менеджера.
+            obj = self.model(**kwargs)
+            obj.save()
+            return obj
+        return super().create(**kwargs)
+
+
+class PostQuerySet(ShardedQuerySet):
+    # Связи, которые читает карточка поста (posts/includes/post_card.html).
+    card_related = ('author', 'group')
+
+    def for_cards(self, *extra):
+        """Всё, что нужно карточке поста, одним запросом."""
+        return sharding.with_related(self, *self.card_related, *extra)
+
+
+class Post(CountedModel):
     text = models.TextField(
         'Текст поста',
         help_text='Введите текст поста',
@@ -25,38 +85,98 @@ class Post(models.Model):
         'Дата публикации',
         auto_now_add=True
     )
+    # Пользователи и группы лежат в основной базе, посты — на шардах
+    # (posts.sharding), поэтому ограничений внешних ключей в базе нет.
     author = models.ForeignKey(
         User,
         on_delete=models.CASCADE,
         related_name='posts',
-        verbose_name='Автор'
+        verbose_name='Автор',
+        db_constraint=False
     )
     group = models.ForeignKey(
         Group,
         null=True,
         blank=True,
         on_delete=models.SET_NULL,
+        db_constraint=False,
         related_name='posts',
         verbose_name='Группа',
         max_length=200,
         help_text='Выберите группу'
     )
+    # Имя файла — sha256 содержимого: одинаковые картинки хранятся
+    # один раз (core.storage). Индекс — для поиска ссылок на файл
+    # (posts.media_gc).
     image = models.ImageField(
         'Картинка',
         upload_to='posts/',
-        blank=True
+        storage=ContentAddressedStorage(),
+        blank=True,
+        db_index=True
+    )
+    # JSON {имя: {url, width, height}} готовых миниатюр картинки
+    # (posts.renditions); пусто, пока их не сделали.
+    renditions = models.TextField(
+        'Миниатюры',
+        blank=True,
+        default='',
+        editable=False
+    )
+    comments_count = models.IntegerField(
+        'Число комментариев',
+        default=0,
+        editable=False
     )
 
+    counter_fields = ('comments_count',)
+
+    objects = PostQuerySet.as_manager()
+
     class Meta:
         verbose_name = 'Пост'
         verbose_name_plural = 'Посты'
         ordering = ['-pub_date']
+        # Ленты читаются range scan'ом по этим индексам. id стоит в
+        # индексе явно: неявный rowid в конце индекса идёт по
+        # возрастанию, и порядок (-pub_date, -id) keyset-пагинации
+        # потребовал бы досортировки во временном B-tree.
+        indexes = (
+            models.Index(
+                fields=['author', '-pub_date', '-id'],
+                name='post_author_pub_date_idx',
+            ),
+            models.Index(
+                fields=['group', '-pub_date', '-id'],
+                name='post_group_pub_date_idx',
+            ),
+            models.Index(
+                fields=['-pub_date', '-id'],
+                name='post_pub_date_idx',
+            ),
+        )
 
     def __str__(self):
         return self.text[:15]
 
+    @property
+    def card_image(self):
+        """Миниатюра для карточки: {url, width, height} или None."""
+        if not self.renditions:
+            # Пока миниатюр нет — то, что нашёл renditions.prefetch().
+            return getattr(self, 'prefetched_renditions', {}).get('card')
+        return json.loads(self.renditions).get('card')
 
-class Comment(models.Model):
+    def save(self, *args, **kwargs):
+        if self.pk is None and sharding.is_sharded():
+            # id уникален на всех шардах; force_insert не даст молча
+            # перезаписать пост, если PostLocation отстал от шардов.
+            self.pk = sharding.allocate_post_id(self.author_id)
+            kwargs['force_insert'] = True
+        super().save(*args, **kwargs)
+
+
+class Comment(CountedModel):
     post = models.ForeignKey(
         Post,
         on_delete=models.CASCADE,
@@ -66,6 +186,7 @@ class Comment(models.Model):
         User,
         on_delete=models.CASCADE,
         related_name='comments',
+        db_constraint=False,
     )
     text = models.TextField(
         'Текст комментария',
@@ -76,11 +197,19 @@ class Comment(models.Model):
         auto_now_add=True
     )
 
+    objects = ShardedQuerySet.as_manager()
+
     class Meta:
         ordering = ['-created']
+        indexes = (
+            models.Index(
+                fields=['post', '-created'],
+                name='comment_post_created_idx',
+            ),
+        )
 
 
-class Follow(models.Model):
+class Follow(CountedModel):
     user = models.ForeignKey(
         User,
         on_delete=models.CASCADE,
@@ -97,7 +226,225 @@ class Follow(models.Model):
     )
 
     class Meta:
+        # Индекс (user, author) создаёт уникальное ограничение,
+        # (author, user) покрывает выборку подписчиков при fan-out.
         constraints = (models.UniqueConstraint(
             fields=['user', 'author'],
             name='user_to_author_follow',
         ),)
+        indexes = (
+            models.Index(
+                fields=['author', 'user'],
+                name='follow_author_user_idx',
+            ),
+        )
+
+
+class AuthorStats(models.Model):
+    """Денормализованные счётчики пользователя (posts.counters)."""
+    user = models.OneToOneField(
+        User,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='stats',
+        verbose_name='Пользователь'
+    )
+    posts_count = models.IntegerField('Число постов', default=0)
+    followers_count = models.IntegerField('Число подписчиков', default=0)
+    following_count = models.IntegerField('Число подписок', default=0)
+
+    class Meta:
+        verbose_name = 'Счётчики автора'
+        verbose_name_plural = 'Счётчики авторов'
+
+
+class PostEntryQuerySet(models.QuerySet):
+    """Строки-указатели на посты: записи лент, тегов и упоминаний."""
+
+    def for_cards(self):
+        """Записи вместе со всем, что нужно карточкам их постов."""
+        return self.select_related(*(
+            f'post__{name}' for name in PostQuerySet.card_related))
+
+
+class FeedEntry(models.Model):
+    """Материализованная лента «Избранные авторы».
+
+    Строка появляется у каждого подписчика при публикации поста,
+    поэтому чтение ленты — один range scan по индексу (user, pub_date).
+    """
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='feed_entries',
+        verbose_name='Читатель'
+    )
+    post = models.ForeignKey(
+        Post,
+        on_delete=models.CASCADE,
+        related_name='feed_entries',
+        verbose_name='Пост',
+        db_constraint=False
+    )
+    author = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='+',
+        verbose_name='Автор'
+    )
+    pub_date = models.DateTimeField('Дата публикации')
+
+    objects = PostEntryQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = 'Запись ленты'
+        verbose_name_plural = 'Записи ленты'
+        ordering = ['-pub_date']
+        constraints = (models.UniqueConstraint(
+            fields=['user', 'post'],
+            name='user_to_post_feed_entry',
+        ),)
+        indexes = (
+            models.Index(
+                fields=['user', '-pub_date', '-post'],
+                name='feed_user_pub_date_idx',
+            ),
+            models.Index(
+                fields=['user', 'author'],
+                name='feed_user_author_idx',
+            ),
+        )
+
+
+class PostLocation(models.Model):
+    """Адрес поста при шардировании (posts.sharding).
+
+    Выдаёт id постов, уникальные на всех шардах, и по id поста
+    находит его автора, а значит и шард.
+    """
+    author = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='+',
+        verbose_name='Автор'
+    )
+
+    class Meta:
+        verbose_name = 'Адрес поста'
+        verbose_name_plural = 'Адреса постов'
+
+
+class AuthorShard(models.Model):
+    """Шард, на котором лежат посты автора (posts.sharding)."""
+    user = models.OneToOneField(
+        User,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='shard',
+        verbose_name='Автор'
+    )
+    alias = models.CharField('Алиас базы', max_length=100)
+    pinned = models.BooleanField(
+        'Закреплён вручную',
+        default=False,
+        help_text='rebalance_shards не переносит автора по хешу'
+    )
+    moving = models.BooleanField(
+        'Переносится',
+        default=False,
+        help_text='Посты автора копируются на другой шард, запись закрыта'
+    )
+
+    class Meta:
+        verbose_name = 'Шард автора'
+        verbose_name_plural = 'Шарды авторов'
+
+
+class TagEntry(models.Model):
+    """Инвертированный индекс хештегов (posts.tags)."""
+    tag = models.CharField('Тег', max_length=50)
+    post = models.ForeignKey(
+        Post,
+        on_delete=models.CASCADE,
+        related_name='tag_entries',
+        verbose_name='Пост',
+        db_constraint=False
+    )
+    author = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='+',
+        verbose_name='Автор'
+    )
+    pub_date = models.DateTimeField('Дата публикации')
+
+    objects = PostEntryQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = 'Тег поста'
+        verbose_name_plural = 'Теги постов'
+        constraints = (models.UniqueConstraint(
+            fields=['tag', 'post'],
+            name='tag_to_post_entry',
+        ),)
+        indexes = (
+            models.Index(
+                fields=['tag', '-pub_date', '-post'],
+                name='tag_pub_date_idx',
+            ),
+        )
+
+
+class Mention(models.Model):
+    """Инвертированный индекс упоминаний @username (posts.tags)."""
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='mentions',
+        verbose_name='Упомянутый'
+    )
+    post = models.ForeignKey(
+        Post,
+        on_delete=models.CASCADE,
+        related_name='mentions',
+        verbose_name='Пост',
+        db_constraint=False
+    )
+    author = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='+',
+        verbose_name='Автор'
+    )
+    pub_date = models.DateTimeField('Дата публикации')
+
+    objects = PostEntryQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = 'Упоминание'
+        verbose_name_plural = 'Упоминания'
+        constraints = (models.UniqueConstraint(
+            fields=['user', 'post'],
+            name='user_to_post_mention',
+        ),)
+        indexes = (
+            models.Index(
+                fields=['user', '-pub_date', '-post'],
+                name='mention_user_pub_date_idx',
+            ),
+        )
+
+
+class RenditionJob(models.Model):
+    """Очередь постов, которым нужны миниатюры (posts.renditions)."""
+    post_id = models.IntegerField('Пост')
+    alias = models.CharField('Алиас базы поста', max_length=100)
+    created = models.DateTimeField('Поставлено', auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Задание на миниатюры'
+        verbose_name_plural = 'Задания на миниатюры'
+        constraints = (models.UniqueConstraint(
+            fields=['post_id', 'alias'],
+            name='rendition_job_post',
+        ),)
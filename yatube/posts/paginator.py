@@ -0,0 +1,241 @@
+import base64
+import binascii
+import heapq
+import re
+from functools import wraps
+
+from django.core.paginator import Page, Paginator
+from django.db.models import Q
+from django.shortcuts import redirect
+from django.utils.dateparse import parse_datetime
+
+FORWARD = 'n'
+BACKWARD = 'p'
+# Дальше этой страницы старые ссылки ?page=N не ведут: позиция ищется
+# шагами по страницам.
+LEGACY_MAX_PAGE = 50
+
+
+class LegacyPage(Exception):
+    """Запрошена старая ссылка ?page=N; cursor — её страница."""
+
+    def __init__(self, cursor):
+        super().__init__(cursor)
+        self.cursor = cursor
+
+
+def encode_cursor(direction, pub_date=None, key=None):
+    """Упаковывает позицию (pub_date, id) в непрозрачный токен."""
+    raw = direction
+    if pub_date is not None:
+        raw = f'{direction}|{pub_date.isoformat()}|{key}'
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """Возвращает (direction, pub_date, id); None для битого токена."""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode()).decode()
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+    parts = raw.split('|')
+    if parts[0] not in (FORWARD, BACKWARD):
+        return None
+    if len(parts) == 1:
+        return parts[0], None, None
+    # isdigit() пропустил бы и '²': int() на нём падает.
+    if len(parts) != 3 or not re.fullmatch('[0-9]+', parts[2]):
+        return None
+    try:
+        pub_date = parse_datetime(parts[1])
+        key = int(parts[2])
+    except (ValueError, OverflowError):
+        # Дата по формату, но вне диапазона: 2020-13-45.
+        return None
+    if pub_date is None:
+        return None
+    return parts[0], pub_date, key
+
+
+def keyset_slice(queryset, limit, tiebreak='pk', descending=True,
+                 pub_date=None, key=None):
+    """Строки строго после позиции (pub_date, key) в порядке ленты."""
+    if descending:
+        ordering = ('-pub_date', f'-{tiebreak}')
+        lookup = 'lt'
+    else:
+        ordering = ('pub_date', tiebreak)
+        lookup = 'gt'
+    queryset = queryset.order_by(*ordering)
+    if pub_date is not None:
+        queryset = queryset.filter(
+            Q(**{f'pub_date__{lookup}': pub_date})
+            | Q(pub_date=pub_date, **{f'{tiebreak}__{lookup}': key}))
+    return list(queryset[:limit])
+
+
+class CursorPaginator(Paginator):
+    """Keyset-пагинация по (pub_date, id) с токенами ?cursor=.
+
+    Любая страница стоит одного индексного range scan с LIMIT,
+    независимо от того, как далеко от начала ленты она находится.
+    Вместо COUNT(*) паджинатор знает только окно вокруг текущей
+    страницы: есть ли записи до неё и после неё.
+    """
+
+    def __init__(self, object_list, per_page, tiebreak='pk', **kwargs):
+        if hasattr(object_list, 'order_by'):
+            object_list = object_list.order_by('-pub_date', f'-{tiebreak}')
+        super().__init__(object_list, per_page, **kwargs)
+        self.tiebreak = tiebreak
+        self.next_cursor = None
+        self.previous_cursor = None
+        self.last_cursor = encode_cursor(BACKWARD)
+        self._num_pages = 1
+
+    @property
+    def num_pages(self):
+        return self._num_pages
+
+    @property
+    def count(self):
+        return self._num_pages * self.per_page
+
+    @property
+    def page_range(self):
+        return range(1, self._num_pages + 1)
+
+    def validate_number(self, number):
+        return number
+
+    def position(self, row):
+        return row.pub_date, getattr(row, self.tiebreak)
+
+    def _fetch(self, descending=True, pub_date=None, key=None):
+        return keyset_slice(
+            self.object_list, self.per_page + 1, self.tiebreak,
+            descending, pub_date, key)
+
+    def _build_page(self, rows, number, has_next):
+        if has_next:
+            self.next_cursor = encode_cursor(
+                FORWARD, *self.position(rows[-1]))
+        if number > 1 and rows:
+            self.previous_cursor = encode_cursor(
+                BACKWARD, *self.position(rows[0]))
+        self._num_pages = number + 1 if has_next else number
+        return Page(rows, number, self)
+
+    def get_page(self, cursor=None):
+        position = decode_cursor(cursor) if cursor else None
+        if position is None:
+            rows = self._fetch()
+            return self._build_page(
+                rows[:self.per_page], 1, len(rows) > self.per_page)
+        direction, pub_date, key = position
+        if direction == FORWARD:
+            rows = self._fetch(True, pub_date, key)
+            return self._build_page(
+                rows[:self.per_page], 2, len(rows) > self.per_page)
+        rows = self._fetch(False, pub_date, key)
+        if len(rows) <= self.per_page:
+            # Дошли до начала ленты: отдаём полную первую страницу.
+            return self.get_page()
+        return self._build_page(
+            rows[:self.per_page][::-1], 2, pub_date is not None)
+
+    def cursor_for_page(self, number):
+        """Курсор страницы number для старых ссылок ?page=N.
+
+        Позиция ищется keyset-шагами по страницам, без OFFSET; номер
+        больше последней страницы ведёт на последнюю.
+        """
+        try:
+            number = min(max(int(number), 1), LEGACY_MAX_PAGE)
+        except (TypeError, ValueError):
+            number = 1
+        position = (None, None)
+        for _ in range(number - 1):
+            rows = self._fetch(True, *position)
+            if len(rows) <= self.per_page:
+                break
+            position = self.position(rows[self.per_page - 1])
+        if position[0] is None:
+            return None
+        return encode_cursor(FORWARD, *position)
+
+
+class MergedCursorPaginator(CursorPaginator):
+    """Cursor-пагинация поверх нескольких потоков, упорядоченных по
+    (pub_date, id): k-way merge через heapq.merge.
+
+    streams — список пар (queryset, tiebreak); одна и та же позиция
+    (pub_date, id) в разных потоках считается одной записью.
+    """
+
+    def __init__(self, streams, per_page, **kwargs):
+        super().__init__(list(streams), per_page, **kwargs)
+
+    def position(self, row):
+        return row.pub_date, row.cursor_key
+
+    def _merge(self, slices, descending, limit):
+        def tagged(rows, tiebreak):
+            for row in rows:
+                row.cursor_key = getattr(row, tiebreak)
+                yield (row.pub_date, row.cursor_key), row
+
+        merged = heapq.merge(
+            *(tagged(rows, tiebreak) for rows, tiebreak in slices),
+            key=lambda item: item[0], reverse=descending)
+        rows, seen = [], set()
+        for position, row in merged:
+            if position in seen:
+                continue
+            seen.add(position)
+            rows.append(row)
+            if len(rows) == limit:
+                break
+        return rows
+
+    def _fetch(self, descending=True, pub_date=None, key=None):
+        limit = self.per_page + 1
+        return self._merge(
+            [(keyset_slice(queryset, limit, tiebreak, descending,
+                           pub_date, key), tiebreak)
+             for queryset, tiebreak in self.object_list],
+            descending, limit)
+
+
+def paginate(request, queryset, per_page, paginator_class=CursorPaginator,
+             **kwargs):
+    """Возвращает страницу ленты по ?cursor=.
+
+    Устаревший ?page=N поднимает LegacyPage: legacy_pages переводит
+    его в редирект на курсор.
+    """
+    paginator = paginator_class(queryset, per_page, **kwargs)
+    cursor = request.GET.get('cursor')
+    page_number = request.GET.get('page')
+    if not cursor and page_number:
+        raise LegacyPage(paginator.cursor_for_page(page_number))
+    return paginator.get_page(cursor)
+
+
+def legacy_pages(view):
+    """Редиректит старые ссылки ?page=N ленты на ?cursor=."""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        try:
+            return view(request, *args, **kwargs)
+        except LegacyPage as legacy:
+            query = request.GET.copy()
+            query.pop('page', None)
+            if legacy.cursor:
+                query['cursor'] = legacy.cursor
+            url = request.path
+            if query:
+                url += '?' + query.urlencode()
+            return redirect(url)
+    return wrapper
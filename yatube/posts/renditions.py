@@ -0,0 +1,287 @@
+"""Миниатюры картинок постов, подготовленные заранее.
+
+Для карточки делаются миниатюры нескольких ширин (variants()) в WebP
+и JPEG: шаблон отдаёт их через srcset/sizes, и браузер скачивает
+ближайшую к ширине карточки. Миниатюры делает отдельный процесс
+renditions_worker: после коммита поста с новой картинкой в очередь
+RenditionJob ставится задание. Адреса и размеры миниатюр сохраняются
+в Post.renditions, поэтому шаблоны на запросе не вызывают ни Pillow,
+ни kvstore sorl. Пока миниатюр нет, карточка показывает исходную
+картинку.
+
+Задание теряется, если процесс упал между коммитом поста и записью
+в очередь: такие посты и старые доделывает make_renditions. Для
+таких постов prefetch() берёт уже сделанные sorl миниатюры одним
+запросом на страницу, а если их нет — прежнюю миниатюру LEGACY.
+"""
+import json
+import logging
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from PIL import features
+from sorl.thumbnail import default, get_thumbnail
+from sorl.thumbnail.conf import defaults as sorl_defaults
+from sorl.thumbnail.conf import settings as sorl_settings
+from sorl.thumbnail.images import ImageFile, deserialize_image_file
+from sorl.thumbnail.kvstores.cached_db_kvstore import EMPTY_VALUE
+from sorl.thumbnail.kvstores.base import add_prefix
+from sorl.thumbnail.models import KVStore
+
+from .models import Post, RenditionJob
+
+logger = logging.getLogger(__name__)
+
+# Пропорции карточки и ширины миниатюр для srcset.
+CARD_SIZE = (1980, 1024)
+CARD_WIDTHS = (480, 960, 1980)
+# Ширина для src: её берут браузеры без поддержки srcset.
+CARD_DEFAULT_WIDTH = 960
+QUALITY = 80
+# Прежняя миниатюра карточки — одна, увеличенная (image_report).
+LEGACY = ('1980x1024', {'crop': 'center', 'upscale': True})
+
+
+def card_formats():
+    """Форматы миниатюр; WebP — если Pillow собран с libwebp."""
+    if features.check('webp'):
+        return ('WEBP', 'JPEG')
+    return ('JPEG',)
+
+
+def variants():
+    """[(ширина, формат, геометрия, параметры sorl)] для карточки.
+
+    Без upscale: увеличенная копия маленькой картинки только тяжелее.
+    """
+    card_width, card_height = CARD_SIZE
+    return [
+        (width, format_,
+         f'{width}x{round(card_height * width / card_width)}',
+         {'crop': 'center', 'upscale': False, 'format': format_,
+          'quality': QUALITY})
+        for format_ in card_formats() for width in CARD_WIDTHS]
+
+
+def renditions_async():
+    return getattr(settings, 'RENDITIONS_ASYNC', True)
+
+
+def describe(thumbnails):
+    """{'card': {url, width, height, srcset}} из [(формат, миниатюра)].
+
+    url, width и height — JPEG для src; srcset — строки srcset по
+    форматам: {'webp': 'a.webp 480w, …', 'jpeg': …}.
+    """
+    candidates = {}
+    for format_, thumbnail in sorted(
+            thumbnails, key=lambda item: item[1].width):
+        # Маленькая картинка без увеличения даёт одинаковые миниатюры.
+        candidates.setdefault(format_.lower(), {}).setdefault(
+            thumbnail.width, thumbnail)
+    jpegs = list(candidates.get('jpeg', {}).values())
+    if not jpegs:
+        return {}
+    fallback = [
+        thumbnail for thumbnail in jpegs
+        if thumbnail.width <= CARD_DEFAULT_WIDTH][-1:] or jpegs[:1]
+    return {'card': {
+        'url': fallback[0].url,
+        'width': fallback[0].width,
+        'height': fallback[0].height,
+        'srcset': {
+            format_: ', '.join(
+                f'{thumbnail.url} {width}w'
+                for width, thumbnail in by_width.items())
+            for format_, by_width in candidates.items()},
+    }}
+
+
+def make(image):
+    """Делает миниатюры картинки; возвращает describe() для них."""
+    thumbnails = []
+    for _, format_, geometry, options in variants():
+        thumbnail = get_thumbnail(image, geometry, **options)
+        if not thumbnail.exists():
+            # sorl не смог прочитать исходник: он сам пишет об этом в лог.
+            continue
+        thumbnails.append((format_, thumbnail))
+    return describe(thumbnails)
+
+
+def sorl_options(source, options):
+    """Параметры sorl, дополненные, как в ThumbnailBackend.get_thumbnail.
+
+    С другими параметрами получились бы другое имя и ключ kvstore.
+    """
+    backend = default.backend
+    options = dict(options)
+    if sorl_settings.THUMBNAIL_PRESERVE_FORMAT:
+        options.setdefault('format', backend._get_format(source))
+    for key, value in backend.default_options.items():
+        options.setdefault(key, value)
+    for key, attr in backend.extra_options:
+        value = getattr(sorl_settings, attr)
+        if value != getattr(sorl_defaults, attr):
+            options.setdefault(key, value)
+    return options
+
+
+def thumbnail_file(image, geometry, options):
+    """Файл миниатюры sorl по имени картинки, не читая её."""
+    source = ImageFile(image)
+    return ImageFile(
+        default.backend._get_thumbnail_filename(
+            source, geometry, sorl_options(source, options)),
+        default.storage)
+
+
+def prefetch(posts):
+    """Подставляет постам без renditions готовые миниатюры sorl.
+
+    Ключи всех картинок страницы читаются одним get_many из кэша
+    kvstore и одним запросом к его таблице для промахов, а не по
+    запросу на {% thumbnail %}. Рассчитано на kvstore по умолчанию
+    (cached_db). Если нет ни одной миниатюры variants(), берётся
+    прежняя (LEGACY): у старых постов только она. Найденное лежит в
+    post.prefetched_renditions.
+    """
+    wanted = _thumbnail_keys(posts)
+    if not wanted:
+        return
+    thumbnails = {}
+    legacy = {}
+    for key, value in _kvstore_values(list(wanted)).items():
+        thumbnail = deserialize_image_file(value)
+        for post, format_ in wanted[key]:
+            if format_ is None:
+                legacy[post] = thumbnail
+            else:
+                thumbnails.setdefault(post, []).append((format_, thumbnail))
+    for post, thumbnail in legacy.items():
+        if post not in thumbnails:
+            format_ = sorl_options(ImageFile(post.image), LEGACY[1])['format']
+            thumbnails[post] = [(format_, thumbnail)]
+    for post, found_thumbnails in thumbnails.items():
+        post.prefetched_renditions = describe(found_thumbnails)
+
+
+def _thumbnail_keys(posts):
+    """{ключ kvstore миниатюры: [(пост, формат)]}; формат None — LEGACY."""
+    geometry, options = LEGACY
+    lookups = [(None, geometry, options)] + [
+        (format_, geometry, options)
+        for _, format_, geometry, options in variants()]
+    wanted = {}
+    for post in posts:
+        if not post.image or post.renditions:
+            continue
+        post.prefetched_renditions = {}
+        for format_, geometry, options in lookups:
+            thumbnail = thumbnail_file(post.image, geometry, options)
+            # Одна картинка может быть у нескольких постов страницы.
+            wanted.setdefault(add_prefix(thumbnail.key), []).append(
+                (post, format_))
+    return wanted
+
+
+def _kvstore_values(keys):
+    """{ключ: значение} kvstore для найденных ключей из keys."""
+    kv_cache = default.kvstore.cache
+    found = kv_cache.get_many(keys)
+    missing = [key for key in keys if key not in found]
+    if missing:
+        rows = dict(KVStore.objects.filter(key__in=missing).values_list(
+            'key', 'value'))
+        # Как _get_raw kvstore: промах тоже кэшируется, иначе страница
+        # без миниатюр ходила бы в таблицу kvstore на каждом запросе.
+        kv_cache.set_many(
+            {key: rows.get(key, EMPTY_VALUE) for key in missing},
+            sorl_settings.THUMBNAIL_CACHE_TIMEOUT)
+        found.update(rows)
+    # Промах kvstore кэширует как маркер-класс, а не строку.
+    return {
+        key: value for key, value in found.items()
+        if isinstance(value, str)}
+
+
+def move_thumbnails(old_name, new_name, storage):
+    """Переписывает в kvstore миниатюры картинки old_name на new_name.
+
+    Файлы миниатюр остаются прежними: их адреса лежат в Post.renditions,
+    а collect_media считает живыми миниатюры живых исходников. Старое
+    имя ищется и под прежним хранилищем по умолчанию (до core.storage).
+    """
+    kvstore = default.kvstore
+    source = ImageFile(new_name, storage)
+    thumbnails = set(
+        kvstore._get(source.key, identity='thumbnails') or [])
+    size = None
+    for old_source in (ImageFile(old_name, storage),
+                       ImageFile(old_name, default_storage)):
+        old = kvstore.get(old_source)
+        if old is not None:
+            size = old.size
+        thumbnails.update(
+            kvstore._get(old_source.key, identity='thumbnails') or [])
+        kvstore.delete(old_source, delete_thumbnails=False)
+        kvstore._delete(old_source.key, identity='thumbnails')
+    if not thumbnails or size is None:
+        return
+    source.set_size(size)
+    kvstore._set(source.key, source)
+    kvstore._set(source.key, list(thumbnails), identity='thumbnails')
+
+
+def render(post_id, using):
+    """Делает миниатюры поста и сохраняет их; True — если сохранил."""
+    post = Post.objects.using(using).filter(pk=post_id).first()
+    if post is None or not post.image:
+        return False
+    image_name = post.image.name
+    result = make(post.image)
+    if not result:
+        return False
+    with transaction.atomic(using=using):
+        post = Post.objects.using(using).filter(pk=post_id).first()
+        # Пока делали миниатюры, картинку могли заменить.
+        if post is None or post.image.name != image_name:
+            return False
+        post.renditions = json.dumps(result)
+        # save(), а не update(): сигналы поднимут версии кэша страниц.
+        post.save(update_fields=['renditions'])
+    return True
+
+
+def run_jobs(limit):
+    """Выполняет до limit заданий очереди; возвращает их число."""
+    jobs = list(RenditionJob.objects.order_by('pk')[:limit])
+    for job in jobs:
+        # Задание забирается до работы: если картинку заменят, пока
+        # делаются миниатюры, enqueue поставит новое, а не совпадёт со
+        # старым. Упавшее задание не повторяется: пост доделает
+        # make_renditions.
+        if not RenditionJob.objects.filter(pk=job.pk).delete()[0]:
+            # Его уже забрал другой worker.
+            continue
+        try:
+            render(job.post_id, job.alias)
+        except Exception:
+            logger.exception('Миниатюры поста #%s не сделаны', job.post_id)
+    return len(jobs)
+
+
+def enqueue(post_id, using):
+    RenditionJob.objects.bulk_create(
+        [RenditionJob(post_id=post_id, alias=using)], ignore_conflicts=True)
+
+
+def schedule(post):
+    """Ставит миниатюры поста в очередь после коммита его сохранения."""
+    using = post._state.db
+    if renditions_async():
+        job = enqueue
+    else:
+        job = render
+    transaction.on_commit(lambda: job(post.pk, using), using=using)
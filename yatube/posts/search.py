@@ -0,0 +1,202 @@
+"""Полнотекстовый поиск по постам на SQLite FTS5.
+
+posts_post_fts — external content таблица над posts_post: сам текст
+в ней не хранится, только индекс. Её обновляют триггеры на
+posts_post, поэтому индекс не отстаёт и при bulk_create, update() и
+переносе автора между шардами (rebalance_shards). Пересоздание
+таблицы posts_post миграциями удаляет триггеры; install() после
+каждого migrate ставит их заново и при этом пересобирает индекс.
+
+Результаты упорядочены по bm25 (rank) и листаются курсором по
+(rank, id): следующая страница не перечитывает посты предыдущих.
+"""
+import base64
+import binascii
+import heapq
+import re
+
+from django.core.paginator import Page, Paginator
+from django.db import connections, router
+
+from . import sharding
+from .models import Post
+
+TABLE = 'posts_post_fts'
+TRIGGERS = {
+    f'{TABLE}_insert': (
+        'AFTER INSERT ON posts_post BEGIN '
+        f'INSERT INTO {TABLE}(rowid, text) VALUES (new.id, new.text); '
+        'END'),
+    f'{TABLE}_delete': (
+        'AFTER DELETE ON posts_post BEGIN '
+        f'INSERT INTO {TABLE}({TABLE}, rowid, text) '
+        "VALUES ('delete', old.id, old.text); "
+        'END'),
+    f'{TABLE}_update': (
+        'AFTER UPDATE OF text ON posts_post BEGIN '
+        f'INSERT INTO {TABLE}({TABLE}, rowid, text) '
+        "VALUES ('delete', old.id, old.text); "
+        f'INSERT INTO {TABLE}(rowid, text) VALUES (new.id, new.text); '
+        'END'),
+}
+# Префиксу из одной буквы подходит заметная часть индекса.
+MIN_PREFIX = 2
+MAX_TERMS = 8
+TERM = re.compile(r'\w+')
+
+
+def install(connection):
+    """Создаёт индекс и триггеры, которых нет; True — если создавал."""
+    if connection.vendor != 'sqlite':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT name FROM sqlite_master WHERE name = %s "
+            "OR (type = 'trigger' AND tbl_name = 'posts_post')", [TABLE])
+        existing = {row[0] for row in cursor.fetchall()}
+        missing = [name for name in (TABLE, *TRIGGERS)
+                   if name not in existing]
+        if not missing:
+            return False
+        cursor.execute(
+            f'CREATE VIRTUAL TABLE IF NOT EXISTS {TABLE} USING fts5('
+            "text, content='posts_post', content_rowid='id', "
+            "tokenize='unicode61 remove_diacritics 2', prefix='2 3')")
+        for name, body in TRIGGERS.items():
+            cursor.execute(f'CREATE TRIGGER IF NOT EXISTS {name} {body}')
+        # Без триггеров индекс мог отстать от таблицы.
+        rebuild(connection)
+    return True
+
+
+def drop(connection):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        for name in TRIGGERS:
+            cursor.execute(f'DROP TRIGGER IF EXISTS {name}')
+        cursor.execute(f'DROP TABLE IF EXISTS {TABLE}')
+
+
+def rebuild(connection):
+    with connection.cursor() as cursor:
+        cursor.execute(f"INSERT INTO {TABLE}({TABLE}) VALUES ('rebuild')")
+        cursor.execute(f"INSERT INTO {TABLE}({TABLE}) VALUES ('optimize')")
+
+
+def match_expression(query):
+    """Выражение MATCH: все слова запроса, последнее — как префикс.
+
+    Слова берутся в кавычки, поэтому операторы FTS5 во вводе
+    пользователя (OR, NEAR, *, ^) ищутся как обычный текст.
+    """
+    terms = TERM.findall(query.lower())[:MAX_TERMS]
+    if not terms:
+        return None
+    quoted = [f'"{term}"' for term in terms]
+    if len(terms[-1]) >= MIN_PREFIX:
+        quoted[-1] += '*'
+    return ' '.join(quoted)
+
+
+def search_aliases():
+    """Базы, в которых искать: все шарды или база чтения постов."""
+    if sharding.is_sharded():
+        return sharding.shards()
+    return [router.db_for_read(Post)]
+
+
+def ranked_ids(alias, expression, limit, after=None):
+    """[(rank, id)] лучших совпадений в базе alias после позиции after."""
+    sql = f'SELECT rank, rowid FROM {TABLE} WHERE {TABLE} MATCH %s'
+    params = [expression]
+    if after is not None:
+        sql += ' AND (rank > %s OR (rank = %s AND rowid > %s))'
+        params += [after[0], after[0], after[1]]
+    sql += ' ORDER BY rank, rowid LIMIT %s'
+    params.append(limit)
+    with connections[alias].cursor() as cursor:
+        cursor.execute(sql, params)
+        return [tuple(row) for row in cursor.fetchall()]
+
+
+def encode_cursor(rank, key):
+    raw = f'{rank!r}|{key}'
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token):
+    """Возвращает (rank, id); None для битого токена."""
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        rank, key = base64.urlsafe_b64decode(
+            padded.encode()).decode().split('|')
+        return float(rank), int(key)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+
+
+class SearchPaginator(Paginator):
+    """Курсорная пагинация результатов поиска по (rank, id).
+
+    Только вперёд: rank зависит от запроса и считается заново, а
+    последняя страница стоила бы ранжирования всех совпадений.
+    """
+
+    def __init__(self, query, per_page, **kwargs):
+        super().__init__([], per_page, **kwargs)
+        self.query = query
+        self.expression = match_expression(query)
+        self.next_cursor = None
+        # Назад и на последнюю страницу ссылок нет (paginator.html).
+        self.previous_cursor = self.last_cursor = None
+        self._num_pages = 1
+
+    @property
+    def num_pages(self):
+        return self._num_pages
+
+    @property
+    def count(self):
+        return self._num_pages * self.per_page
+
+    def validate_number(self, number):
+        return number
+
+    def get_page(self, cursor=None):
+        after = decode_cursor(cursor) if cursor else None
+        number = 1 if after is None else 2
+        if self.expression is None:
+            return Page([], 1, self)
+        limit = self.per_page + 1
+        # Ранги с разных шардов сравнимы приблизительно: статистика
+        # bm25 у каждого шарда своя.
+        rows = list(heapq.merge(*(
+            [(rank, pk, alias) for rank, pk in ranked_ids(
+                alias, self.expression, limit, after)]
+            for alias in search_aliases())))[:limit]
+        has_next = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if has_next:
+            self.next_cursor = encode_cursor(*rows[-1][:2])
+        self._num_pages = number + 1 if has_next else number
+        return Page(self._load(rows), number, self)
+
+    def _load(self, rows):
+        by_alias = {}
+        for _, pk, alias in rows:
+            by_alias.setdefault(alias, []).append(pk)
+        posts = {}
+        for alias, pks in by_alias.items():
+            posts.update(
+                (post.pk, post) for post in
+                Post.objects.using(alias).filter(pk__in=pks).for_cards())
+        return [posts[pk] for _, pk, _ in rows if pk in posts]
+
+
+def matching_ids(query, limit, using):
+    """id лучших по rank совпадений в базе using; None — пустой запрос."""
+    expression = match_expression(query)
+    if expression is None:
+        return None
+    return [pk for _, pk in ranked_ids(using, expression, limit)]
@@ -0,0 +1,263 @@
+"""Горизонтальное шардирование постов и комментариев по автору.
+
+Post и Comment лежат на алиасах settings.POST_SHARDS: все посты автора
+и комментарии к ним — на одном шарде. Шард автора записан в AuthorShard
+при его первом посте; нового автора размещает rendezvous hashing.
+Добавление шарда ничего не переносит само: команда rebalance_shards
+переносит на него его долю авторов (при rendezvous hashing — только
+её) и переключает AuthorShard после копирования. Пока посты автора
+копируются (AuthorShard.moving), запись его постов и комментариев к ним
+запрещена: ShardRouter бросает AuthorMoving, а AuthorMovingMiddleware
+отвечает 503.
+
+Пользователи, группы, подписки, ленты и счётчики остаются в основной
+базе, поэтому внешние ключи постов на них объявлены без ограничений в
+базе (db_constraint=False), а на шарде автор и группа подгружаются
+отдельным запросом (with_related). id постов уникальны на всех
+шардах: их выдаёт PostLocation в основной базе, и по нему же
+post_queryset() находит шард поста.
+
+С одним шардом (по умолчанию) ничего из этого не включается.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, DatabaseError
+from django.http import HttpResponse
+
+from .paginator import MergedCursorPaginator, paginate
+
+SHARDED_MODELS = ('posts.post', 'posts.comment')
+CACHE_PREFIX = 'shard:'
+CACHE_TIMEOUT = 60 * 60
+BATCH_SIZE = 500
+# Через сколько секунд повторить запись во время переноса автора.
+RETRY_AFTER = 30
+
+
+class AuthorMoving(DatabaseError):
+    """Посты автора переносятся на другой шард: запись закрыта."""
+
+
+def shards():
+    return getattr(settings, 'POST_SHARDS', None) or [DEFAULT_DB_ALIAS]
+
+
+def is_sharded():
+    return len(shards()) > 1
+
+
+def hashed_shard(author_id, aliases=None):
+    """Шард для нового автора (rendezvous hashing)."""
+    return max(aliases or shards(), key=lambda alias: hashlib.md5(
+        f'{alias}:{author_id}'.encode()).digest())
+
+
+def shard_for(author_id):
+    aliases = shards()
+    if len(aliases) == 1:
+        return aliases[0]
+    key = f'{CACHE_PREFIX}{author_id}'
+    alias = cache.get(key)
+    if alias is None:
+        from .models import AuthorShard
+        alias = AuthorShard.objects.filter(user_id=author_id).values_list(
+            'alias', flat=True).first()
+        if alias not in aliases:
+            alias = hashed_shard(author_id, aliases)
+        cache.set(key, alias, CACHE_TIMEOUT)
+    return alias
+
+
+def current_shards(author_ids):
+    """{автор: шард} по AuthorShard, мимо кэша shard_for: один запрос."""
+    from .models import AuthorShard
+    found = dict(AuthorShard.objects.filter(
+        user_id__in=author_ids).values_list('user_id', 'alias'))
+    return {
+        author_id: found.get(author_id) or hashed_shard(author_id)
+        for author_id in author_ids}
+
+
+def forget_shard(author_id):
+    cache.delete(f'{CACHE_PREFIX}{author_id}')
+
+
+def allocate_post_id(author_id):
+    """Выдаёт id нового поста и закрепляет шард за автором."""
+    from .models import AuthorShard, PostLocation
+    AuthorShard.objects.get_or_create(
+        user_id=author_id, defaults={'alias': shard_for(author_id)})
+    return PostLocation.objects.create(author_id=author_id).pk
+
+
+def post_shard(post_id):
+    """Шард поста; None, если такого поста нет."""
+    if not is_sharded():
+        return shards()[0]
+    from .models import PostLocation
+    author_id = PostLocation.objects.filter(pk=post_id).values_list(
+        'author_id', flat=True).first()
+    return shard_for(author_id) if author_id is not None else None
+
+
+def post_queryset(post_id):
+    """Посты на шарде поста post_id."""
+    from .models import Post
+    if not is_sharded():
+        return Post.objects.all()
+    alias = post_shard(post_id)
+    if alias is None:
+        return Post.objects.none()
+    return Post.objects.using(alias)
+
+
+def author_posts(author_id):
+    """Посты автора с его шарда."""
+    from .models import Post
+    posts = Post.objects.filter(author_id=author_id)
+    if not is_sharded():
+        return posts
+    return posts.using(shard_for(author_id))
+
+
+def with_related(queryset, *fields):
+    """select_related, а на шардах — prefetch_related.
+
+    Связанные пользователи и группы лежат в основной базе, и JOIN на
+    шарде нашёл бы пустые таблицы.
+    """
+    if is_sharded():
+        return queryset.prefetch_related(*fields)
+    return queryset.select_related(*fields)
+
+
+def paginate_posts(request, queryset, per_page):
+    """Страница постов: со всех шардов слиянием потоков по (pub_date, id).
+
+    Каждый шард отдаёт не больше страницы своим range scan'ом, поэтому
+    стоимость страницы растёт с числом шардов, а не с их размером.
+    """
+    if not is_sharded():
+        return paginate(request, queryset, per_page)
+    return paginate(
+        request, [(queryset.using(alias), 'pk') for alias in shards()],
+        per_page, paginator_class=MergedCursorPaginator)
+
+
+def backfill_directory():
+    """Адреса и шарды постов, созданных до включения шардирования."""
+    from .models import AuthorShard, Post, PostLocation
+    for alias in shards():
+        author_ids = Post.objects.using(alias).order_by().values_list(
+            'author_id', flat=True).distinct()
+        AuthorShard.objects.bulk_create(
+            [AuthorShard(user_id=author_id, alias=alias)
+             for author_id in author_ids],
+            batch_size=BATCH_SIZE, ignore_conflicts=True)
+        rows = Post.objects.using(alias).values_list('pk', 'author_id')
+        batch = []
+        for pk, author_id in rows.iterator():
+            batch.append(PostLocation(pk=pk, author_id=author_id))
+            if len(batch) >= BATCH_SIZE:
+                PostLocation.objects.bulk_create(
+                    batch, ignore_conflicts=True)
+                batch = []
+        PostLocation.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+def shard_of(model, instance):
+    """Шард строки model, связанной с instance; None — не шардирована."""
+    label = instance._meta.label_lower
+    # У новой строки _state.db выставляет присваивание связи, например
+    # comment.author = user, и шард по нему не определить.
+    if (label in SHARDED_MODELS and not instance._state.adding
+            and instance._state.db in shards()):
+        return instance._state.db
+    if label == 'posts.post':
+        return shard_for(instance.author_id)
+    if label == 'posts.comment':
+        post_field = instance._meta.get_field('post')
+        if post_field.is_cached(instance):
+            return shard_of(model, instance.post)
+        return post_shard(instance.post_id)
+    if (model._meta.label_lower == 'posts.post'
+            and label == settings.AUTH_USER_MODEL.lower()):
+        # user.posts
+        return shard_for(instance.pk)
+    return None
+
+
+def author_of(instance):
+    """Автор поста или поста комментария."""
+    if instance._meta.label_lower == 'posts.post':
+        return instance.author_id
+    post_field = instance._meta.get_field('post')
+    if post_field.is_cached(instance):
+        return instance.post.author_id
+    from .models import PostLocation
+    return PostLocation.objects.filter(pk=instance.post_id).values_list(
+        'author_id', flat=True).first()
+
+
+def check_writable(instance):
+    """AuthorMoving, если автора строки сейчас переносят."""
+    from .models import AuthorShard
+    author_id = author_of(instance)
+    if AuthorShard.objects.filter(user_id=author_id, moving=True).exists():
+        raise AuthorMoving(f'Посты автора #{author_id} переносятся')
+
+
+class AuthorMovingMiddleware:
+    """Запись во время переноса автора — 503 вместо ошибки сервера."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_exception(self, request, exception):
+        if not isinstance(exception, AuthorMoving):
+            return None
+        response = HttpResponse(
+            'Посты автора переносятся, повторите через минуту.',
+            status=503, content_type='text/plain; charset=utf-8')
+        response['Retry-After'] = RETRY_AFTER
+        return response
+
+
+class ShardRouter:
+    """Направляет Post и Comment на шард автора.
+
+    Запросы без привязки к строке (ленты) идут на шарды явным using():
+    см. paginate_posts и posts.feed.
+    """
+
+    def _route(self, model, **hints):
+        if not is_sharded():
+            return None
+        instance = hints.get('instance')
+        if instance is None:
+            return None
+        if model._meta.label_lower in SHARDED_MODELS:
+            return shard_of(model, instance)
+        if instance._meta.label_lower in SHARDED_MODELS:
+            # Автор, группа, записи лент шардированной строки.
+            return DEFAULT_DB_ALIAS
+        return None
+
+    db_for_read = _route
+
+    def db_for_write(self, model, **hints):
+        alias = self._route(model, **hints)
+        instance = hints.get('instance')
+        if (alias is not None
+                and model._meta.label_lower in SHARDED_MODELS
+                and instance._meta.label_lower in SHARDED_MODELS):
+            check_writable(instance)
+        return alias
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
@@ -0,0 +1,175 @@
+from django.db.models.signals import (
+    post_delete, post_save, pre_delete, pre_save)
+from django.dispatch import receiver
+
+from core import storage
+from core.cache import bump
+
+from . import counters, feed, renditions, sharding, tags
+from .models import (
+    AuthorStats, Comment, FeedEntry, Follow, Group, Post, PostLocation, User)
+
+
+def _bump_post(post, old_group_slug=None, extra=()):
+    scopes = [
+        'posts', f'author:{post.author.username}', f'post:{post.pk}',
+        *extra]
+    if post.group_id:
+        scopes.append(f'group:{post.group.slug}')
+    if old_group_slug:
+        scopes.append(f'group:{old_group_slug}')
+    # Одна область на автора, а не по области на каждого подписчика.
+    scopes.append(f'feed:{post.author_id}')
+    # Карточка есть и в лентах тегов и упоминаний: они зависят от своих
+    # областей, а не от версии поста.
+    scopes.extend(tags.post_scopes(post))
+    bump(*dict.fromkeys(scopes))
+
+
+def _move_image_reference(post, old_name, new_name):
+    """Переносит ссылку поста со старой картинки на новую."""
+    if new_name == old_name:
+        return
+    image_storage = post.image.storage
+    # Файлы с прежними именами не считаются (core.storage).
+    if new_name and image_storage.is_hashed(new_name):
+        storage.add_reference(new_name)
+    if old_name and image_storage.is_hashed(old_name):
+        storage.drop_reference(
+            old_name, image_storage, using=post._state.db)
+
+
+@receiver(post_save, sender=User)
+def create_author_stats(sender, instance, created, raw, **kwargs):
+    # Без строки счётчики посчитались бы с нуля при первом чтении.
+    if created and not raw:
+        AuthorStats.objects.get_or_create(user=instance)
+
+
+@receiver(pre_save, sender=Post)
+def remember_group(sender, instance, **kwargs):
+    instance._old_group_id = instance._old_group_slug = None
+    instance._old_text = instance._old_image = None
+    if instance.pk and not instance._state.adding:
+        # Группы в основной базе, пост может быть на шарде: без JOIN.
+        (instance._old_group_id, instance._old_text,
+         instance._old_image) = Post.objects.using(
+            instance._state.db).filter(pk=instance.pk).values_list(
+                'group_id', 'text', 'image').first() or (None, None, None)
+    if instance.image.name != instance._old_image:
+        # Миниатюры старой картинки новой не подходят.
+        instance.renditions = ''
+    if instance._old_group_id:
+        instance._old_group_slug = Group.objects.filter(
+            pk=instance._old_group_id).values_list('slug', flat=True).first()
+
+
+@receiver(post_save, sender=Post)
+def fan_out_post(sender, instance, created, **kwargs):
+    tag_scopes = ()
+    if created:
+        counters.post_added(instance)
+        feed.push_post(instance)
+        tag_scopes = tags.index_post(instance)
+    else:
+        counters.post_moved(
+            getattr(instance, '_old_group_id', None), instance.group_id)
+        if instance.text != getattr(instance, '_old_text', None):
+            tag_scopes = tags.index_post(instance, created=False)
+    _move_image_reference(
+        instance, getattr(instance, '_old_image', None) or None,
+        instance.image.name or None)
+    if instance.image and not instance.renditions:
+        renditions.schedule(instance)
+    _bump_post(
+        instance, getattr(instance, '_old_group_slug', None), tag_scopes)
+
+
+@receiver(pre_delete, sender=Post)
+def unindex_deleted_post(sender, instance, **kwargs):
+    # До каскада: после него не узнать, в каких лентах тегов был пост.
+    instance._tag_scopes = tags.unindex_post(instance)
+
+
+@receiver(post_delete, sender=Post)
+def invalidate_deleted_post(sender, instance, **kwargs):
+    counters.post_added(instance, -1)
+    if sharding.is_sharded():
+        # Каскад Django удалил строки только в базе самого поста.
+        FeedEntry.objects.filter(post_id=instance.pk).delete()
+        PostLocation.objects.filter(pk=instance.pk).delete()
+    _move_image_reference(instance, instance.image.name or None, None)
+    _bump_post(instance, extra=getattr(instance, '_tag_scopes', ()))
+
+
+def _bump_commented(comment):
+    # Число комментариев есть и на карточках в лентах, а закэшированная
+    # лента зависит только от своих областей, не от версий постов.
+    post = Post.objects.using(comment._state.db).filter(
+        pk=comment.post_id).first()
+    if post is None:
+        # Пост удаляется каскадом: его удаление само поднимет версии.
+        bump(f'post:{comment.post_id}')
+    else:
+        _bump_post(post)
+
+
+@receiver(post_save, sender=Comment)
+def count_comment(sender, instance, created, **kwargs):
+    if created:
+        counters.comment_added(instance)
+    _bump_commented(instance)
+
+
+@receiver(post_delete, sender=Comment)
+def uncount_comment(sender, instance, **kwargs):
+    counters.comment_added(instance, -1)
+    _bump_commented(instance)
+
+
+@receiver(pre_delete, sender=User)
+def delete_sharded_posts(sender, instance, **kwargs):
+    # Каскад основной базы не видит посты и комментарии на шардах.
+    if sharding.is_sharded():
+        for alias in sharding.shards():
+            Comment.objects.using(alias).filter(author=instance).delete()
+            Post.objects.using(alias).filter(author=instance).delete()
+
+
+@receiver(pre_delete, sender=Group)
+def ungroup_sharded_posts(sender, instance, **kwargs):
+    if sharding.is_sharded():
+        for alias in sharding.shards():
+            Post.objects.using(alias).filter(group=instance).update(
+                group=None)
+
+
+@receiver(post_save, sender=Group)
+def invalidate_group(sender, instance, **kwargs):
+    bump(f'group:{instance.slug}')
+
+
+@receiver(post_save, sender=Follow)
+def backfill_feed(sender, instance, created, **kwargs):
+    if created and instance.user_id and instance.author_id:
+        counters.follow_added(instance)
+        if feed.followers_changed(instance.author_id, 1):
+            bump('pulled')
+        feed.backfill(instance.user_id, instance.author_id)
+        # Число подписчиков показано в профиле автора, число подписок —
+        # в профиле читателя.
+        bump(f'follower:{instance.user_id}',
+             f'author:{instance.author.username}',
+             f'author:{instance.user.username}')
+
+
+@receiver(post_delete, sender=Follow)
+def clean_feed(sender, instance, **kwargs):
+    if instance.user_id and instance.author_id:
+        counters.follow_added(instance, -1)
+        feed.drop(instance.user_id, instance.author_id)
+        if feed.followers_changed(instance.author_id, -1):
+            bump('pulled')
+        bump(f'follower:{instance.user_id}',
+             f'author:{instance.author.username}',
+             f'author:{instance.user.username}')
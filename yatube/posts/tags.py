@@ -0,0 +1,131 @@
+"""Хештеги и упоминания: инвертированный индекс по тексту постов.
+
+#тег и @username разбираются при сохранении поста в строки TagEntry и
+Mention с датой публикации поста, поэтому лента тега и лента
+упоминаний читаются range scan'ом по (tag, pub_date) и
+(user, pub_date) — как FeedEntry, без LIKE по текстам. Индекс лежит в
+основной базе; посты при шардировании подгружаются с их шардов
+(feed.entries_page). Посты, написанные до появления индекса,
+разбирает команда index_tags.
+"""
+import re
+
+from core.cache import bump
+
+from .models import Mention, TagEntry, User
+
+TAG_LENGTH = 50
+# Не середина слова, адрес почты, якорь ссылки или &#123;.
+TAG = re.compile(r'(?<![\w#/&])#(\w+)')
+MENTION = re.compile(r'(?<![\w@/])@(\w[\w.+-]*)')
+
+
+def parse_tags(text):
+    return {
+        tag.lower() for tag in TAG.findall(text)
+        if len(tag) <= TAG_LENGTH}
+
+
+def parse_mentions(text):
+    """Имена из @упоминаний; точка в конце — конец предложения."""
+    return {name.rstrip('.') for name in MENTION.findall(text)}
+
+
+def mentioned_ids(text):
+    names = parse_mentions(text)
+    if not names:
+        return set()
+    return set(User.objects.filter(username__in=names).values_list(
+        'pk', flat=True))
+
+
+def _entries(post, tags, user_ids):
+    return (
+        [TagEntry(tag=tag, post_id=post.pk, author_id=post.author_id,
+                  pub_date=post.pub_date) for tag in tags],
+        [Mention(user_id=user_id, post_id=post.pk,
+                 author_id=post.author_id, pub_date=post.pub_date)
+         for user_id in user_ids],
+    )
+
+
+def index_post(post, created=True):
+    """Приводит строки индекса поста к его тексту.
+
+    Возвращает области кэша, которые задело изменение.
+    """
+    tags, user_ids = parse_tags(post.text), mentioned_ids(post.text)
+    old_tags, old_user_ids = set(), set()
+    if not created:
+        old_tags = set(TagEntry.objects.filter(
+            post_id=post.pk).values_list('tag', flat=True))
+        old_user_ids = set(Mention.objects.filter(
+            post_id=post.pk).values_list('user_id', flat=True))
+        if old_tags - tags:
+            TagEntry.objects.filter(
+                post_id=post.pk, tag__in=old_tags - tags).delete()
+        if old_user_ids - user_ids:
+            Mention.objects.filter(
+                post_id=post.pk,
+                user_id__in=old_user_ids - user_ids).delete()
+    new_tags, new_mentions = _entries(
+        post, tags - old_tags, user_ids - old_user_ids)
+    TagEntry.objects.bulk_create(new_tags, ignore_conflicts=True)
+    Mention.objects.bulk_create(new_mentions, ignore_conflicts=True)
+    return scopes(tags ^ old_tags, user_ids ^ old_user_ids)
+
+
+def unindex_post(post):
+    """Убирает пост из индекса; возвращает задетые области кэша."""
+    tags = set(TagEntry.objects.filter(post_id=post.pk).values_list(
+        'tag', flat=True))
+    user_ids = set(Mention.objects.filter(post_id=post.pk).values_list(
+        'user_id', flat=True))
+    TagEntry.objects.filter(post_id=post.pk).delete()
+    Mention.objects.filter(post_id=post.pk).delete()
+    return scopes(tags, user_ids)
+
+
+def post_scopes(post):
+    """Области лент тегов и упоминаний, где сейчас есть пост."""
+    return scopes(parse_tags(post.text), mentioned_ids(post.text))
+
+
+def scopes(tags, user_ids):
+    return (
+        [f'tag:{tag}' for tag in tags]
+        + [f'mentions:{user_id}' for user_id in user_ids])
+
+
+def index_batch(posts):
+    """Переразбирает пачку постов целиком (index_tags)."""
+    posts = list(posts)
+    names = set()
+    for post in posts:
+        names |= parse_mentions(post.text)
+    user_ids = dict(User.objects.filter(username__in=names).values_list(
+        'username', 'pk')) if names else {}
+    post_ids = [post.pk for post in posts]
+    TagEntry.objects.filter(post_id__in=post_ids).delete()
+    Mention.objects.filter(post_id__in=post_ids).delete()
+    tags, mentions = [], []
+    for post in posts:
+        post_tags, post_mentions = _entries(
+            post, parse_tags(post.text),
+            {user_ids[name] for name in parse_mentions(post.text)
+             if name in user_ids})
+        tags.extend(post_tags)
+        mentions.extend(post_mentions)
+    TagEntry.objects.bulk_create(tags, ignore_conflicts=True)
+    Mention.objects.bulk_create(mentions, ignore_conflicts=True)
+    bump(*scopes({entry.tag for entry in tags},
+                 {entry.user_id for entry in mentions}))
+    return len(tags), len(mentions)
+
+
+def tag_entries(tag):
+    return TagEntry.objects.filter(tag=tag.lower())
+
+
+def mention_entries(user):
+    return Mention.objects.filter(user=user)
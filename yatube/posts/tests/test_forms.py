@@ -1,3 +1,4 @@
+import hashlib
 import shutil
 import tempfile
 
@@ -42,6 +43,9 @@ class PostCreateFormTests(TestCase):
             b'\x02\x00\x01\x00\x00\x02\x02\x0C'
             b'\x0A\x00\x3B'
         )
+        # Хранилище называет картинки по sha256 содержимого.
+        digest = hashlib.sha256(cls.small_gif_code).hexdigest()
+        cls.image_name = f'posts/{digest[:2]}/{digest[2:4]}/{digest}.gif'
 
     @classmethod
     def tearDownClass(cls):
@@ -84,7 +88,7 @@ class PostCreateFormTests(TestCase):
                 text='Тестовый текст 2',
                 author=self.user,
                 group=self.group,
-                image='posts/small.gif',
+                image=self.image_name,
             ).exists()
         )
 
@@ -115,7 +119,7 @@ class PostCreateFormTests(TestCase):
                 text='Тестовый текст 2 изменен',
                 author=self.user,
                 group=self.group,
-                image='posts/small2.gif',
+                image=self.image_name,
             ).exists()
         )
 
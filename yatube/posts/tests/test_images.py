@@ -0,0 +1,74 @@
+from io import BytesIO
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, override_settings
+from PIL import Image
+
+from posts.forms import PostForm
+
+
+def upload(size, format_='JPEG', mode='RGB', name='photo.jpg', **options):
+    content = BytesIO()
+    Image.new(mode, size).save(content, format_, **options)
+    return SimpleUploadedFile(name, content.getvalue())
+
+
+class ImageUploadTests(SimpleTestCase):
+
+    def clean(self, image):
+        form = PostForm(data={'text': 'Текст'}, files={'image': image})
+        form.is_valid()
+        return form
+
+    def test_small_image_kept(self):
+        """Картинка в пределах лимитов сохраняется как есть"""
+        image = upload((800, 600))
+        form = self.clean(image)
+        self.assertEqual(form.errors, {})
+        self.assertIs(form.cleaned_data['image'], image)
+
+    @override_settings(POST_IMAGE_MAX_SIDE=1000)
+    def test_oversized_image_downsized(self):
+        """Большая картинка уменьшается до MAX_SIDE с теми же пропорциями"""
+        form = self.clean(upload((3000, 1500)))
+        self.assertEqual(form.errors, {})
+        saved = form.cleaned_data['image']
+        self.assertEqual(saved.name, 'photo.jpg')
+        with Image.open(saved) as image:
+            self.assertEqual((image.format, image.size), ('JPEG', (1000, 500)))
+
+    @override_settings(POST_IMAGE_MAX_SIDE=1000)
+    def test_downsized_image_keeps_orientation(self):
+        """Уменьшенный снимок с EXIF Orientation повёрнут заранее"""
+        exif = Image.Exif()
+        # Orientation = 6: показывать повёрнутым на 90° по часовой.
+        exif[0x0112] = 6
+        form = self.clean(upload((3000, 1500), exif=exif.tobytes()))
+        self.assertEqual(form.errors, {})
+        with Image.open(form.cleaned_data['image']) as image:
+            self.assertEqual(image.size, (500, 1000))
+            self.assertNotIn(0x0112, image.getexif())
+
+    @override_settings(POST_IMAGE_MAX_PIXELS=1000000)
+    def test_pixel_bomb_rejected(self):
+        """Картинка с лишними пикселями отклоняется до декодирования"""
+        # 25 Мп одноцветного PNG сжимаются в несколько килобайт.
+        image = upload((5000, 5000), 'PNG', mode='1', name='bomb.png')
+        self.assertLess(image.size, 100 * 1024)
+        form = self.clean(image)
+        self.assertEqual(
+            form.errors.as_data()['image'][0].code, 'too_many_pixels')
+
+    @override_settings(POST_IMAGE_MAX_BYTES=1024)
+    def test_large_file_rejected(self):
+        """Файл больше лимита отклоняется"""
+        content = BytesIO()
+        Image.effect_noise((400, 400), 100).save(content, 'PNG')
+        form = self.clean(SimpleUploadedFile('noise.png', content.getvalue()))
+        self.assertEqual(
+            form.errors.as_data()['image'][0].code, 'file_too_large')
+
+    def test_not_an_image_rejected(self):
+        """Не картинка отклоняется"""
+        form = self.clean(SimpleUploadedFile('photo.jpg', b'not an image'))
+        self.assertIn('image', form.errors)
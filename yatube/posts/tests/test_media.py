@@ -0,0 +1,288 @@
+import hashlib
+import os
+import shutil
+import tempfile
+from collections import Counter
+from io import StringIO
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import transaction
+from django.test import TransactionTestCase, override_settings
+from sorl.thumbnail import default, get_thumbnail
+from sorl.thumbnail.images import ImageFile
+
+from core.models import Checkpoint, StoredFile
+from posts import media_gc, renditions
+from posts.management.commands import recount_media, shard_media
+from posts.models import Post
+
+User = get_user_model()
+TEMP_MEDIA_ROOT = tempfile.mkdtemp(dir=settings.BASE_DIR)
+SMALL_GIF = (
+    b'\x47\x49\x46\x38\x39\x61\x02\x00'
+    b'\x01\x00\x80\x00\x00\x00\x00\x00'
+    b'\xFF\xFF\xFF\x21\xF9\x04\x00\x00'
+    b'\x00\x00\x00\x2C\x00\x00\x00\x00'
+    b'\x02\x00\x01\x00\x00\x02\x02\x0C'
+    b'\x0A\x00\x3B'
+)
+OTHER_GIF = SMALL_GIF.replace(b'\xFF\xFF\xFF', b'\x00\xFF\x00')
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT, RENDITIONS_ASYNC=True)
+class ContentAddressedStorageTests(TransactionTestCase):
+    databases = {'default', 'shard1'}
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+
+    def setUp(self):
+        cache.clear()
+        # Свой MEDIA_ROOT на тест: файлы проверяются по содержимому папки.
+        self.media_root = tempfile.mkdtemp(dir=TEMP_MEDIA_ROOT)
+        media = self.settings(MEDIA_ROOT=self.media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.author = User.objects.create_user(username='author')
+        digest = hashlib.sha256(SMALL_GIF).hexdigest()
+        self.name = f'posts/{digest[:2]}/{digest[2:4]}/{digest}.gif'
+
+    def create_post(self, name='small.gif', content=SMALL_GIF):
+        return Post.objects.create(
+            text='Пост с картинкой', author=self.author,
+            image=SimpleUploadedFile(name, content, 'image/gif'))
+
+    def path(self, name):
+        return os.path.join(self.media_root, name)
+
+    def references(self, name):
+        stored = StoredFile.objects.filter(name=name).first()
+        return stored.references if stored else None
+
+    def test_same_content_stored_once(self):
+        """Одинаковые картинки с разными именами — один файл"""
+        first = self.create_post('first.gif')
+        second = self.create_post('second.GIF')
+        self.assertEqual(first.image.name, self.name)
+        self.assertEqual(second.image.name, self.name)
+        self.assertEqual(
+            os.listdir(self.path(os.path.dirname(self.name))),
+            [os.path.basename(self.name)])
+        self.assertEqual(self.references(self.name), 2)
+
+    def test_file_deleted_with_last_reference(self):
+        """Файл удаляется с последним постом, который на него ссылается"""
+        first, second = self.create_post(), self.create_post()
+        first.delete()
+        self.assertTrue(os.path.exists(self.path(self.name)))
+        self.assertEqual(self.references(self.name), 1)
+        second.delete()
+        self.assertFalse(os.path.exists(self.path(self.name)))
+        self.assertIsNone(self.references(self.name))
+
+    def test_replaced_image_released(self):
+        """Замена картинки снимает ссылку на прежнюю"""
+        post = self.create_post()
+        post.image = SimpleUploadedFile('other.gif', OTHER_GIF, 'image/gif')
+        post.save()
+        self.assertFalse(os.path.exists(self.path(self.name)))
+        self.assertTrue(os.path.exists(self.path(post.image.name)))
+        self.assertEqual(self.references(post.image.name), 1)
+
+    def test_reused_file_reserved(self):
+        """Уже лежащий файл без ссылок получает ссылку и свежее время"""
+        post = self.create_post()
+        Post.objects.filter(pk=post.pk).update(image='')
+        StoredFile.objects.filter(name=self.name).update(references=0)
+        os.utime(self.path(self.name), (0, 0))
+        self.create_post('again.gif')
+        self.assertGreater(os.path.getmtime(self.path(self.name)), 0)
+        self.assertEqual(self.references(self.name), 1)
+
+    def test_rolled_back_upload_not_counted(self):
+        """Откат загрузки снимает и временную ссылку"""
+        self.create_post()
+        with self.assertRaises(RuntimeError), transaction.atomic():
+            self.create_post('again.gif')
+            self.assertEqual(self.references(self.name), 3)
+            raise RuntimeError
+        self.assertEqual(self.references(self.name), 1)
+        self.assertTrue(os.path.exists(self.path(self.name)))
+
+    @override_settings(POST_SHARDS=['default', 'shard1'])
+    def test_reservation_held_until_shard_commit(self):
+        """Временная ссылка живёт до коммита транзакции шарда"""
+        storage = self.create_post().image.storage
+        with transaction.atomic(using='shard1'):
+            storage.save('posts/again.gif', ContentFile(SMALL_GIF))
+            self.assertEqual(self.references(self.name), 2)
+        self.assertEqual(self.references(self.name), 1)
+
+    def test_legacy_name_not_counted(self):
+        """Файлы с прежними именами не считаются и не удаляются"""
+        post = self.create_post()
+        os.rename(self.path(self.name), self.path('posts/small.gif'))
+        Post.objects.filter(pk=post.pk).update(image='posts/small.gif')
+        StoredFile.objects.all().delete()
+        Post.objects.get(pk=post.pk).delete()
+        self.assertTrue(os.path.exists(self.path('posts/small.gif')))
+        self.assertFalse(StoredFile.objects.exists())
+
+    def test_recount_media(self):
+        """recount_media чинит счётчики, разошедшиеся с постами"""
+        self.create_post(), self.create_post()
+        StoredFile.objects.update(references=5)
+        StoredFile.objects.create(
+            name='posts/' + 'a' * 64 + '.gif', references=3)
+        out = StringIO()
+        call_command('recount_media', dry_run=True, stdout=out)
+        self.assertIn('Расхождений найдено: 2', out.getvalue())
+        self.assertEqual(self.references(self.name), 5)
+        other = self.create_post('other.gif', OTHER_GIF).image.name
+        StoredFile.objects.filter(name=other).delete()
+        # Пачки по одной строке: расхождения ищутся в каждой.
+        with mock.patch.object(recount_media, 'BATCH_SIZE', 1):
+            call_command('recount_media', stdout=StringIO())
+        self.assertEqual(self.references(self.name), 2)
+        self.assertEqual(self.references(other), 1)
+        self.assertEqual(
+            self.references('posts/' + 'a' * 64 + '.gif'), 0)
+
+    def test_shard_media(self):
+        """shard_media переносит старые файлы в подпапки по хешу"""
+        legacy, flat = self.create_post(), self.create_post(
+            'other.gif', OTHER_GIF)
+        flat_name = 'posts/' + os.path.basename(flat.image.name)
+        os.rename(self.path(self.name), self.path('posts/small.gif'))
+        os.rename(self.path(flat.image.name), self.path(flat_name))
+        Post.objects.filter(pk=legacy.pk).update(
+            image='posts/small.gif', renditions='{"card": {}}')
+        Post.objects.filter(pk=flat.pk).update(image=flat_name)
+        StoredFile.objects.filter(name=self.name).delete()
+        StoredFile.objects.filter(name=flat.image.name).update(name=flat_name)
+        call_command('shard_media', batch_size=1, stdout=StringIO())
+        legacy.refresh_from_db()
+        self.assertEqual(legacy.image.name, self.name)
+        self.assertEqual(legacy.renditions, '{"card": {}}')
+        self.assertEqual(flat.image.name, Post.objects.get(
+            pk=flat.pk).image.name)
+        for name in (self.name, flat.image.name):
+            self.assertTrue(os.path.exists(self.path(name)))
+            self.assertEqual(self.references(name), 1)
+        for name in ('posts/small.gif', flat_name):
+            self.assertFalse(os.path.exists(self.path(name)))
+        self.assertIsNone(self.references(flat_name))
+        out = StringIO()
+        call_command('shard_media', stdout=out)
+        self.assertIn(f'продолжаем после поста #{flat.pk}', out.getvalue())
+        call_command('shard_media', restart=True, stdout=out)
+        self.assertIn('готово, перенесено 0', out.getvalue())
+
+    def test_shard_media_keeps_shared_legacy_file(self):
+        """Прежний файл двух постов удаляется после переноса обоих"""
+        first = self.create_post()
+        self.create_post()
+        os.rename(self.path(self.name), self.path('posts/small.gif'))
+        Post.objects.update(image='posts/small.gif')
+        StoredFile.objects.all().delete()
+        command = shard_media.Command(stdout=StringIO())
+        command.storage = first.image.storage
+        command.upload_to = 'posts/'
+        checkpoint = Checkpoint.objects.create(name='test')
+        batch = [Post.objects.get(pk=first.pk)]
+        command.rewrite(
+            'default', batch, command.copy(batch, Counter()), checkpoint)
+        self.assertTrue(os.path.exists(self.path('posts/small.gif')))
+        call_command('shard_media', stdout=StringIO())
+        self.assertFalse(os.path.exists(self.path('posts/small.gif')))
+        self.assertEqual(
+            set(Post.objects.values_list('image', flat=True)), {self.name})
+        self.assertEqual(self.references(self.name), 2)
+
+    def test_shard_media_keeps_renditions(self):
+        """Миниатюры перенесённой картинки остаются живыми для сборки"""
+        post = self.create_post()
+        os.rename(self.path(self.name), self.path('posts/small.gif'))
+        Post.objects.filter(pk=post.pk).update(image='posts/small.gif')
+        StoredFile.objects.all().delete()
+        renditions.render(post.pk, 'default')
+        post.refresh_from_db()
+        url = post.card_image['url']
+        call_command('shard_media', stdout=StringIO())
+        call_command('collect_media', min_age=0, rate=0, stdout=StringIO())
+        self.assertTrue(os.path.exists(self.path(url.split('/media/')[1])))
+        post.refresh_from_db()
+        self.assertEqual(post.card_image['url'], url)
+
+    def test_collect_media(self):
+        """collect_media удаляет файлы и записи kvstore без ссылок"""
+        live, gone = self.create_post(), self.create_post(
+            'other.gif', OTHER_GIF)
+        live_thumbnail = get_thumbnail(live.image, '1x1')
+        gone_thumbnail = get_thumbnail(gone.image, '1x1')
+        # Ссылку сняли в обход сигналов: файлы остались без владельца.
+        Post.objects.filter(pk=gone.pk).update(image='')
+        StoredFile.objects.filter(name=gone.image.name).delete()
+        stray = default.storage.save('cache/00/00/stray.jpg', ContentFile(
+            b'stray'))
+        out = StringIO()
+        call_command(
+            'collect_media', dry_run=True, min_age=0, rate=0, stdout=out)
+        self.assertIn('Файлов найдено: 3, записей kvstore: 3', out.getvalue())
+        self.assertTrue(os.path.exists(self.path(stray)))
+        call_command('collect_media', min_age=0, rate=0, stdout=out)
+        for name in (gone.image.name, gone_thumbnail.name, stray):
+            self.assertFalse(os.path.exists(self.path(name)))
+        self.assertIsNone(default.kvstore.get(
+            ImageFile(gone.image.name, gone.image.storage)))
+        for name in (live.image.name, live_thumbnail.name):
+            self.assertTrue(os.path.exists(self.path(name)))
+        self.assertIsNotNone(default.kvstore.get(live_thumbnail))
+        call_command(
+            'collect_media', dry_run=True, min_age=0, rate=0, stdout=out)
+        self.assertIn('Файлов найдено: 0, записей kvstore: 0', out.getvalue())
+
+    def test_collect_media_drops_unused_thumbnails(self):
+        """Миниатюры живого поста, которых нет в renditions, — мусор"""
+        post = self.create_post()
+        legacy = get_thumbnail(post.image, renditions.LEGACY[0], **dict(
+            renditions.LEGACY[1]))
+        renditions.render(post.pk, 'default')
+        post.refresh_from_db()
+        url = post.card_image['url']
+        call_command('collect_media', min_age=0, rate=0, stdout=StringIO())
+        self.assertFalse(os.path.exists(self.path(legacy.name)))
+        self.assertIsNone(default.kvstore.get(legacy))
+        self.assertTrue(os.path.exists(self.path(url.split('/media/')[1])))
+        source = ImageFile(post.image.name, post.image.storage)
+        self.assertNotIn(legacy.key, default.kvstore._get(
+            source.key, identity='thumbnails'))
+
+    def test_collect_media_keeps_reuploaded_file(self):
+        """Старый файл без поста, но снова загруженный, не удаляется"""
+        post = self.create_post()
+        Post.objects.filter(pk=post.pk).update(image='')
+        StoredFile.objects.filter(name=self.name).update(references=1)
+        os.utime(self.path(self.name), (0, 0))
+        # Ссылку взяли уже после проверки постов.
+        with mock.patch.object(media_gc, 'referenced', return_value=set()):
+            call_command(
+                'collect_media', min_age=0, rate=0, stdout=StringIO())
+        self.assertTrue(os.path.exists(self.path(self.name)))
+        self.assertEqual(self.references(self.name), 1)
+
+    def test_collect_media_skips_fresh_files(self):
+        """Только что загруженные файлы без поста не удаляются"""
+        post = self.create_post()
+        Post.objects.filter(pk=post.pk).update(image='')
+        StoredFile.objects.all().delete()
+        call_command('collect_media', rate=0, stdout=StringIO())
+        self.assertTrue(os.path.exists(self.path(self.name)))
@@ -1,7 +1,11 @@
+from io import StringIO
+
 from django.contrib.auth import get_user_model
+from django.core.management import call_command
 from django.test import TestCase
 
-from ..models import Group, Post
+from ..counters import author_stats
+from ..models import AuthorStats, Comment, Follow, Group, Post
 
 User = get_user_model()
 
@@ -42,3 +46,70 @@ class PostModelTest(TestCase):
             with self.subTest(field=field):
                 self.assertEqual(
                     post._meta.get_field(field).verbose_name, expected_value)
+
+
+class CountersTest(TestCase):
+    def setUp(self):
+        self.author = User.objects.create_user(username='author')
+        self.reader = User.objects.create_user(username='reader')
+        self.group = Group.objects.create(
+            title='Группа', slug='group', description='Описание')
+        self.other_group = Group.objects.create(
+            title='Другая', slug='other', description='Описание')
+        self.post = Post.objects.create(
+            author=self.author, text='Пост', group=self.group)
+
+    def counts(self):
+        stats = AuthorStats.objects.filter(user=self.author).values_list(
+            'posts_count', 'followers_count').first()
+        return (
+            stats,
+            Group.objects.get(pk=self.group.pk).posts_count,
+            Group.objects.get(pk=self.other_group.pk).posts_count,
+            Post.objects.get(pk=self.post.pk).comments_count,
+        )
+
+    def test_counters_follow_changes(self):
+        """Счётчики меняются при создании, переносе и удалении"""
+        author = User.objects.get(pk=self.author.pk)
+        self.assertEqual(author_stats(author).posts_count, 1)
+        Follow.objects.create(user=self.reader, author=self.author)
+        Comment.objects.create(
+            post=self.post, author=self.reader, text='Комментарий')
+        self.assertEqual(self.counts(), ((1, 1), 1, 0, 1))
+        self.post.group = self.other_group
+        self.post.save()
+        self.assertEqual(self.counts(), ((1, 1), 0, 1, 1))
+        Post.objects.create(author=self.author, text='Ещё', group=self.group)
+        Follow.objects.all().delete()
+        self.assertEqual(self.counts(), ((2, 0), 1, 1, 1))
+        self.post.delete()
+        self.assertEqual(AuthorStats.objects.get(
+            user=self.author).posts_count, 1)
+
+    def test_save_keeps_counters(self):
+        """save() устаревшего объекта не затирает счётчик комментариев"""
+        post = Post.objects.get(pk=self.post.pk)
+        Comment.objects.create(
+            post=self.post, author=self.reader, text='Комментарий')
+        post.text = 'Исправленный пост'
+        post.save()
+        post.refresh_from_db()
+        self.assertEqual(post.text, 'Исправленный пост')
+        self.assertEqual(post.comments_count, 1)
+
+    def test_recount_repairs_drift(self):
+        """recount находит и чинит расхождения"""
+        AuthorStats.objects.filter(user=self.reader).delete()
+        Post.objects.filter(pk=self.post.pk).update(comments_count=5)
+        AuthorStats.objects.filter(user=self.author).update(posts_count=0)
+        out = StringIO()
+        call_command('recount', '--dry-run', stdout=out)
+        self.assertIn('comments_count = 5, должно быть 0', out.getvalue())
+        self.assertEqual(self.counts()[3], 5)
+        call_command('recount', stdout=StringIO())
+        self.assertEqual(self.counts(), ((1, 0), 1, 0, 0))
+        self.assertTrue(AuthorStats.objects.filter(user=self.reader).exists())
+        out = StringIO()
+        call_command('recount', '--dry-run', stdout=out)
+        self.assertIn('Расхождений найдено: 0', out.getvalue())
@@ -0,0 +1,225 @@
+import shutil
+import tempfile
+from io import BytesIO, StringIO
+from unittest import mock, skipUnless
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from PIL import Image, features
+from sorl.thumbnail import get_thumbnail
+from sorl.thumbnail.models import KVStore
+
+from posts import renditions
+from posts.models import Post, RenditionJob
+
+User = get_user_model()
+TEMP_MEDIA_ROOT = tempfile.mkdtemp(dir=settings.BASE_DIR)
+SMALL_GIF = (
+    b'\x47\x49\x46\x38\x39\x61\x02\x00'
+    b'\x01\x00\x80\x00\x00\x00\x00\x00'
+    b'\xFF\xFF\xFF\x21\xF9\x04\x00\x00'
+    b'\x00\x00\x00\x2C\x00\x00\x00\x00'
+    b'\x02\x00\x01\x00\x00\x02\x02\x0C'
+    b'\x0A\x00\x3B'
+)
+
+
+@override_settings(MEDIA_ROOT=TEMP_MEDIA_ROOT, RENDITIONS_ASYNC=False)
+class RenditionsTests(TransactionTestCase):
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(TEMP_MEDIA_ROOT, ignore_errors=True)
+
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create_user(username='author')
+        self.client.force_login(self.author)
+
+    def upload(self, name):
+        return SimpleUploadedFile(name, SMALL_GIF, content_type='image/gif')
+
+    def upload_photo(self, name, size=(2400, 1300)):
+        content = BytesIO()
+        Image.new('RGB', size, (200, 100, 50)).save(content, 'JPEG')
+        return SimpleUploadedFile(
+            name, content.getvalue(), content_type='image/jpeg')
+
+    def create_post(self, **data):
+        self.client.post(reverse('posts:post_create'), {
+            'text': 'Пост с картинкой', 'image': self.upload('small.gif'),
+            **data})
+        return Post.objects.get()
+
+    def test_renditions_stored_on_save(self):
+        """Миниатюры всех ширин сохраняются сразу после коммита"""
+        post = self.create_post(image=self.upload_photo('photo.jpg'))
+        image = post.card_image
+        self.assertEqual((image['width'], image['height']), (960, 496))
+        self.assertIn('/cache/', image['url'])
+        self.assertEqual(
+            [candidate.split()[-1]
+             for candidate in image['srcset']['jpeg'].split(', ')],
+            ['480w', '960w', '1980w'])
+
+    def test_small_image_is_not_upscaled(self):
+        """Маленькая картинка не увеличивается и не дублируется"""
+        image = self.create_post().card_image
+        self.assertEqual((image['width'], image['height']), (2, 1))
+        self.assertEqual(image['srcset']['jpeg'], f'{image["url"]} 2w')
+
+    def test_responsive_markup(self):
+        """Карточка отдаёт srcset, sizes и ленивую загрузку"""
+        post = self.create_post(image=self.upload_photo('photo.jpg'))
+        response = self.client.get(reverse('posts:index'))
+        self.assertContains(
+            response, f'srcset="{post.card_image["srcset"]["jpeg"]}"')
+        self.assertContains(response, 'sizes="(min-width: 768px)')
+        self.assertContains(response, 'loading="lazy"')
+
+    @skipUnless(features.check('webp'), 'Pillow собран без WebP')
+    def test_webp_source(self):
+        """WebP отдаётся отдельным <source> той же картинки"""
+        post = self.create_post(image=self.upload_photo('photo.jpg'))
+        srcset = post.card_image['srcset']['webp']
+        self.assertEqual(srcset.count('.webp '), 3)
+        response = self.client.get(reverse('posts:index'))
+        self.assertContains(response, 'type="image/webp"')
+
+    def test_pages_skip_thumbnail_store(self):
+        """Страницы с картинками не читают kvstore sorl"""
+        post = self.create_post()
+        for url in (reverse('posts:index'),
+                    reverse('posts:post_detail', args=[post.pk])):
+            with self.subTest(url=url):
+                cache.clear()
+                with CaptureQueriesContext(connection) as context:
+                    response = self.client.get(url)
+                self.assertContains(response, post.card_image['url'])
+                self.assertFalse(any(
+                    'thumbnail_kvstore' in query['sql']
+                    for query in context.captured_queries))
+
+    def test_new_image_replaces_renditions(self):
+        """Новая картинка получает свои миниатюры"""
+        post = self.create_post()
+        old_url = post.card_image['url']
+        self.client.post(reverse('posts:post_edit', args=[post.pk]), {
+            'text': 'Правка', 'image': self.upload_photo('other.jpg')})
+        post.refresh_from_db()
+        self.assertNotEqual(post.card_image['url'], old_url)
+        self.client.post(
+            reverse('posts:post_edit', args=[post.pk]), {'text': 'Ещё'})
+        post.refresh_from_db()
+        self.assertEqual(post.text, 'Ещё')
+        self.assertIsNotNone(post.card_image)
+
+    @override_settings(RENDITIONS_ASYNC=True)
+    def test_background_worker(self):
+        """renditions_worker делает миниатюры по очереди заданий"""
+        post = self.create_post()
+        self.assertIsNone(post.card_image)
+        self.assertTrue(
+            RenditionJob.objects.filter(post_id=post.pk).exists())
+        call_command('renditions_worker', once=True, stdout=StringIO())
+        post.refresh_from_db()
+        self.assertIsNotNone(post.card_image)
+        self.assertFalse(RenditionJob.objects.exists())
+
+    @override_settings(RENDITIONS_ASYNC=True)
+    def test_image_replaced_during_render(self):
+        """Картинка, заменённая во время работы worker'а, не теряется"""
+        post = self.create_post()
+        make = renditions.make
+
+        def make_and_replace(image):
+            result = make(image)
+            self.client.post(reverse('posts:post_edit', args=[post.pk]), {
+                'text': 'Правка', 'image': self.upload_photo('other.jpg')})
+            return result
+
+        with mock.patch.object(renditions, 'make', make_and_replace):
+            renditions.run_jobs(10)
+        post.refresh_from_db()
+        self.assertIsNone(post.card_image)
+        self.assertTrue(
+            RenditionJob.objects.filter(post_id=post.pk).exists())
+        renditions.run_jobs(10)
+        post.refresh_from_db()
+        self.assertIsNotNone(post.card_image)
+
+    def test_make_renditions_command(self):
+        """make_renditions доделывает миниатюры старых постов"""
+        post = self.create_post()
+        Post.objects.filter(pk=post.pk).update(renditions='')
+        out = StringIO()
+        call_command('make_renditions', stdout=out)
+        self.assertIn('сделано для постов: 1', out.getvalue())
+        post.refresh_from_db()
+        self.assertIsNotNone(post.card_image)
+
+    def test_prefetch_reads_store_once_per_page(self):
+        """Готовые миниатюры sorl страницы читаются одним запросом"""
+        for index in range(3):
+            self.client.post(reverse('posts:post_create'), {
+                'text': f'Пост {index}',
+                'image': self.upload(f'small{index}.gif')})
+        for post in Post.objects.all():
+            for _, _, geometry, options in renditions.variants():
+                get_thumbnail(post.image, geometry, **options)
+        Post.objects.update(renditions='')
+        cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('posts:index'))
+        queries = [
+            query['sql'] for query in context.captured_queries
+            if 'thumbnail_kvstore' in query['sql']]
+        self.assertEqual(len(queries), 1)
+        for post in response.context['page_obj']:
+            self.assertIn('/cache/', post.card_image['url'])
+
+    def test_prefetch_caches_misses(self):
+        """Промахи kvstore кэшируются: повторный prefetch не ходит в базу"""
+        self.create_post()
+        Post.objects.update(renditions='')
+        KVStore.objects.all().delete()
+        cache.clear()
+        for expected in (1, 0):
+            posts = list(Post.objects.all())
+            with CaptureQueriesContext(connection) as context:
+                renditions.prefetch(posts)
+            self.assertEqual(len(context.captured_queries), expected)
+            self.assertEqual(posts[0].prefetched_renditions, {})
+
+    def test_prefetch_falls_back_to_legacy(self):
+        """У старого поста карточка берёт прежнюю миниатюру sorl"""
+        post = self.create_post(image=self.upload_photo('photo.jpg'))
+        KVStore.objects.all().delete()
+        cache.clear()
+        geometry, options = renditions.LEGACY
+        legacy = get_thumbnail(post.image, geometry, **options)
+        Post.objects.update(renditions='')
+        response = self.client.get(reverse('posts:index'))
+        card = response.context['page_obj'][0].card_image
+        self.assertEqual(card['url'], legacy.url)
+        self.assertEqual(card['srcset'], {'jpeg': f'{legacy.url} 1980w'})
+
+    def test_image_report(self):
+        """image_report сравнивает прежнюю миниатюру с новыми"""
+        media_root = tempfile.mkdtemp(dir=TEMP_MEDIA_ROOT)
+        with self.settings(MEDIA_ROOT=media_root):
+            self.create_post(image=self.upload_photo('photo.jpg'))
+            out = StringIO()
+            call_command('image_report', stdout=out)
+        report = out.getvalue()
+        self.assertIn('images: 1, unreadable: 0', report)
+        for label in ('legacy', '480w jpeg', '1980w jpeg'):
+            self.assertIn(label, report)
@@ -0,0 +1,102 @@
+from io import StringIO
+from unittest import mock
+from urllib.parse import urlencode
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase
+from django.urls import reverse
+
+from posts.admin import PostAdmin
+from posts.models import Post
+
+User = get_user_model()
+
+
+class SearchTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create_user(username='author')
+        self.sea = Post.objects.create(
+            author=self.author, text='Море, море и снова Море')
+        self.river = Post.objects.create(
+            author=self.author, text='Река впадает в море')
+        Post.objects.create(author=self.author, text='Лес и горы')
+
+    def found(self, query, **params):
+        response = self.client.get(
+            reverse('posts:search'), {'q': query, **params})
+        self.assertEqual(response.status_code, 200)
+        return response, list(response.context['page_obj'])
+
+    def test_ranked_results(self):
+        """Поиск находит посты без учёта регистра и ранжирует их"""
+        self.assertEqual(self.found('МОРЕ')[1], [self.sea, self.river])
+        self.assertEqual(self.found('впада')[1], [self.river])
+        self.assertEqual(self.found('пустыня')[1], [])
+
+    def test_index_follows_edits(self):
+        """Индекс обновляется при правке и удалении поста"""
+        self.river.text = 'Река впадает в озеро'
+        self.river.save()
+        self.assertEqual(self.found('море')[1], [self.sea])
+        self.assertEqual(self.found('озеро')[1], [self.river])
+        self.sea.delete()
+        self.assertEqual(self.found('море')[1], [])
+
+    def test_cursor_pagination(self):
+        """Курсор листает результаты без повторов и пропусков"""
+        Post.objects.bulk_create(
+            Post(author=self.author, text=f'Дорога {index}')
+            for index in range(15))
+        response, first = self.found('дорога')
+        cursor = response.context['page_obj'].paginator.next_cursor
+        self.assertEqual(len(first), 10)
+        query = urlencode({'q': 'дорога'})
+        self.assertContains(response, f'href="?{query}&amp;cursor={cursor}"')
+        self.assertNotContains(response, 'Последняя')
+        response, second = self.found('дорога', cursor=cursor)
+        self.assertEqual(len(second), 5)
+        self.assertFalse(response.context['page_obj'].has_next())
+        self.assertContains(response, f'href="?{query}">Первая')
+        self.assertNotContains(response, 'Предыдущая')
+        self.assertEqual(len(set(first + second)), 15)
+
+    def test_query_syntax_is_escaped(self):
+        """Операторы FTS5 во вводе не ломают поиск"""
+        for query in ('"море', 'море OR лес', 'NEAR(море', '*', '^море'):
+            with self.subTest(query=query):
+                self.found(query)
+
+    def test_admin_search(self):
+        """Поиск в админке идёт по индексу"""
+        admin = User.objects.create_superuser(
+            'admin', 'admin@example.com', 'password')
+        self.client.force_login(admin)
+        response = self.client.get(
+            reverse('admin:posts_post_changelist'), {'q': 'река'})
+        self.assertEqual(
+            list(response.context['cl'].result_list), [self.river])
+
+    def test_admin_search_reports_limit(self):
+        """Админка предупреждает, что совпадения обрезаны"""
+        admin = User.objects.create_superuser(
+            'admin', 'admin@example.com', 'password')
+        self.client.force_login(admin)
+        url = reverse('admin:posts_post_changelist')
+        with mock.patch.object(PostAdmin, 'search_limit', 1):
+            response = self.client.get(url, {'q': 'море'})
+        self.assertEqual(len(response.context['cl'].result_list), 1)
+        self.assertContains(response, 'Показаны 1 лучших совпадений')
+        response = self.client.get(url, {'q': 'море'})
+        self.assertEqual(len(response.context['cl'].result_list), 2)
+        self.assertNotContains(response, 'лучших совпадений')
+
+    def test_reindex_command(self):
+        """reindex_search пересобирает индекс"""
+        out = StringIO()
+        call_command('reindex_search', stdout=out)
+        self.assertIn('проиндексировано постов: 3', out.getvalue())
+        self.assertEqual(self.found('лес')[1][0].text, 'Лес и горы')
@@ -0,0 +1,175 @@
+from io import StringIO
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TransactionTestCase, override_settings
+from django.urls import reverse
+
+from posts.management.commands import rebalance_shards
+from posts.models import (
+    AuthorShard, Comment, FeedEntry, Follow, Group, Post, PostLocation)
+
+User = get_user_model()
+
+
+@override_settings(POST_SHARDS=['default', 'shard1'])
+class ShardingTests(TransactionTestCase):
+    databases = {'default', 'shard1'}
+
+    def setUp(self):
+        cache.clear()
+        self.group = Group.objects.create(
+            title='Группа', slug='group', description='Описание')
+        self.near = User.objects.create_user(username='near')
+        self.far = User.objects.create_user(username='far')
+        AuthorShard.objects.create(user=self.near, alias='default')
+        AuthorShard.objects.create(user=self.far, alias='shard1')
+        self.posts = [
+            Post.objects.create(
+                author=author, group=self.group, text=f'Пост {index}')
+            for index, author in enumerate(
+                [self.near, self.far, self.near, self.far])]
+        self.reader = User.objects.create_user(username='reader')
+        self.client.force_login(self.reader)
+
+    def shard_posts(self, alias, author):
+        return list(Post.objects.using(alias).filter(author=author))
+
+    def page_texts(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return [post.text for post in response.context['page_obj']]
+
+    def test_posts_live_on_author_shard(self):
+        """Посты лежат на шарде автора, id уникальны на всех шардах"""
+        self.assertEqual(len(self.shard_posts('default', self.near)), 2)
+        self.assertEqual(len(self.shard_posts('shard1', self.far)), 2)
+        self.assertEqual(self.shard_posts('default', self.far), [])
+        ids = [post.pk for post in self.posts]
+        self.assertEqual(len(set(ids)), len(ids))
+        self.assertEqual(
+            PostLocation.objects.filter(pk__in=ids).count(), len(ids))
+
+    def test_feeds_merge_shards(self):
+        """Главная и группа собираются со всех шардов по дате"""
+        expected = [post.text for post in reversed(self.posts)]
+        self.assertEqual(self.page_texts(reverse('posts:index')), expected)
+        self.assertEqual(
+            self.page_texts(reverse('posts:group_list', args=['group'])),
+            expected)
+
+    def test_follow_feed_reads_entries_from_shards(self):
+        """Лента подписок подгружает посты записей с их шардов"""
+        Follow.objects.create(user=self.reader, author=self.near)
+        Follow.objects.create(user=self.reader, author=self.far)
+        self.assertEqual(
+            self.page_texts(reverse('posts:follow_index')),
+            [post.text for post in reversed(self.posts)])
+
+    def test_routed_views(self):
+        """Профиль, пост, комментарий и правка идут на шард автора"""
+        post = self.posts[1]
+        self.assertEqual(
+            self.page_texts(reverse('posts:profile', args=['far'])),
+            ['Пост 3', 'Пост 1'])
+        self.client.post(
+            reverse('posts:add_comment', args=[post.pk]),
+            {'text': 'Комментарий'})
+        comment = Comment.objects.using('shard1').get()
+        self.assertEqual(comment.post_id, post.pk)
+        self.assertEqual(
+            Post.objects.using('shard1').get(pk=post.pk).comments_count, 1)
+        response = self.client.get(
+            reverse('posts:post_detail', args=[post.pk]))
+        self.assertEqual(response.context['posts'], post)
+        self.assertContains(response, 'Комментарий')
+        self.client.force_login(self.far)
+        self.client.post(
+            reverse('posts:post_edit', args=[post.pk]), {'text': 'Правка'})
+        self.assertEqual(
+            Post.objects.using('shard1').get(pk=post.pk).text, 'Правка')
+
+    def test_delete_cleans_default_database(self):
+        """Удаление поста на шарде убирает его записи из основной базы"""
+        Follow.objects.create(user=self.reader, author=self.far)
+        post = Post.objects.using('shard1').get(pk=self.posts[1].pk)
+        post.delete()
+        self.assertFalse(FeedEntry.objects.filter(post_id=post.pk).exists())
+        self.assertFalse(PostLocation.objects.filter(pk=post.pk).exists())
+
+    def test_rebalance_moves_author(self):
+        """rebalance_shards переносит посты и комментарии автора"""
+        post = self.posts[1]
+        Comment.objects.create(post=post, author=self.near, text='Привет')
+        call_command(
+            'rebalance_shards', author='far', to='default', grace=0,
+            stdout=StringIO())
+        self.assertEqual(self.shard_posts('shard1', self.far), [])
+        self.assertEqual(len(self.shard_posts('default', self.far)), 2)
+        self.assertEqual(Comment.objects.using('shard1').count(), 0)
+        self.assertEqual(
+            Comment.objects.using('default').get().post_id, post.pk)
+        shard = AuthorShard.objects.get(user=self.far)
+        self.assertEqual((shard.alias, shard.pinned), ('default', True))
+        response = self.client.get(
+            reverse('posts:post_detail', args=[post.pk]))
+        self.assertContains(response, 'Привет')
+
+    def test_writes_closed_while_author_moves(self):
+        """Пока автора переносят, запись его постов отвечает 503"""
+        post = self.posts[1]
+        AuthorShard.objects.filter(user=self.far).update(moving=True)
+        response = self.client.post(
+            reverse('posts:add_comment', args=[post.pk]),
+            {'text': 'Комментарий'})
+        self.assertEqual(response.status_code, 503)
+        self.client.force_login(self.far)
+        response = self.client.post(
+            reverse('posts:post_edit', args=[post.pk]), {'text': 'Правка'})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(Comment.objects.using('shard1').count(), 0)
+        self.assertEqual(
+            Post.objects.using('shard1').get(pk=post.pk).text, 'Пост 1')
+        self.assertEqual(len(self.page_texts(reverse('posts:index'))), 4)
+
+    def test_rebalance_waits_once_per_batch(self):
+        """Ожидание после закрытия записи — одно на пачку авторов"""
+        command = rebalance_shards.Command(stdout=StringIO())
+        with mock.patch.object(rebalance_shards.time, 'sleep') as sleep:
+            command.move(
+                [(self.near.pk, 'default', 'shard1'),
+                 (self.far.pk, 'shard1', 'default')], False, 5)
+        sleep.assert_called_once_with(5)
+        self.assertEqual(len(self.shard_posts('shard1', self.near)), 2)
+        self.assertEqual(len(self.shard_posts('default', self.far)), 2)
+        self.assertFalse(AuthorShard.objects.filter(moving=True).exists())
+        self.client.force_login(self.far)
+        self.client.post(
+            reverse('posts:post_edit', args=[self.posts[1].pk]),
+            {'text': 'Правка'})
+        self.assertEqual(
+            Post.objects.using('default').get(pk=self.posts[1].pk).text,
+            'Правка')
+
+    def test_search_merges_shards(self):
+        """Поиск собирает совпадения со всех шардов"""
+        response = self.client.get(reverse('posts:search'), {'q': 'пост'})
+        self.assertEqual(
+            {post.pk for post in response.context['page_obj']},
+            {post.pk for post in self.posts})
+
+    def test_tag_feed_reads_posts_from_shards(self):
+        """Лента тега подгружает посты с шардов их авторов"""
+        near = Post.objects.create(author=self.near, text='#шард')
+        far = Post.objects.create(author=self.far, text='#шард @reader')
+        self.assertEqual(
+            self.page_texts(reverse('posts:tag_posts', args=['шард'])),
+            [far.text, near.text])
+        self.assertEqual(
+            self.page_texts(reverse('posts:mentions')), [far.text])
+        far.delete()
+        self.assertEqual(
+            self.page_texts(reverse('posts:tag_posts', args=['шард'])),
+            [near.text])
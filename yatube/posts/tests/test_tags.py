@@ -0,0 +1,124 @@
+from io import StringIO
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.test import TestCase
+from django.urls import reverse
+
+from core.models import Checkpoint
+from posts import tags
+from posts.models import Comment, Mention, Post, TagEntry
+
+User = get_user_model()
+
+
+class ParseTests(TestCase):
+
+    def test_parse_tags(self):
+        """Теги: без регистра, не из адресов, якорей и сущностей"""
+        self.assertEqual(
+            tags.parse_tags(
+                '#Море и #море, #лес! a#b http://x.ru/#anchor &#123; ##'),
+            {'море', 'лес'})
+        self.assertEqual(tags.parse_tags('#' + 'т' * 51), set())
+
+    def test_parse_mentions(self):
+        """Упоминания: не из почты, точка в конце не входит в имя"""
+        self.assertEqual(
+            tags.parse_mentions('Привет, @ann и @bob.smith. me@mail.ru'),
+            {'ann', 'bob.smith'})
+
+
+class TagFeedTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create_user(username='author')
+        self.ann = User.objects.create_user(username='ann')
+        self.sea = Post.objects.create(
+            author=self.author, text='#Море и @ann')
+        self.forest = Post.objects.create(
+            author=self.author, text='#лес и #море')
+
+    def page(self, url):
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return list(response.context['page_obj'])
+
+    def tag_page(self, tag):
+        return self.page(reverse('posts:tag_posts', args=[tag]))
+
+    def mentions_page(self):
+        self.client.force_login(self.ann)
+        return self.page(reverse('posts:mentions'))
+
+    def test_tag_feed(self):
+        """Лента тега: новые посты сверху, тег без учёта регистра"""
+        self.assertEqual(self.tag_page('МОРЕ'), [self.forest, self.sea])
+        self.assertEqual(self.tag_page('лес'), [self.forest])
+        self.assertEqual(self.tag_page('горы'), [])
+
+    def test_mentions_feed(self):
+        """Лента упоминаний показывает только посты с @username"""
+        self.assertEqual(self.mentions_page(), [self.sea])
+        self.client.logout()
+        response = self.client.get(reverse('posts:mentions'))
+        self.assertEqual(response.status_code, 302)
+
+    def test_feeds_share_template(self):
+        """Ленты тега и упоминаний — один шаблон со своим заголовком"""
+        self.client.force_login(self.ann)
+        for url, title in (
+                (reverse('posts:tag_posts', args=['Море']),
+                 'Записи с тегом #море'),
+                (reverse('posts:mentions'), 'Упоминания меня')):
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                self.assertTemplateUsed(response, 'posts/post_list.html')
+                self.assertContains(response, f'<h1>{title}</h1>')
+
+    def test_index_follows_edits(self):
+        """Правка и удаление поста обновляют индекс и кэш лент"""
+        self.assertEqual(self.tag_page('лес'), [self.forest])
+        self.assertEqual(self.mentions_page(), [self.sea])
+        self.forest.text = '#горы и @ann'
+        self.forest.save()
+        self.assertEqual(self.tag_page('лес'), [])
+        self.assertEqual(self.tag_page('горы'), [self.forest])
+        self.assertEqual(self.mentions_page(), [self.forest, self.sea])
+        self.sea.delete()
+        self.assertEqual(self.tag_page('море'), [])
+        self.assertEqual(self.mentions_page(), [self.forest])
+
+    def test_comment_updates_cached_feeds(self):
+        """Комментарий меняет счётчик на карточке в лентах тега и
+        упоминаний"""
+        urls = (
+            reverse('posts:tag_posts', args=['море']),
+            reverse('posts:mentions'))
+        self.client.force_login(self.ann)
+        for url in urls:
+            self.assertContains(self.client.get(url), 'комментариев: 0')
+        Comment.objects.create(post=self.sea, author=self.ann, text='Да')
+        for url in urls:
+            with self.subTest(url=url):
+                self.assertContains(
+                    self.client.get(url), 'комментариев: 1')
+
+    def test_backfill_resumes(self):
+        """index_tags продолжает с сохранённой позиции"""
+        TagEntry.objects.all().delete()
+        Mention.objects.all().delete()
+        Checkpoint.objects.create(
+            name='index_tags:default', position=self.sea.pk)
+        call_command('index_tags', stdout=StringIO())
+        self.assertEqual(
+            set(TagEntry.objects.values_list('post_id', flat=True)),
+            {self.forest.pk})
+        call_command('index_tags', restart=True, stdout=StringIO())
+        self.assertEqual(TagEntry.objects.count(), 3)
+        self.assertEqual(
+            Checkpoint.objects.get(name='index_tags:default').position,
+            self.forest.pk)
+        self.assertEqual(self.mentions_page(), [self.sea])
@@ -1,13 +1,23 @@
+import base64
+import hashlib
+import re
 import shutil
 import tempfile
+import time
+from io import StringIO
+from unittest import mock
 from django.contrib.auth import get_user_model
-from django.test import Client, TestCase, override_settings
+from django.test import Client, RequestFactory, TestCase, override_settings
 from django.urls import reverse
 from django import forms
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.conf import settings
-from posts.models import Post, Group
+from posts.models import Comment, FeedEntry, Follow, Post, Group
+from django.core.management import call_command
 from django.core.cache import cache
+from core.cache import _is_stale, bump, page_key
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 User = get_user_model()
 
 # Создаем временную папку для медиа-файлов;
@@ -37,6 +47,9 @@ class PostsPagesTests(TestCase):
             content=small_gif,
             content_type='image/gif'
         )
+        # Хранилище называет картинки по sha256 содержимого.
+        digest = hashlib.sha256(small_gif).hexdigest()
+        cls.image_name = f'posts/{digest[:2]}/{digest[2:4]}/{digest}.gif'
         cls.post = Post.objects.create(
             author=cls.user,
             text='Текст',
@@ -100,7 +113,7 @@ class PostsPagesTests(TestCase):
         # Проверяем текст поста
         self.assertEqual(post_text_0, 'Текст')
         # Проверяет картинку
-        self.assertEqual(post_image, 'posts/small.gif')
+        self.assertEqual(post_image, self.image_name)
 
     def test_group_list_show_correct_context(self):
         """Шаблон group_list  сформирован с правильным контекстом."""
@@ -116,7 +129,7 @@ class PostsPagesTests(TestCase):
             response.context.get('group').slug, 'test-slug')
         first_object = response.context['page_obj'][0]
         post_image = first_object.image
-        self.assertEqual(post_image, 'posts/small.gif')
+        self.assertEqual(post_image, self.image_name)
 
     def test_profile_show_correct_context(self):
         """Шаблон profile  сформирован с правильным контекстом."""
@@ -129,7 +142,7 @@ class PostsPagesTests(TestCase):
         self.assertEqual(post_detail_obj, 'HasNoName')
         # # Проверяет картинку
         first_object = self.post.image
-        self.assertEqual(first_object, 'posts/small.gif')
+        self.assertEqual(first_object, self.image_name)
         # first_object = self.post.image
         # self.assertIn(first_object, 'posts/small.gif')
 
@@ -140,7 +153,7 @@ class PostsPagesTests(TestCase):
         post_detail_obj = response.context['posts'].pk
         self.assertEqual(post_detail_obj, 1)
         post_image = response.context['posts'].image
-        self.assertEqual(post_image, 'posts/small.gif')
+        self.assertEqual(post_image, self.image_name)
 
     # Проверка словаря контекста создания поста (в нём передаётся форма)
     def test_create_post_show_correct_context(self):
@@ -219,7 +232,7 @@ class PaginatorViewsTest(TestCase):
     def test_second_page_contains_three_records_index(self):
         """Проверяем паджинатор второй страницы index
         Проверка: на второй странице должно быть 3 поста"""
-        response = self.client.get('', {'page': 2})
+        response = self.client.get('', {'page': 2}, follow=True)
         self.assertEqual(len(response.context['page_obj']), 3)
 
     def test_first_page_contains_ten_records_group_list(self):
@@ -234,7 +247,7 @@ class PaginatorViewsTest(TestCase):
         Проверка: на второй странице должно быть 3 поста"""
         response = self.client.get(reverse('posts:group_list',
                                    kwargs={'slug': 'test-slug1'})
-                                   + '?page=2')
+                                   + '?page=2', follow=True)
         self.assertEqual(len(response.context['page_obj']), 3)
 
     def test_first_page_contains_ten_records_profile(self):
@@ -248,9 +261,91 @@ class PaginatorViewsTest(TestCase):
         """Проверяем паджинатор второй страницы profile
         Проверка: на второй странице должно быть 3 поста"""
         response = self.authorized_client.get(
-            reverse('posts:profile', kwargs={'username': 'auth1'}) + '?page=2')
+            reverse('posts:profile', kwargs={'username': 'auth1'}) + '?page=2',
+            follow=True)
         self.assertEqual(len(response.context['page_obj']), 3)
 
+    def test_cursor_pages_index(self):
+        """Проверяем переходы по ?cursor= вперёд, назад и на последнюю
+        Проверка: страницы не пересекаются и покрывают все посты"""
+        first_page = self.client.get(reverse('posts:index')).context[
+            'page_obj']
+        self.assertTrue(first_page.has_next())
+        self.assertFalse(first_page.has_previous())
+        second_page = self.client.get(
+            reverse('posts:index'),
+            {'cursor': first_page.paginator.next_cursor}).context['page_obj']
+        self.assertEqual(len(second_page), 3)
+        self.assertFalse(second_page.has_next())
+        self.assertEqual(
+            {post.pk for post in first_page}
+            | {post.pk for post in second_page},
+            set(Post.objects.values_list('pk', flat=True)))
+        previous_cursor = second_page.paginator.previous_cursor
+        back_page = self.client.get(
+            reverse('posts:index'),
+            {'cursor': previous_cursor}).context['page_obj']
+        self.assertEqual(list(back_page), list(first_page))
+        last_page = self.client.get(
+            reverse('posts:index'),
+            {'cursor': first_page.paginator.last_cursor}).context['page_obj']
+        self.assertEqual(list(last_page)[-1], Post.objects.order_by(
+            'pub_date', 'pk').first())
+
+    def test_cursor_page_does_not_count(self):
+        """Проверяем, что страница по курсору не делает COUNT(*)"""
+        first_page = self.client.get(reverse('posts:index')).context[
+            'page_obj']
+        cache.clear()
+        next_cursor = first_page.paginator.next_cursor
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('posts:index'), {'cursor': next_cursor})
+        self.assertFalse(
+            [q for q in queries if 'COUNT(' in q['sql'].upper()])
+
+    def test_legacy_page_redirects_to_cursor(self):
+        """Проверяем, что ?page=N ведёт на курсор без OFFSET"""
+        first_page = self.client.get(reverse('posts:index')).context[
+            'page_obj']
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(
+                reverse('posts:index'), {'page': 2, 'x': 'y'})
+        self.assertRedirects(
+            response, reverse('posts:index') + '?x=y&cursor='
+            + first_page.paginator.next_cursor)
+        self.assertFalse(
+            [q for q in queries if 'OFFSET' in q['sql'].upper()])
+        response = self.client.get(reverse('posts:index'), {'page': 1})
+        self.assertRedirects(response, reverse('posts:index'))
+
+    def test_page_links_keep_query(self):
+        """Проверяем, что ссылки паджинатора сохраняют параметры"""
+        first_page = self.client.get(reverse('posts:index')).context[
+            'page_obj']
+        response = self.client.get(reverse('posts:index'), {
+            'x': 'y', 'cursor': first_page.paginator.next_cursor})
+        self.assertContains(response, 'href="?x=y">Первая')
+        self.assertContains(response, '?x=y&amp;cursor=')
+
+    def test_broken_cursor_returns_first_page(self):
+        """Проверяем, что битый токен открывает первую страницу"""
+        response = self.client.get(reverse('posts:index'), {'cursor': '%%'})
+        self.assertEqual(len(response.context['page_obj']), 10)
+        self.assertFalse(response.context['page_obj'].has_previous())
+
+    def test_crafted_cursor_returns_first_page(self):
+        """Проверяем, что токен с не-ASCII цифрой в id или датой вне
+        диапазона тоже открывает первую страницу, а не 500"""
+        for raw in ('n|2020-01-01T00:00:00|²', 'n|2020-13-45T00:00:00|1'):
+            with self.subTest(raw=raw):
+                cursor = base64.urlsafe_b64encode(raw.encode()).decode()
+                response = self.client.get(
+                    reverse('posts:index'), {'cursor': cursor})
+                self.assertEqual(len(response.context['page_obj']), 10)
+                self.assertFalse(
+                    response.context['page_obj'].has_previous())
+
 
 class PostViewsTest_create_post_in(TestCase):
 
@@ -383,10 +478,8 @@ class PostsIndexCache(TestCase):
         """Тест проверяющий работу кэширования страницы"""
         response_first = self.authorized_client.get(
             reverse('posts:index'))
-        Post.objects.create(
-            text='Тестирование кэша главной страницы',
-            author=self.user,
-        )
+        # update() не шлёт сигналов: страница должна прийти из кэша
+        Post.objects.filter(pk=self.post.pk).update(text='Без сигнала')
         response_two = self.authorized_client.get(
             reverse('posts:index'))
         self.assertEqual(response_first.content, response_two.content)
@@ -395,6 +488,118 @@ class PostsIndexCache(TestCase):
             reverse('posts:index'))
         self.assertNotEqual(response_first.content, response_three.content)
 
+    def test_cached_index_shared_between_users(self):
+        """Закэшированная главная общая, но шапка у каждого своя"""
+        self.authorized_client.get(reverse('posts:index'))
+        other_client = Client()
+        other_client.force_login(self.post.author)
+        with CaptureQueriesContext(connection) as queries:
+            response = other_client.get(reverse('posts:index'))
+        self.assertFalse(
+            [q for q in queries if 'posts_post' in q['sql']])
+        self.assertContains(response, 'Пользователь: auth')
+        self.assertNotContains(response, 'HasNoName')
+        self.assertContains(response, 'Избранные авторы')
+        response = self.guest_client.get(reverse('posts:index'))
+        self.assertNotContains(response, 'Избранные авторы')
+        self.assertContains(response, 'Регистрация')
+
+    def test_post_card_fragment_cache(self):
+        """Карточка поста берётся из кэша, пока не изменилась его версия"""
+        self.guest_client.get(reverse('posts:index'))
+        Post.objects.filter(pk=self.post.pk).update(text='Без сигнала')
+        bump('posts')
+        response = self.guest_client.get(reverse('posts:index'))
+        self.assertNotContains(response, 'Без сигнала')
+        post = Post.objects.get(pk=self.post.pk)
+        post.text = 'После правки'
+        post.save()
+        response = self.guest_client.get(reverse('posts:index'))
+        self.assertContains(response, 'После правки')
+
+    def test_stale_page_served_while_locked(self):
+        """Пока другой запрос пересчитывает страницу, отдаётся старая"""
+        self.guest_client.get(reverse('posts:index'))
+        Post.objects.create(text='Пересчитывается', author=self.post.author)
+        lock_key = page_key(
+            RequestFactory().get(reverse('posts:index')),
+            'index_page') + ':lock'
+        cache.add(lock_key, 1)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.guest_client.get(reverse('posts:index'))
+        self.assertNotContains(response, 'Пересчитывается')
+        self.assertFalse(
+            [q for q in queries if 'posts_post' in q['sql']])
+        cache.delete(lock_key)
+        response = self.guest_client.get(reverse('posts:index'))
+        self.assertContains(response, 'Пересчитывается')
+
+    def test_early_recomputation(self):
+        """Дорогая страница пересчитывается до истечения TTL"""
+        now = time.time()
+        entry = {'versions': '1', 'delta': 0.5, 'expires': now + 1}
+        with mock.patch('core.cache.random.random', return_value=0.9):
+            self.assertTrue(_is_stale(entry, '1', now))
+        with mock.patch('core.cache.random.random', return_value=0.1):
+            self.assertFalse(_is_stale(entry, '1', now))
+        self.assertTrue(_is_stale(entry, '2', now))
+
+    def test_cache_invalidated_by_new_post(self):
+        """Новый пост сразу виден на закэшированных страницах"""
+        self.authorized_client.get(reverse('posts:index'))
+        self.authorized_client.get(
+            reverse('posts:profile', kwargs={'username': 'auth'}))
+        Post.objects.create(text='Сразу на главной', author=self.post.author)
+        for url in (
+            reverse('posts:index'),
+            reverse('posts:profile', kwargs={'username': 'auth'}),
+        ):
+            with self.subTest(url=url):
+                response = self.authorized_client.get(url)
+                self.assertContains(response, 'Сразу на главной')
+
+    def test_cache_invalidated_by_comment(self):
+        """Новый комментарий сразу виден на странице поста"""
+        url = reverse('posts:post_detail', kwargs={'post_id': self.post.pk})
+        self.assertContains(
+            self.authorized_client.get(url), 'csrfmiddlewaretoken')
+        self.authorized_client.post(
+            reverse('posts:add_comment', kwargs={'post_id': self.post.pk}),
+            {'text': 'Свежий комментарий'})
+        self.assertContains(
+            self.authorized_client.get(url), 'Свежий комментарий')
+
+    def test_comment_count_on_cached_lists(self):
+        """Число комментариев на карточках лент обновляется сразу"""
+        urls = (
+            reverse('posts:index'),
+            reverse('posts:profile', kwargs={'username': 'auth'}))
+        for url in urls:
+            self.assertContains(
+                self.guest_client.get(url), 'комментариев: 0')
+        comment = Comment.objects.create(
+            post=self.post, author=self.user, text='Комментарий')
+        for url in urls:
+            with self.subTest(url=url):
+                self.assertContains(
+                    self.guest_client.get(url), 'комментариев: 1')
+        comment.delete()
+        for url in urls:
+            with self.subTest(url=url):
+                self.assertContains(
+                    self.guest_client.get(url), 'комментариев: 0')
+
+    def test_following_count_on_cached_profile(self):
+        """Подписка меняет число подписок в профиле читателя"""
+        url = reverse('posts:profile', kwargs={'username': 'HasNoName'})
+        self.assertContains(self.guest_client.get(url), 'подписок: 0')
+        self.authorized_client.get(
+            reverse('posts:profile_follow', kwargs={'username': 'auth'}))
+        self.assertContains(self.guest_client.get(url), 'подписок: 1')
+        self.authorized_client.get(
+            reverse('posts:profile_unfollow', kwargs={'username': 'auth'}))
+        self.assertContains(self.guest_client.get(url), 'подписок: 0')
+
 
 class PostsFollowAuthor(TestCase):
     @classmethod
@@ -480,3 +685,227 @@ class PostsFollowAuthor(TestCase):
         self.assertEqual(
             response_follow_index_none_post.content,
             response_follow_index_unfollow.content)
+
+    def test_new_post_pushed_to_follower_feed(self):
+        """Пост, созданный после подписки, попадает в ленту подписчика"""
+        self.authorized_vasya.get('/profile/Masha/follow/')
+        self.authorized_masha.post(
+            reverse('posts:post_create'), {'text': 'Свежий пост'})
+        self.assertTrue(FeedEntry.objects.filter(
+            user=self.user_vasya, post__text='Свежий пост').exists())
+        response = self.authorized_vasya.get(reverse('posts:follow_index'))
+        self.assertEqual(
+            response.context['page_obj'][0].text, 'Свежий пост')
+
+    @override_settings(FEED_FANOUT_THRESHOLD=0)
+    def test_pulled_post_invalidates_follow_page(self):
+        """Пост pull-автора сбрасывает кэш ленты его подписчиков"""
+        self.authorized_vasya.get('/profile/Masha/follow/')
+        self.authorized_vasya.get(reverse('posts:follow_index'))
+        self.authorized_masha.post(
+            reverse('posts:post_create'), {'text': 'Свежий пост'})
+        response = self.authorized_vasya.get(reverse('posts:follow_index'))
+        self.assertEqual(
+            response.context['page_obj'][0].text, 'Свежий пост')
+
+    def test_rebuild_feeds_command(self):
+        """Команда rebuild_feeds восстанавливает ленты из подписок"""
+        Follow.objects.create(user=self.user_vasya, author=self.user_masha)
+        FeedEntry.objects.all().delete()
+        call_command('rebuild_feeds', stdout=StringIO())
+        self.assertEqual(
+            list(FeedEntry.objects.filter(
+                user=self.user_vasya).values_list('post', flat=True)),
+            [self.post_masha.pk])
+
+    def test_pulled_author_merged_into_feed(self):
+        """Посты автора выше порога fan-out не раскладываются, но
+        подмешиваются в ленту при чтении в порядке pub_date"""
+        user_petya = User.objects.create_user(username='Petya')
+        Follow.objects.create(user=self.user_vasya, author=self.user_masha)
+        Follow.objects.create(user=self.user_vasya, author=user_petya)
+        Follow.objects.create(user=self.user_masha, author=user_petya)
+        with self.settings(FEED_FANOUT_THRESHOLD=1):
+            posts = []
+            for i in range(12):
+                posts.append(Post.objects.create(
+                    author=user_petya if i % 2 else self.user_masha,
+                    text=f'Пост {i}'))
+            self.assertFalse(
+                FeedEntry.objects.filter(author=user_petya).exists())
+            first_page = self.authorized_vasya.get(
+                reverse('posts:follow_index')).context['page_obj']
+            second_page = self.authorized_vasya.get(
+                reverse('posts:follow_index'),
+                {'cursor': first_page.paginator.next_cursor}
+            ).context['page_obj']
+        expected = sorted(
+            posts + [self.post_masha],
+            key=lambda post: (post.pub_date, post.pk), reverse=True)
+        self.assertEqual(list(first_page) + list(second_page), expected)
+
+    def test_fanout_threshold_crossing(self):
+        """При переходе порога fan-out записи лент удаляются и
+        раскладываются заново, и посты не теряются"""
+        user_petya = User.objects.create_user(username='Petya')
+        Follow.objects.create(user=self.user_vasya, author=self.user_masha)
+        with self.settings(FEED_FANOUT_THRESHOLD=1):
+            self.assertTrue(FeedEntry.objects.filter(
+                author=self.user_masha).exists())
+            follow = Follow.objects.create(
+                user=user_petya, author=self.user_masha)
+            self.assertFalse(FeedEntry.objects.filter(
+                author=self.user_masha).exists())
+            pulled_post = Post.objects.create(
+                author=self.user_masha, text='Пост в режиме pull')
+            follow.delete()
+            self.assertEqual(
+                set(FeedEntry.objects.filter(
+                    user=self.user_vasya).values_list('post', flat=True)),
+                {self.post_masha.pk, pulled_post.pk})
+
+
+class QueryBudgetTests(TestCase):
+    """Число запросов страницы не растёт с числом постов на ней"""
+    def setUp(self):
+        cache.clear()
+        self.reader = User.objects.create_user(username='reader')
+        self.group = Group.objects.create(
+            title='Группа', slug='budget', description='Описание')
+        self.client.force_login(self.reader)
+        self.authors = [
+            User.objects.create_user(username=f'author{index}')
+            for index in range(3)]
+        for author in self.authors:
+            Follow.objects.create(user=self.reader, author=author)
+
+    def add_posts(self, count):
+        for index in range(count):
+            post = Post.objects.create(
+                author=self.authors[index % 3],
+                group=self.group, text=f'Пост {index}')
+            Comment.objects.create(
+                post=post, author=self.reader, text='Комментарий')
+
+    def get(self, url, queries):
+        cache.clear()
+        with self.assertNumQueries(queries):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+    def assertBudget(self, url, queries):
+        self.add_posts(2)
+        self.get(url, queries)
+        self.add_posts(10)
+        self.get(url, queries)
+
+    def test_index(self):
+        self.assertBudget(reverse('posts:index'), 3)
+
+    def test_group(self):
+        self.assertBudget(reverse('posts:group_list', args=['budget']), 4)
+
+    def test_profile(self):
+        self.assertBudget(
+            reverse('posts:profile', args=['author0']), 5)
+
+    def test_follow_index(self):
+        # Один запрос — подписки читателя для областей кэша.
+        self.assertBudget(reverse('posts:follow_index'), 5)
+
+    @override_settings(FEED_FANOUT_THRESHOLD=0)
+    def test_follow_index_pulled(self):
+        # Плюс по запросу на каждого из трёх pull-авторов.
+        self.assertBudget(reverse('posts:follow_index'), 8)
+
+    def test_post_detail(self):
+        post = Post.objects.create(author=self.authors[0], text='Пост')
+        url = reverse('posts:post_detail', args=[post.pk])
+        self.get(url, 5)
+        for _ in range(10):
+            Comment.objects.create(
+                post=post, author=self.reader, text='Комментарий')
+        self.get(url, 5)
+
+
+class QueryPlanTests(TestCase):
+    """Запросы страниц идут по индексам"""
+    # Полное сканирование таблицы или сортировка во временном B-tree.
+    BAD_PLAN = re.compile(r'^SCAN (TABLE )?\w+$|TEMP B-TREE')
+
+    def setUp(self):
+        cache.clear()
+        self.reader = User.objects.create_user(username='reader')
+        self.author = User.objects.create_user(username='author')
+        self.celebrity = User.objects.create_user(username='celebrity')
+        self.group = Group.objects.create(
+            title='Группа', slug='plans', description='Описание')
+        Follow.objects.create(user=self.reader, author=self.author)
+        Follow.objects.create(user=self.reader, author=self.celebrity)
+        for index in range(15):
+            self.post = Post.objects.create(
+                author=self.author if index % 2 else self.celebrity,
+                group=self.group, text=f'Пост {index}')
+            Comment.objects.create(
+                post=self.post, author=self.reader, text='Комментарий')
+        self.client.force_login(self.reader)
+
+    def plans(self, url):
+        """Планы всех SELECT страницы и её следующей и последней страниц"""
+        queries = []
+        cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        queries.extend(context.captured_queries)
+        page_obj = response.context.get('page_obj')
+        if page_obj is not None:
+            for cursor in (page_obj.paginator.next_cursor,
+                           page_obj.paginator.last_cursor):
+                if cursor is None:
+                    continue
+                with CaptureQueriesContext(connection) as context:
+                    self.client.get(url, {'cursor': cursor})
+                queries.extend(context.captured_queries)
+        with connection.cursor() as cursor:
+            for query in queries:
+                sql = query['sql']
+                if not sql.startswith('SELECT'):
+                    continue
+                cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+                yield sql, [row[-1] for row in cursor.fetchall()]
+
+    def assertIndexed(self, url):
+        for sql, plan in self.plans(url):
+            for step in plan:
+                with self.subTest(sql=sql, step=step):
+                    self.assertIsNone(self.BAD_PLAN.search(step))
+
+    def test_index(self):
+        self.assertIndexed(reverse('posts:index'))
+
+    def test_group(self):
+        self.assertIndexed(reverse('posts:group_list', args=['plans']))
+
+    def test_profile(self):
+        self.assertIndexed(reverse('posts:profile', args=['author']))
+
+    def test_tag(self):
+        for index in range(15):
+            Post.objects.create(author=self.author, text=f'#план {index}')
+        self.assertIndexed(reverse('posts:tag_posts', args=['план']))
+
+    def test_mentions(self):
+        for index in range(15):
+            Post.objects.create(author=self.author, text=f'@reader {index}')
+        self.assertIndexed(reverse('posts:mentions'))
+
+    def test_post_detail(self):
+        self.assertIndexed(
+            reverse('posts:post_detail', args=[self.post.pk]))
+
+    def test_follow_index(self):
+        self.assertIndexed(reverse('posts:follow_index'))
+
+    @override_settings(FEED_FANOUT_THRESHOLD=0)
+    def test_follow_index_pulled(self):
+        self.assertIndexed(reverse('posts:follow_index'))
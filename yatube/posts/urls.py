@@ -8,6 +8,9 @@ urlpatterns = [
     path('', views.index, name='index'),
     # Посты, отфильтрованные по группам.
     path('group/<slug>/', views.group_posts, name='group_list'),
+    # Посты с хештегом и посты, где упомянут текущий пользователь
+    path('tag/<str:tag>/', views.tag_posts, name='tag_posts'),
+    path('mentions/', views.mentions, name='mentions'),
     # Просмотр записи
     path('posts/<int:post_id>/edit/', views.post_edit, name='post_edit'),
     path(
@@ -16,6 +19,8 @@ urlpatterns = [
         name='add_comment'),
     path('posts/<int:post_id>/', views.post_detail, name='post_detail'),
     path('create/', views.post_create, name='post_create'),
+    # Полнотекстовый поиск по постам
+    path('search/', views.search, name='search'),
     path('follow/', views.follow_index, name='follow_index'),
     path(
         'profile/<str:username>/follow/',
@@ -1,19 +1,42 @@
 from django.shortcuts import redirect, render, get_object_or_404
 from django.contrib.auth.decorators import login_required
 from .forms import PostForm, CommentForm
-from .models import Post, Group, User, Follow
-from django.core.paginator import Paginator
-from django.views.decorators.cache import cache_page
+from . import counters, feed, renditions, sharding, tags
+from .models import Post, PostLocation, Group, User, Follow
+from .paginator import legacy_pages, paginate
+from .search import SearchPaginator
+from core.cache import attach_versions, cache_versioned
+from core.replicas import replica_reads
+from core.writer import write
 
 TEN = 10
+# Страницы инвалидируются сигналами, поэтому TTL может быть долгим.
+CACHE_TIMEOUT = 60 * 60 * 24
 
 
-@cache_page(timeout=20, key_prefix='index_page')
+def post_scopes(request, post_id):
+    # На странице поста есть счётчик постов автора, поэтому она
+    # зависит и от версии автора.
+    posts = PostLocation.objects if sharding.is_sharded() else Post.objects
+    username = posts.filter(pk=post_id).values_list(
+        'author__username', flat=True).first()
+    return [f'post:{post_id}', f'author:{username}']
+
+
+def prepare_cards(posts):
+    """Версии кэша карточек и миниатюры постов страницы."""
+    attach_versions(posts, 'post:{}')
+    renditions.prefetch(posts)
+
+
+@legacy_pages
+@replica_reads
+@cache_versioned(
+    CACHE_TIMEOUT, 'index_page', lambda request: ['posts'])
 def index(request):
-    post_list = Post.objects.select_related('author', 'group')
-    paginator = Paginator(post_list, TEN)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    post_list = Post.objects.for_cards()
+    page_obj = sharding.paginate_posts(request, post_list, TEN)
+    prepare_cards(page_obj)
     title = 'Последние обновления на сайте'
     is_index = True
     context = {
@@ -24,12 +47,16 @@ def index(request):
     return render(request, 'posts/index.html', context)
 
 
+@legacy_pages
+@replica_reads
+@cache_versioned(
+    CACHE_TIMEOUT, 'group_page',
+    lambda request, slug: [f'group:{slug}'])
 def group_posts(request, slug):
     group = get_object_or_404(Group, slug=slug)
-    posts = group.posts.select_related('group')
-    paginator = Paginator(posts, TEN)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    posts = group.posts.for_cards()
+    page_obj = sharding.paginate_posts(request, posts, TEN)
+    prepare_cards(page_obj)
     title = f'Записи сообщества {group}'
     context = {
         'group': group,
@@ -41,39 +68,95 @@ def group_posts(request, slug):
     return render(request, 'posts/group_list.html', context)
 
 
+@legacy_pages
+@replica_reads
+@cache_versioned(
+    CACHE_TIMEOUT, 'profile_page',
+    lambda request, username: [f'author:{username}'])
 def profile(request, username):
-    author = get_object_or_404(User, username=username)
-    post_list = author.posts.select_related('author', 'group')
-    paginator = Paginator(post_list, TEN)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
-    posts_count = author.posts.count
-    if request.user.is_authenticated:
-        following = Follow.objects.filter(
-            user=request.user, author=author).exists()
-    else:
-        following = False
+    author = get_object_or_404(
+        User.objects.select_related('stats'), username=username)
+    # author.posts роутер направляет на шард автора.
+    post_list = author.posts.for_cards()
+    page_obj = paginate(request, post_list, TEN)
+    prepare_cards(page_obj)
+    stats = counters.author_stats(author)
     context = {
         'author': author,
         'page_obj': page_obj,
-        'posts_count': posts_count,
-        'following': following,
+        'posts_count': stats.posts_count,
+        'stats': stats,
     }
     return render(request, 'posts/profile.html', context)
 
 
+@replica_reads
+@cache_versioned(CACHE_TIMEOUT, 'post_page', post_scopes)
 def post_detail(request, post_id):
-    post = get_object_or_404(Post, pk=post_id)
-    comments = post.comments.select_related('post', 'author')
+    post = get_object_or_404(
+        sharding.post_queryset(post_id).for_cards('author__stats'),
+        pk=post_id)
+    comments = sharding.with_related(post.comments.all(), 'author')
+    renditions.prefetch([post])
     form = CommentForm()
     context = {
         'posts': post,
+        'posts_count': counters.author_stats(post.author).posts_count,
         'form': form,
         'comments': comments,
     }
     return render(request, 'posts/post_detail.html', context)
 
 
+@legacy_pages
+@replica_reads
+@cache_versioned(
+    CACHE_TIMEOUT, 'tag_page', lambda request, tag: [f'tag:{tag.lower()}'])
+def tag_posts(request, tag):
+    page_obj = feed.entries_page(
+        request, [feed.entry_stream(tags.tag_entries(tag))], TEN)
+    prepare_cards(page_obj)
+    context = {
+        'page_obj': page_obj,
+        'tag': tag.lower(),
+        'title': f'Записи с тегом #{tag.lower()}',
+    }
+    return render(request, 'posts/post_list.html', context)
+
+
+@legacy_pages
+@replica_reads
+@login_required
+@cache_versioned(
+    CACHE_TIMEOUT, 'mentions_page',
+    lambda request: [f'mentions:{request.user.pk}'],
+    per_user=True)
+def mentions(request):
+    page_obj = feed.entries_page(
+        request, [feed.entry_stream(tags.mention_entries(request.user))],
+        TEN)
+    prepare_cards(page_obj)
+    context = {
+        'page_obj': page_obj,
+        'title': 'Упоминания меня',
+    }
+    return render(request, 'posts/post_list.html', context)
+
+
+@replica_reads
+def search(request):
+    query = request.GET.get('q', '').strip()
+    page_obj = SearchPaginator(query, TEN).get_page(
+        request.GET.get('cursor'))
+    prepare_cards(page_obj)
+    context = {
+        'page_obj': page_obj,
+        'query': query,
+        'title': 'Поиск',
+    }
+    return render(request, 'posts/search.html', context)
+
+
 @login_required
 def post_create(request):
     title = 'Новый пост'
@@ -83,7 +166,7 @@ def post_create(request):
     if form.is_valid():
         form = form.save(commit=False)
         form.author = request.user
-        form.save()
+        write(form.save)
         return redirect('posts:profile', request.user.username)
     context = {
         'form': form,
@@ -94,7 +177,7 @@ def post_create(request):
 
 @login_required
 def post_edit(request, post_id):
-    post = get_object_or_404(Post, pk=post_id)
+    post = get_object_or_404(sharding.post_queryset(post_id), pk=post_id)
     if request.user != post.author:
         return redirect('posts:post_detail', post_id=post.id)
     form = PostForm(
@@ -109,29 +192,33 @@ def post_edit(request, post_id):
     if form.is_valid():
         form.author = request.user
         form = form.save(commit=False)
-        form.save()
+        write(form.save)
         return redirect('posts:post_detail', post_id=post.id)
     return render(request, 'posts/create_post.html', context)
 
 
 @login_required
 def add_comment(request, post_id):
-    post = get_object_or_404(Post, id=post_id)
+    post = get_object_or_404(sharding.post_queryset(post_id), pk=post_id)
     form = CommentForm(request.POST or None)
     if form.is_valid():
         comment = form.save(commit=False)
         comment.author = request.user
         comment.post = post
-        comment.save()
+        write(comment.save)
     return redirect('posts:post_detail', post_id=post_id)
 
 
+@legacy_pages
+@replica_reads
 @login_required
+@cache_versioned(
+    CACHE_TIMEOUT, 'follow_page',
+    lambda request: feed.page_scopes(request.user.pk),
+    per_user=True)
 def follow_index(request):
-    post_list = Post.objects.filter(author__following__user=request.user)
-    paginator = Paginator(post_list, TEN)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    page_obj = feed.follow_page(request, TEN)
+    prepare_cards(page_obj)
     title = ('Посты избранных авторов')
     is_follow = True
     context = {
@@ -149,7 +236,8 @@ def profile_follow(request, username):
             user=request.user
         ).exists()
         if not followed:
-            Follow.objects.create(
+            write(
+                Follow.objects.create,
                 author=author,
                 user=request.user
             )
@@ -161,5 +249,5 @@ def profile_unfollow(request, username):
     author = get_object_or_404(User, username=username)
     follower = Follow.objects.filter(user=request.user, author=author)
     if follower.exists():
-        follower.delete()
+        write(follower.delete)
     return redirect('posts:profile', username)
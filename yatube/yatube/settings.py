@@ -58,6 +58,8 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'core.replicas.ReplicaPinMiddleware',
+    'posts.sharding.AuthorMovingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'debug_toolbar.middleware.DebugToolbarMiddleware',
@@ -97,8 +99,44 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
-    }
+    },
+    # Локальная реплика: копия основной базы, которую обновляет
+    # manage.py sync_replica.
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'db.replica.sqlite3'),
+        'TEST': {'MIRROR': 'default'},
+    },
+    # Второй шард постов для локальной проверки (posts.sharding):
+    # migrate --database shard1, затем POST_SHARDS = ['default', 'shard1']
+    # и manage.py rebalance_shards.
+    'shard1': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, 'db.shard1.sqlite3'),
+    },
 }
+DATABASE_ROUTERS = [
+    'posts.sharding.ShardRouter',
+    'core.replicas.ReplicaRouter',
+]
+# Алиасы, по которым разложены посты и комментарии; один алиас —
+# шардирование выключено.
+POST_SHARDS = ['default']
+# Алиасы, с которых читают ленты (core.replicas); пусто — только
+# основная база. Для проверки локально: sync_replica, затем ['replica'].
+DATABASE_REPLICAS = []
+# Сколько секунд после записи пользователь читает из основной базы.
+REPLICA_PIN_SECONDS = 10
+# Наибольшее ожидаемое отставание реплик, секунды.
+REPLICA_MAX_LAG = 5
+
+# PRAGMA для новых соединений с SQLite берутся из core.db.DEFAULT_PRAGMAS;
+# SQLITE_PRAGMAS в настройках заменяет их целиком.
+# Записи из представлений через одного писателя процесса (core.writer).
+SQLITE_WRITE_QUEUE = False
+# Миниатюры картинок постов делает процесс renditions_worker
+# (posts.renditions); False — сразу после коммита в процессе запроса.
+RENDITIONS_ASYNC = True
 
 
 # Password validation
@@ -153,10 +191,29 @@ EMAIL_BACKEND = 'django.core.mail.backends.filebased.EmailBackend'
 EMAIL_FILE_PATH = os.path.join(BASE_DIR, 'sent_emails')
 
 
+# Один файл SQLite на все worker-процессы: общие страницы, фрагменты
+# и счётчики версий видны всем процессам сразу. Перед ним — LRU в
+# памяти процесса с коротким TTL для самых горячих ключей.
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-    }
+        'BACKEND': 'core.cache_backends.TwoTierCache',
+        'LOCATION': 'shared',
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000,
+            'LOCAL_TIMEOUT': 10,
+            'COUNTER_TIMEOUT': 1,
+        },
+    },
+    'shared': {
+        'BACKEND': 'core.cache_backends.SQLiteCache',
+        'LOCATION': os.path.join(BASE_DIR, 'cache', 'cache.sqlite3'),
+        'OPTIONS': {
+            'MAX_ENTRIES': 50000,
+        },
+    },
 }
 
+# Тесты пишут в свой файл кэша (core.testing).
+TEST_RUNNER = 'core.testing.TestRunner'
+
 CSRF_FAILURE_VIEW = 'core.views.csrf_failure'